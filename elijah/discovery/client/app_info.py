@@ -23,6 +23,8 @@ class AppInfo(object):
     REQUIRED_CACHE_FILES     = "required-files"
     REQUIRED_CACHE_URLS      = "required-URLs"
     REQUIRED_MIN_CPU_CLOCK   = "required-cpu-clocks"
+    # return the list of cached files in addition to the cache score
+    RETURN_CACHE_FILES       = "return-cache-files"
 
     WEIGHT_RTT      = "weight-RTT"
     WEIGHT_CACHE    = "weight-cache"
@@ -48,6 +48,7 @@ class DiscoveryConst(object):
 
     # Cloudlet registration
     REGISTER_URL        = "/api/v1/Cloudlet/"
+    HEARTBEAT_URL       = "heartbeat/"
     REST_API_PORT       = 8022
     REST_API_URL        = "/api/v1/resource/"
     KEY_REST_PORT   = "rest_api_port"
@@ -61,6 +62,38 @@ class DiscoveryConst(object):
     # Cloudlet Storage
     CLOUDLET_FS_ROOT = "/cloudletFS"
     DFS_ROOT = "/magfs/home/kiryongh/"
+    # FUSE mount options of CLOUDLET_FS_ROOT. kernel_cache keeps file data
+    # in the page cache across opens; enable it only if DFS_ROOT is not
+    # changed by others while mounted. The loopback caches attributes and
+    # directory listings for attr_timeout seconds as well.
+    FUSE_MOUNT_OPTIONS = {
+        "kernel_cache": False,
+        "big_writes": True,
+        "max_read": 131072,
+        "max_write": 131072,
+        "attr_timeout": 1.0,
+        "entry_timeout": 1.0,
+        "negative_timeout": 1.0,
+        }
+    # chunks of DFS_ROOT files read through the loopback are kept in a local
+    # block cache at BLOCK_CACHE_DIR, preferably on SSD. None disables it.
+    BLOCK_CACHE_DIR = "/var/tmp/cloudlet/block-cache"
+    BLOCK_CACHE_CAPACITY = 4*1024*1024*1024
+    BLOCK_CACHE_CHUNK_SIZE = 1024*1024
+    # cached byte ranges are saved here to survive restarts of the monitor
+    CACHE_STATE_FILE = "/var/tmp/cloudlet/cache-state.log"
+    # prefetch sequentially read files ahead of the reader, and replay the
+    # files an application opened before when it is queried again
+    PREFETCH_ENABLED = False
+    PREFETCH_WORKERS = 4
+    PREFETCH_WINDOW_BLOCKS = 8
+    # warmup requests of the REST API. The bandwidth is in bytes per second,
+    # None for no limit, and URLs are fetched through the HTTP cache proxy
+    # with a timeout in seconds.
+    WARMUP_WORKERS = 2
+    WARMUP_BANDWIDTH = 20*1024*1024
+    WARMUP_HTTP_PROXY = "http://127.0.0.1:3128"
+    WARMUP_HTTP_TIMEOUT = 30
 
     # Avahi server
     MODULE_DIR = os.path.dirname(os.path.abspath(__file__))
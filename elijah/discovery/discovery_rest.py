@@ -4,15 +4,17 @@ import os
 import sys
 import json
 import fnmatch
-import glob2
 
 from flask import Flask
 from flask import request
 from flask.ext import restful
 from flask.ext.restful import Resource
 from flask import jsonify
-from monitor.resource import ResourceMonitor
+from flask import Response
+from monitor import resource
 from monitor import file_cache
+from monitor import web_cache
+from monitor import warmup
 import log as logging
 
 from config import DiscoveryConst
@@ -43,18 +45,28 @@ LOG = TmpLogging()
 
 
 class ResourceInfo(Resource):
+    # the files with the most cached bytes are listed, unless all of them
+    # are requested
+    MAX_CACHE_FILES = 100
+
     resource_monitor = None
     file_cache_monitor = None
+    web_cache_monitor = None
 
     def __init__(self, *args, **kwargs):
         super(ResourceInfo, self).__init__(*args, **kwargs)
         if self.resource_monitor is None:
-            self.resource_monitor = ResourceMonitor()
+            self.resource_monitor = resource.get_instance()
         try:
             if self.file_cache_monitor is None:
                 self.file_cache_monitor = file_cache.get_instance()
         except file_cache.CacheMonitorError as e:
             self.file_cache_monitor = None
+        try:
+            if self.web_cache_monitor is None:
+                self.web_cache_monitor = web_cache.get_instance()
+        except web_cache.WebCacheMonitorError as e:
+            self.web_cache_monitor = None
         self.dfs_root = DiscoveryConst.DFS_ROOT
 
     def get(self):
@@ -69,17 +81,42 @@ class ResourceInfo(Resource):
 
             # file cache
             cache_files = list()
-            cache_score = float(0)
+            cached_bytes = total_bytes = cache_file_count = 0
+            if self.file_cache_monitor is not None and app_id is not None:
+                self.file_cache_monitor.prefetch_app(app_id)
             if self.file_cache_monitor is not None:
                 file_cachelist = app_info.get(AppInfo.REQUIRED_CACHE_FILES, None)
-                cache_files, total_filesize, total_cachesize = \
-                        self.check_file_cache(file_cachelist)
-                if total_filesize is not 0:
-                    cache_score = float(100.0*total_cachesize/total_filesize)
-                else:
-                    cache_score = float(0)
+                if file_cachelist is not None and len(file_cachelist) > 0:
+                    max_files = ResourceInfo.MAX_CACHE_FILES
+                    if app_info.get(AppInfo.RETURN_CACHE_FILES, False):
+                        max_files = None
+                    cached_bytes, total_bytes, cache_files, \
+                            cache_file_count = \
+                            self.file_cache_monitor.app_scores.get(
+                                    file_cachelist, max_files)
+
+            # web cache
+            cache_urls = list()
+            estimated_urls = list()
+            url_list = app_info.get(AppInfo.REQUIRED_CACHE_URLS, None)
+            if self.web_cache_monitor is not None and url_list is not None \
+                    and len(url_list) > 0:
+                url_cached_bytes, url_total_bytes, cache_urls, \
+                        estimated_urls = \
+                        self.web_cache_monitor.check_urls(url_list)
+                cached_bytes += url_cached_bytes
+                total_bytes += url_total_bytes
+            # fraction of the required bytes in the file and web cache
+            cache_score = float(0)
+            if total_bytes > 0:
+                cache_score = float(100.0*cached_bytes/total_bytes)
             ret_data.update({\
                     ResourceConst.APP_CACHE_FILES: cache_files,
+                    # more than listed if the list was cut at MAX_CACHE_FILES
+                    ResourceConst.APP_CACHE_FILE_COUNT: cache_file_count,
+                    ResourceConst.APP_CACHE_URLS: cache_urls,
+                    # counted in the score with an estimated size
+                    ResourceConst.APP_CACHE_ESTIMATED_URLS: estimated_urls,
                     ResourceConst.APP_CACHE_TOTAL_SCORE: cache_score,
                     })
 
@@ -88,33 +125,19 @@ class ResourceInfo(Resource):
             # return default resource info
             return jsonify(ret_data)
 
-    def check_file_cache(self, filepattern_list):
-        if filepattern_list is None or len(filepattern_list) == 0:
-            return list(), 0, 0
-
-        ret_filelist = list()
-        total_filesize = 0
-        total_cachesize = 0
-        filelist = list()
-        for each_pattern in filepattern_list:
-            pattern = os.path.join(self.dfs_root, each_pattern)
-            filelist += glob2.glob(pattern)
-
-        for abspath in filelist:
-            LOG.debug("checking cache file of %s" % abspath)
-            if os.path.isfile(abspath) is not True:
-                continue
-            filesize = os.path.getsize(abspath)
-            total_filesize += filesize
-            if self.file_cache_monitor.check_file(abspath, is_abspath=True) is True:
-                relpath = os.path.relpath(abspath, self.dfs_root)
-                ret_filelist.append(relpath)
-                total_cachesize += filesize
-            ret_filelist.sort()
-        return ret_filelist, total_filesize, total_cachesize
-
 
 class CacheInfo(Resource):
+    # query parameters
+    PARAM_PREFIX = "prefix"
+    PARAM_CURSOR = "cursor"
+    PARAM_LIMIT = "limit"
+    PARAM_STREAM = "stream"
+    TRUE_VALUES = ("1", "true", "yes")
+    FALSE_VALUES = ("", "0", "false", "no")
+    # files per response, and per chunk of a streamed response
+    MAX_PAGE_SIZE = 10000
+    STREAM_PAGE_SIZE = 1000
+
     file_cache_monitor = None
 
     def __init__(self, *args, **kwargs):
@@ -126,12 +149,141 @@ class CacheInfo(Resource):
             self.file_cache_monitor = None
 
     def get(self):
+        prefix = request.args.get(CacheInfo.PARAM_PREFIX, "")
+        cursor = request.args.get(CacheInfo.PARAM_CURSOR, None)
+        if isinstance(prefix, unicode):
+            prefix = prefix.encode("utf-8")
+        if isinstance(cursor, unicode):
+            cursor = cursor.encode("utf-8")
+        stream = request.args.get(CacheInfo.PARAM_STREAM, "").lower()
+        if stream not in CacheInfo.TRUE_VALUES + CacheInfo.FALSE_VALUES:
+            restful.abort(400, message="invalid %s" % CacheInfo.PARAM_STREAM)
+        if stream in CacheInfo.TRUE_VALUES:
+            # one JSON string per line
+            return Response(self._stream(prefix, cursor),
+                    mimetype="application/x-ndjson")
+
+        try:
+            limit = int(request.args.get(CacheInfo.PARAM_LIMIT,
+                CacheInfo.MAX_PAGE_SIZE))
+        except ValueError:
+            restful.abort(400, message="invalid %s" % CacheInfo.PARAM_LIMIT)
+        limit = max(1, min(limit, CacheInfo.MAX_PAGE_SIZE))
         ret_data = {}
         if self.file_cache_monitor is not None:
-            filecache_ret = self.file_cache_monitor.cached_files()
-            ret_data = {ResourceConst.APP_CACHE_FILES: filecache_ret}
+            filecache_ret = self.file_cache_monitor.cached_files(prefix,
+                    cursor, limit)
+            next_cursor = None
+            if len(filecache_ret) == limit:
+                next_cursor = filecache_ret[-1]
+            ret_data = {ResourceConst.APP_CACHE_FILES: filecache_ret,
+                    ResourceConst.APP_CACHE_NEXT_CURSOR: next_cursor}
         return jsonify(ret_data)
 
+    def _stream(self, prefix, cursor):
+        if self.file_cache_monitor is None:
+            return
+        while True:
+            file_list = self.file_cache_monitor.cached_files(prefix, cursor,
+                    CacheInfo.STREAM_PAGE_SIZE)
+            if len(file_list) == 0:
+                return
+            yield "".join([json.dumps(filename) + "\n" for filename in file_list])
+            cursor = file_list[-1]
+
+
+class CachePin(Resource):
+    file_cache_monitor = None
+
+    def __init__(self, *args, **kwargs):
+        super(CachePin, self).__init__(*args, **kwargs)
+        try:
+            if self.file_cache_monitor is None:
+                self.file_cache_monitor = file_cache.get_instance()
+        except file_cache.CacheMonitorError as e:
+            self.file_cache_monitor = None
+
+    def _is_enabled(self):
+        # pinning keeps files in the block cache
+        return self.file_cache_monitor is not None and \
+                self.file_cache_monitor.block_cache_dir is not None
+
+    def _filepattern_list(self):
+        if self.file_cache_monitor is None:
+            restful.abort(503, message="file cache is not monitored")
+        if not self._is_enabled():
+            restful.abort(503, message="block cache is disabled")
+        request_opts = request.json or dict()
+        filepattern_list = request_opts.get(AppInfo.REQUIRED_CACHE_FILES, None)
+        if not isinstance(filepattern_list, list):
+            restful.abort(400, message="need list of %s" % \
+                    AppInfo.REQUIRED_CACHE_FILES)
+        return filepattern_list
+
+    def get(self):
+        ret_data = {}
+        if self._is_enabled():
+            ret_data = {ResourceConst.CACHE_PINNED_FILES: \
+                    self.file_cache_monitor.pinned_files()}
+        return jsonify(ret_data)
+
+    def post(self):
+        pinned = self.file_cache_monitor.pin(self._filepattern_list())
+        return jsonify({ResourceConst.CACHE_PINNED_FILES: pinned})
+
+    def delete(self):
+        self.file_cache_monitor.unpin(self._filepattern_list())
+        return self.get()
+
+
+class CacheWarmup(Resource):
+    file_cache_monitor = None
+
+    def __init__(self, *args, **kwargs):
+        super(CacheWarmup, self).__init__(*args, **kwargs)
+        try:
+            if self.file_cache_monitor is None:
+                self.file_cache_monitor = file_cache.get_instance()
+        except file_cache.CacheMonitorError as e:
+            self.file_cache_monitor = None
+        if self.file_cache_monitor is None or \
+                self.file_cache_monitor.warmup is None:
+            restful.abort(503, message="file cache is not monitored")
+        self.warmup = self.file_cache_monitor.warmup
+
+    def get(self, job_id=None):
+        if job_id is None:
+            return jsonify({ResourceConst.WARMUP_JOBS: [job.to_dict()
+                for job in self.warmup.job_list()]})
+        job = self.warmup.get(job_id)
+        if job is None:
+            restful.abort(404, message="no warmup job %s" % job_id)
+        return jsonify(job.to_dict())
+
+    def post(self, job_id=None):
+        request_opts = request.json or dict()
+        filepattern_list = request_opts.get(AppInfo.REQUIRED_CACHE_FILES, list())
+        url_list = request_opts.get(AppInfo.REQUIRED_CACHE_URLS, list())
+        bandwidth = request_opts.get(ResourceConst.WARMUP_BANDWIDTH, None)
+        if job_id is not None or not isinstance(filepattern_list, list) or \
+                not isinstance(url_list, list):
+            restful.abort(400, message="need lists of %s and %s" % \
+                    (AppInfo.REQUIRED_CACHE_FILES, AppInfo.REQUIRED_CACHE_URLS))
+        if bandwidth is not None and (isinstance(bandwidth, bool) or \
+                not isinstance(bandwidth, (int, long, float)) or \
+                not bandwidth >= 0):
+            restful.abort(400, message="%s must be a non-negative number" % \
+                    ResourceConst.WARMUP_BANDWIDTH)
+        try:
+            # 0 for no limit
+            job = self.warmup.submit(filepattern_list, url_list,
+                    bandwidth or None)
+        except warmup.WarmupError as e:
+            restful.abort(429, message=str(e))
+        response = jsonify(job.to_dict())
+        response.status_code = 202
+        return response
+
 
 if __name__ == "__main__":
     try:
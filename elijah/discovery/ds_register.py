@@ -159,6 +159,16 @@ class RegisterThread(threading.Thread):
     def update_status(register_server, resource_uri, feature_flag_list, resource_stats):
         resource_meta = {}
         resource_meta.update(resource_stats)
+
+        # lightweight heartbeat that only refreshes time and resource info
+        end_point = urlparse("%s%s%s" % \
+                (register_server, resource_uri, Const.HEARTBEAT_URL))
+        status = http_post_status(end_point, json_string={'meta': resource_meta})
+        if status == httplib.OK or status == httplib.NO_CONTENT:
+            return dict()
+
+        # fall back to full update for a server without heartbeat support
+        # or when the server does not have this cloudlet as running
         end_point = urlparse("%s%s" % (register_server, resource_uri))
         json_string = {
                 "status":"RUN",
@@ -209,6 +219,18 @@ def http_post(end_point, json_string=None):
         return json.loads(data)
 
 
+def http_post_status(end_point, json_string=None):
+    params = json.dumps(json_string)
+    headers = {"Content-type":"application/json" }
+
+    conn = httplib.HTTPConnection(end_point[1], timeout=1)
+    conn.request("POST", "%s" % end_point[2], params, headers)
+    response = conn.getresponse()
+    response.read()
+    conn.close()
+    return response.status
+
+
 def http_put(end_point, json_string=None):
     #sys.stdout.write("Connecting to %s\n" % (''.join(end_point)))
     params = json.dumps(json_string)
@@ -13,6 +13,24 @@ RTT_BETWEEN_CLIENT  = "dynamic_RTT"
 
 # cache status
 APP_CACHE_FILES                 =   "app_cache_files"
+APP_CACHE_FILE_COUNT            =   "app_cache_file_count"
 APP_CACHE_URLS                  =   "app_cache_urls"
+APP_CACHE_ESTIMATED_URLS        =   "app_cache_estimated_urls"
 APP_CACHE_TOTAL_SCORE           =   "app_cache_total_score"
+APP_CACHE_NEXT_CURSOR           =   "next_cursor"
 
+
+# cache pinning and warmup
+CACHE_PINNED_FILES              =   "pinned_files"
+WARMUP_BANDWIDTH                =   "bandwidth"
+WARMUP_JOBS                     =   "jobs"
+WARMUP_JOB_ID                   =   "job_id"
+WARMUP_STATE                    =   "state"
+WARMUP_PROGRESS                 =   "progress"
+WARMUP_TOTAL_ITEMS              =   "total_items"
+WARMUP_DONE_ITEMS               =   "done_items"
+WARMUP_FAILED_ITEMS             =   "failed_items"
+WARMUP_TOTAL_BYTES              =   "total_bytes"
+WARMUP_DONE_BYTES               =   "done_bytes"
+WARMUP_CREATED_TIME             =   "created_time"
+WARMUP_FINISHED_TIME            =   "finished_time"
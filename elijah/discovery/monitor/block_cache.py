@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+#
+# Cloudlet Infrastructure for Mobile Computing
+#
+#   Copyright (C) 2011-2013 Carnegie Mellon University
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+
+import os
+import mmap
+import struct
+import threading
+from collections import OrderedDict
+
+from fusecache import pread
+from fusecache import pwrite
+
+
+class BlockCache(object):
+    '''
+    Local copy of files in fixed size chunks, up to @capacity bytes.
+
+    Chunks are stored in slots of a data file under @cache_dir, and an
+    mmapped index maps each slot to (inode, mtime, chunk number, length).
+    A chunk is looked up by (inode, mtime, chunk number), so the chunks of
+    a file that has been modified are not used. The least recently used
+    chunk is evicted when all slots are taken, except chunks of pinned
+    inodes. A chunk is not cached if all slots hold pinned chunks.
+
+    Chunk data is copied outside the lock. A slot being read is marked
+    busy, so that it is neither evicted nor reused until the copy is done,
+    and a slot being filled is published only when the copy is done and
+    its inode has not been invalidated meanwhile.
+
+    The index is marked clean only when the cache is closed, and a cache
+    that was not closed cleanly is emptied when opened again.
+    '''
+    CHUNK_SIZE = 1024*1024
+    MAGIC = "CLBCACHE"
+    HEADER = struct.Struct("<8sQQQ")    # magic, chunk size, slots, clean
+    SLOT = struct.Struct("<QdQI")       # inode, mtime, chunk, length
+
+    def __init__(self, cache_dir, capacity, chunk_size=CHUNK_SIZE):
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self.chunk_size = chunk_size
+        self.slot_count = max(1, capacity / chunk_size)
+        self.lock = threading.Lock()
+        self.slots = OrderedDict()      # slot:(inode, mtime, chunk, length)
+        self.chunks = dict()            # (inode, chunk):slot
+        self.inode_mtimes = dict()      # inode:mtime of its cached chunks
+        self.inode_chunks = dict()      # inode:set(chunk)
+        self.free_slots = list()
+        self.pinned = dict()            # inode:pin count
+        self.busy = dict()              # slot:number of reads in progress
+        self.released = set()           # dropped slots still being read
+        self.filling = dict()           # (inode, chunk):slot being written
+
+        self.data_fd = os.open(os.path.join(cache_dir, "chunks"),
+                os.O_RDWR | os.O_CREAT, 0600)
+        index_size = self.HEADER.size + self.slot_count * self.SLOT.size
+        index_fd = os.open(os.path.join(cache_dir, "index"),
+                os.O_RDWR | os.O_CREAT, 0600)
+        try:
+            is_valid = False
+            if os.fstat(index_fd).st_size == index_size:
+                header = self.HEADER.unpack(pread(index_fd, self.HEADER.size, 0))
+                is_valid = (header == (self.MAGIC, chunk_size,
+                    self.slot_count, 1))
+            if not is_valid:
+                os.ftruncate(index_fd, 0)
+                os.ftruncate(index_fd, index_size)
+                os.ftruncate(self.data_fd, 0)
+            self.index = mmap.mmap(index_fd, index_size)
+        finally:
+            os.close(index_fd)
+        self._load()
+        self._set_clean(0)
+
+    @classmethod
+    def read_chunks(cls, cache_dir, capacity, chunk_size=CHUNK_SIZE):
+        '''
+        return dict of inode:[(mtime, start, end)] of the chunks of a cache
+        at @cache_dir that was closed cleanly, or None if it will be emptied
+        when opened. The cache must not be open.
+        '''
+        slot_count = max(1, capacity / chunk_size)
+        try:
+            with open(os.path.join(cache_dir, "index"), "rb") as index_file:
+                index = index_file.read()
+        except IOError:
+            return None
+        if len(index) != cls.HEADER.size + slot_count * cls.SLOT.size or \
+                cls.HEADER.unpack_from(index, 0) != \
+                (cls.MAGIC, chunk_size, slot_count, 1):
+            return None
+        chunks = dict()
+        for slot in xrange(slot_count):
+            (inode, mtime, chunk, length) = cls.SLOT.unpack_from(index,
+                    cls.HEADER.size + slot*cls.SLOT.size)
+            if inode != 0:
+                chunks.setdefault(inode, list()).append((mtime,
+                    chunk*chunk_size, chunk*chunk_size + length))
+        return chunks
+
+    def _set_clean(self, clean):
+        self.HEADER.pack_into(self.index, 0, self.MAGIC, self.chunk_size,
+                self.slot_count, clean)
+        self.index.flush()
+
+    def _load(self):
+        for slot in xrange(self.slot_count-1, -1, -1):
+            entry = self.SLOT.unpack_from(self.index,
+                    self.HEADER.size + slot*self.SLOT.size)
+            if entry[0] == 0:
+                self.free_slots.append(slot)
+                continue
+            (inode, mtime, chunk, length) = entry
+            if self.inode_mtimes.setdefault(inode, mtime) != mtime:
+                self._write_slot(slot, 0, 0, 0, 0)
+                self.free_slots.append(slot)
+                continue
+            self.slots[slot] = entry
+            self.chunks[(inode, chunk)] = slot
+            self.inode_chunks.setdefault(inode, set()).add(chunk)
+
+    def _write_slot(self, slot, inode, mtime, chunk, length):
+        self.SLOT.pack_into(self.index, self.HEADER.size + slot*self.SLOT.size,
+                inode, mtime, chunk, length)
+
+    def _drop(self, slot):
+        (inode, mtime, chunk, length) = self.slots.pop(slot)
+        del self.chunks[(inode, chunk)]
+        inode_chunks = self.inode_chunks[inode]
+        inode_chunks.discard(chunk)
+        if len(inode_chunks) == 0:
+            del self.inode_chunks[inode]
+            del self.inode_mtimes[inode]
+        self._write_slot(slot, 0, 0, 0, 0)
+        if slot in self.busy:
+            # freed by the last reader
+            self.released.add(slot)
+        else:
+            self.free_slots.append(slot)
+        return (inode, chunk, length)
+
+    def validate(self, inode, mtime):
+        '''
+        drop the chunks of @inode cached with another mtime, and return
+        list of dropped (inode, chunk, length)
+        '''
+        if self.inode_mtimes.get(inode, mtime) == mtime:
+            return list()
+        return self.invalidate(inode)
+
+    def invalidate(self, inode):
+        '''
+        drop all chunks of @inode, and return list of dropped
+        (inode, chunk, length)
+        '''
+        with self.lock:
+            # chunks being written may hold old data
+            for key in [key for key in self.filling if key[0] == inode]:
+                del self.filling[key]
+            return [self._drop(self.chunks[(inode, chunk)]) for chunk
+                    in list(self.inode_chunks.get(inode, ()))]
+
+    def modified(self, inode, mtime, first, last=None):
+        '''
+        drop the chunks of @inode from @first to @last (to the end if
+        None) after a change through the cache, and keep its other chunks
+        for @mtime, the modification time after the change. A partial
+        chunk is dropped as well, since the end of file may have moved.
+        Return list of dropped (inode, chunk, length)
+        '''
+        dropped = list()
+        with self.lock:
+            for key in [key for key in self.filling if key[0] == inode]:
+                del self.filling[key]
+            for chunk in list(self.inode_chunks.get(inode, ())):
+                slot = self.chunks[(inode, chunk)]
+                length = self.slots[slot][3]
+                if (chunk >= first and (last is None or chunk <= last)) \
+                        or length < self.chunk_size:
+                    dropped.append(self._drop(slot))
+                else:
+                    entry = (inode, mtime, chunk, length)
+                    self._write_slot(slot, *entry)
+                    self.slots[slot] = entry
+            if inode in self.inode_mtimes:
+                self.inode_mtimes[inode] = mtime
+        return dropped
+
+    def pin(self, inode):
+        with self.lock:
+            self.pinned[inode] = self.pinned.get(inode, 0) + 1
+
+    def unpin(self, inode):
+        with self.lock:
+            count = self.pinned.pop(inode, 0) - 1
+            if count > 0:
+                self.pinned[inode] = count
+
+    def _victim(self):
+        skipped = list()
+        victim = None
+        for (slot, entry) in self.slots.iteritems():
+            if entry[0] not in self.pinned and slot not in self.busy:
+                victim = slot
+                break
+            skipped.append(slot)
+        # keep pinned and busy chunks out of the way of the next eviction
+        for slot in skipped:
+            self.slots[slot] = self.slots.pop(slot)
+        return victim
+
+    def get(self, inode, mtime, chunk, start=0, length=None):
+        '''
+        return @length bytes from @start of the cached chunk, or None if
+        the chunk is not cached
+        '''
+        with self.lock:
+            slot = self.chunks.get((inode, chunk), None)
+            if slot is None:
+                return None
+            entry = self.slots.pop(slot)
+            self.slots[slot] = entry
+            if entry[1] != mtime:
+                return None
+            size = entry[3] - start
+            if length is not None:
+                size = min(size, length)
+            if size <= 0:
+                return ""
+            self.busy[slot] = self.busy.get(slot, 0) + 1
+        try:
+            return pread(self.data_fd, size, slot*self.chunk_size + start)
+        finally:
+            with self.lock:
+                count = self.busy.pop(slot) - 1
+                if count > 0:
+                    self.busy[slot] = count
+                elif slot in self.released:
+                    self.released.discard(slot)
+                    self.free_slots.append(slot)
+
+    def put(self, inode, mtime, chunk, data):
+        '''
+        cache @data of the chunk, and return list of evicted
+        (inode, chunk, length)
+        '''
+        evicted = list()
+        key = (inode, chunk)
+        with self.lock:
+            if self.inode_mtimes.get(inode, mtime) != mtime:
+                return evicted
+            if key in self.chunks or key in self.filling:
+                return evicted
+            if len(self.free_slots) == 0:
+                victim = self._victim()
+                if victim is None:
+                    return evicted
+                evicted.append(self._drop(victim))
+            slot = self.free_slots.pop()
+            self.filling[key] = slot
+        try:
+            pwrite(self.data_fd, data, slot*self.chunk_size)
+            is_written = True
+        except OSError:
+            # e.g. the local disk is full; the read is still served
+            is_written = False
+        with self.lock:
+            if self.filling.get(key, None) != slot:
+                # invalidated while being written
+                is_written = False
+            else:
+                del self.filling[key]
+            if not is_written or \
+                    self.inode_mtimes.get(inode, mtime) != mtime:
+                self.free_slots.append(slot)
+                return evicted
+            entry = (inode, mtime, chunk, len(data))
+            self._write_slot(slot, *entry)
+            self.slots[slot] = entry
+            self.chunks[(inode, chunk)] = slot
+            self.inode_mtimes[inode] = mtime
+            self.inode_chunks.setdefault(inode, set()).add(chunk)
+        return evicted
+
+    def close(self):
+        with self.lock:
+            os.fsync(self.data_fd)
+            self._set_clean(1)
+            self.index.close()
+            os.close(self.data_fd)
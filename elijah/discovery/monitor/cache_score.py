@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+#
+# Cloudlet Infrastructure for Mobile Computing
+#
+#   Copyright (C) 2011-2013 Carnegie Mellon University
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+
+import heapq
+import threading
+from collections import OrderedDict
+
+
+class AppCacheScore(object):
+    '''
+    Cached bytes of the files matching one set of file patterns
+    '''
+    def __init__(self, patterns, generation):
+        self.patterns = patterns
+        self.generation = generation
+        self.files = dict()         # relpath:(size, inode)
+        self.inode_paths = dict()   # inode:[relpath]
+        self.cached_bytes = dict()  # relpath:cached bytes
+        self.total_filesize = 0
+        self.total_cachesize = 0
+
+    def add_file(self, relpath, size, inode, cached_bytes):
+        if relpath in self.files:
+            return
+        self.files[relpath] = (size, inode)
+        self.inode_paths.setdefault(inode, list()).append(relpath)
+        self.total_filesize += size
+        self.set_cached(relpath, cached_bytes)
+
+    def set_cached(self, relpath, cached_bytes):
+        old_bytes = self.cached_bytes.pop(relpath, 0)
+        if cached_bytes > 0:
+            self.cached_bytes[relpath] = cached_bytes
+        self.total_cachesize += cached_bytes - old_bytes
+
+    def update(self, inode, resident_bytes):
+        '''
+        refresh cached bytes of @inode with @resident_bytes(inode, size)
+        '''
+        for relpath in self.inode_paths.get(inode, ()):
+            size = self.files[relpath][0]
+            self.set_cached(relpath, resident_bytes(inode, size))
+
+    def cached_files(self, max_files=None):
+        '''
+        return sorted list of the cached files, or of the @max_files files
+        with the most cached bytes
+        '''
+        if max_files is None or len(self.cached_bytes) <= max_files:
+            return sorted(self.cached_bytes.iterkeys())
+        top_files = heapq.nlargest(max_files, self.cached_bytes.iteritems(),
+                key=lambda item: item[1])
+        return sorted(relpath for (relpath, cached_bytes) in top_files)
+
+
+class CacheScoreTable(object):
+    '''
+    Per-application cache scores keyed by the normalized set of required
+    file patterns.
+
+    A score is the number of bytes of the matching files that are
+    cached, out of their total size. It is computed from the file index
+    once, and then updated as the cache monitor reports changes in the
+    cached byte ranges of an inode, so repeated queries of the same
+    application are answered without matching files again. A score is
+    recomputed when the index changes.
+    '''
+    MAX_ENTRIES = 128
+
+    def __init__(self, cache_monitor, max_entries=MAX_ENTRIES):
+        self.cache_monitor = cache_monitor
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()    # patterns:AppCacheScore
+        self.inode_entries = dict()     # inode:set(patterns)
+        cache_monitor.add_listener(self.on_cached)
+
+    @staticmethod
+    def normalize(filepattern_list):
+        return tuple(sorted(set(pattern.strip() for pattern
+            in filepattern_list if len(pattern.strip()) > 0)))
+
+    def get(self, filepattern_list, max_files=None):
+        '''
+        return (cached bytes, total bytes, sorted list of cached files,
+        number of cached files) of the matching files. Only the @max_files
+        files with the most cached bytes are listed.
+        '''
+        patterns = CacheScoreTable.normalize(filepattern_list)
+        generation = self.cache_monitor.file_index.generation
+        with self.lock:
+            entry = self.entries.pop(patterns, None)
+            if entry is None or entry.generation != generation:
+                if entry is not None:
+                    self._unlink(entry)
+                entry = self._compute(patterns, generation)
+            self.entries[patterns] = entry
+            if len(self.entries) > self.max_entries:
+                (old_patterns, old_entry) = self.entries.popitem(last=False)
+                self._unlink(old_entry)
+            return entry.total_cachesize, entry.total_filesize, \
+                    entry.cached_files(max_files), len(entry.cached_bytes)
+
+    def _compute(self, patterns, generation):
+        entry = AppCacheScore(patterns, generation)
+        for pattern in patterns:
+            for (relpath, size, inode) in \
+                    self.cache_monitor.match_files(pattern):
+                entry.add_file(relpath, size, inode,
+                        self.cache_monitor.resident_bytes(inode, size))
+        for inode in entry.inode_paths.iterkeys():
+            self.inode_entries.setdefault(inode, set()).add(patterns)
+        return entry
+
+    def _unlink(self, entry):
+        for inode in entry.inode_paths.iterkeys():
+            patterns_set = self.inode_entries.get(inode, None)
+            if patterns_set is None:
+                continue
+            patterns_set.discard(entry.patterns)
+            if len(patterns_set) == 0:
+                del self.inode_entries[inode]
+
+    def on_cached(self, inode):
+        with self.lock:
+            for patterns in self.inode_entries.get(inode, ()):
+                self.entries[patterns].update(inode,
+                        self.cache_monitor.resident_bytes)
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+#
+# Cloudlet Infrastructure for Mobile Computing
+#
+#   Copyright (C) 2011-2013 Carnegie Mellon University
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+
+import os
+import zlib
+import struct
+
+from ..log import logging
+
+
+LOG = logging.getLogger(__name__)
+
+
+class CacheStateLog(object):
+    '''
+    Append-only log of the cache residency of files.
+
+    Each record is the state of one inode: its path, mtime and size when
+    the state was written, and the cached byte ranges. A record without
+    ranges removes the inode. Records are framed by their length and
+    CRC32, so a record torn by a crash is detected and loading stops
+    there. The latest record of an inode wins.
+
+    compact() rewrites the log with the live records only, through a
+    temporary file that is fsync'ed and renamed over the log.
+    '''
+    FRAME = struct.Struct("<II")            # payload length, crc32
+    ENTRY = struct.Struct("<QdQHI")         # inode, mtime, size, path length,
+                                            # number of ranges
+    RANGE = struct.Struct("<QQ")            # start, end
+
+    def __init__(self, path):
+        self.path = path
+        self.log_file = None
+        self.log_size = 0
+
+    @staticmethod
+    def pack_entry(inode, path, mtime, size, ranges):
+        ranges = list(ranges)
+        payload = [CacheStateLog.ENTRY.pack(inode, mtime, size, len(path),
+            len(ranges)), path]
+        for (start, end) in ranges:
+            payload.append(CacheStateLog.RANGE.pack(start, end))
+        payload = "".join(payload)
+        return CacheStateLog.FRAME.pack(len(payload),
+                zlib.crc32(payload) & 0xffffffff) + payload
+
+    @staticmethod
+    def unpack_entry(payload):
+        (inode, mtime, size, path_len, range_count) = \
+                CacheStateLog.ENTRY.unpack_from(payload, 0)
+        position = CacheStateLog.ENTRY.size
+        path = payload[position:position+path_len]
+        position += path_len
+        ranges = list()
+        for index in xrange(range_count):
+            ranges.append(CacheStateLog.RANGE.unpack_from(payload, position))
+            position += CacheStateLog.RANGE.size
+        return inode, path, mtime, size, ranges
+
+    def load(self):
+        '''
+        return dict of inode:(path, mtime, size, ranges)
+        '''
+        entries = dict()
+        if not os.path.exists(self.path):
+            return entries
+        with open(self.path, "rb") as log_file:
+            data = log_file.read()
+        position = 0
+        frame_size = CacheStateLog.FRAME.size
+        while position + frame_size <= len(data):
+            (length, crc) = CacheStateLog.FRAME.unpack_from(data, position)
+            payload = data[position+frame_size:position+frame_size+length]
+            if len(payload) != length or \
+                    (zlib.crc32(payload) & 0xffffffff) != crc:
+                LOG.warning("[CACHE] ignore broken cache state after %d bytes" % \
+                        position)
+                break
+            position += frame_size + length
+            (inode, path, mtime, size, ranges) = \
+                    CacheStateLog.unpack_entry(payload)
+            if len(ranges) == 0:
+                entries.pop(inode, None)
+            else:
+                entries[inode] = (path, mtime, size, ranges)
+        return entries
+
+    def _open(self):
+        if self.log_file is None:
+            dirname = os.path.dirname(self.path)
+            if len(dirname) > 0 and not os.path.exists(dirname):
+                os.makedirs(dirname)
+            self.log_file = open(self.path, "ab")
+            self.log_size = self.log_file.tell()
+        return self.log_file
+
+    def append(self, entry_list):
+        '''
+        append (inode, path, mtime, size, ranges) of changed inodes
+        '''
+        data = "".join([CacheStateLog.pack_entry(*entry) for entry in entry_list])
+        if len(data) == 0:
+            return
+        log_file = self._open()
+        log_file.write(data)
+        log_file.flush()
+        os.fsync(log_file.fileno())
+        self.log_size += len(data)
+
+    def compact(self, entry_list):
+        '''
+        replace the log with (inode, path, mtime, size, ranges) of all
+        live inodes
+        '''
+        dirname = os.path.dirname(self.path) or "."
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        tmp_path = self.path + ".tmp"
+        size = 0
+        with open(tmp_path, "wb") as tmp_file:
+            for entry in entry_list:
+                data = CacheStateLog.pack_entry(*entry)
+                tmp_file.write(data)
+                size += len(data)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        self.close()
+        os.rename(tmp_path, self.path)
+        dir_fd = os.open(dirname, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+        self.log_size = size
+
+    def close(self):
+        if self.log_file is not None:
+            self.log_file.close()
+            self.log_file = None
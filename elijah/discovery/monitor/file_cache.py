@@ -19,17 +19,29 @@
 #
 
 import os
+import bisect
+import signal
 import threading
-from multiprocessing import Queue
+import subprocess
 import multiprocessing
+from collections import OrderedDict
 import time
 import sys
 
 from fuse import FUSE, FuseOSError, Operations
 from optparse import OptionParser
-from Queue import Empty
 from fusecache import LoopBack
 from fusecache import AccessInfo
+from fusecache import unpack_records
+from file_index import FileIndex
+from interval_set import IntervalSet
+from cache_score import CacheScoreTable
+from cache_state import CacheStateLog
+from block_cache import BlockCache
+from prefetch import AppAccessLog
+from prefetch import BlockPrefetcher
+from prefetch import SequentialReadAhead
+from warmup import WarmupManager
 
 from ..config import DiscoveryConst as DiscoveryConst
 from ..log import logging
@@ -49,13 +61,22 @@ def get_instance():
     if _cache_monitor_instance is None:
         LOG.info("[CACHE] FUSE mount at %s, which is loop back of %s" % \
                 (DiscoveryConst.CLOUDLET_FS_ROOT, DiscoveryConst.DFS_ROOT))
-        access_queue = Queue()
+        access_reader, access_writer = multiprocessing.Pipe(duplex=False)
+        control_reader, control_writer = multiprocessing.Pipe(duplex=False)
         _fuse_instance = FuseLauncher(DiscoveryConst.CLOUDLET_FS_ROOT,\
-                DiscoveryConst.DFS_ROOT, access_queue)
-        _fuse_instance.start()
+                DiscoveryConst.DFS_ROOT, access_writer,
+                control_conn=control_reader)
         LOG.info("[CACHE] start Cache monitoring")
-        _cache_monitor_instance = _CacheMonitor(access_queue,\
-                DiscoveryConst.DFS_ROOT, print_out=False)
+        # the cache state is restored before the loopback opens the block
+        # cache, which marks it as in use
+        _cache_monitor_instance = _CacheMonitor(access_reader,\
+                DiscoveryConst.DFS_ROOT, print_out=False,
+                state_path=DiscoveryConst.CACHE_STATE_FILE,
+                mount_root=DiscoveryConst.CLOUDLET_FS_ROOT,
+                prefetch=DiscoveryConst.PREFETCH_ENABLED,
+                control_conn=control_writer,
+                block_cache_dir=DiscoveryConst.BLOCK_CACHE_DIR)
+        _fuse_instance.start()
         _cache_monitor_instance.start()
     return _cache_monitor_instance
 
@@ -64,63 +85,574 @@ def terminate():
     global _cache_monitor_instance
     global _fuse_instance
     
-    if _cache_monitor_instance is not None:
-        _cache_monitor_instance.terminate()
-        _cache_monitor_instance = None
+    # the loopback first, so that the monitor sees its last records
     if _fuse_instance is not None:
         _fuse_instance.terminate()
         _fuse_instance = None
+    if _cache_monitor_instance is not None:
+        _cache_monitor_instance.terminate()
+        if _cache_monitor_instance.is_alive():
+            # saves the cache state on exit
+            _cache_monitor_instance.join(_CacheMonitor.TERMINATE_TIMEOUT)
+        _cache_monitor_instance = None
 
 
 class CacheMonitorError(Exception):
     pass
 
 
+class PathInodeCache(object):
+    '''
+    Bounded LRU map of absolute path to inode. Entries expire after
+    @timeout seconds to pick up changes made outside the loopback.
+    '''
+    MAX_SIZE = 4096
+    TIMEOUT = 60
+
+    def __init__(self, max_size=MAX_SIZE, timeout=TIMEOUT):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()    # path:(inode, time)
+
+    def get(self, path):
+        with self.lock:
+            entry = self.entries.pop(path, None)
+            if entry is None:
+                return None
+            if time.time() - entry[1] > self.timeout:
+                return None
+            self.entries[path] = entry
+            return entry[0]
+
+    def put(self, path, inode):
+        with self.lock:
+            self.entries.pop(path, None)
+            self.entries[path] = (inode, time.time())
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, path):
+        '''
+        drop @path and, for a directory, the paths under it
+        '''
+        prefix = path.rstrip("/") + "/"
+        with self.lock:
+            self.entries.pop(path, None)
+            for cached_path in [cached_path for cached_path in self.entries
+                    if cached_path.startswith(prefix)]:
+                del self.entries[cached_path]
+
+
+class SortedPathSet(object):
+    '''
+    Sorted set of relative paths that is updated in place, so that pages
+    of paths under a prefix are read without sorting. A path added more
+    than once is kept until it is removed as many times.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.paths = list()
+        self.counts = dict()    # path:count
+
+    def __len__(self):
+        return len(self.paths)
+
+    def add(self, path):
+        with self.lock:
+            count = self.counts.get(path, 0)
+            if count == 0:
+                bisect.insort(self.paths, path)
+            self.counts[path] = count + 1
+
+    def remove(self, path):
+        with self.lock:
+            count = self.counts.pop(path, 0) - 1
+            if count > 0:
+                self.counts[path] = count
+            elif count == 0:
+                del self.paths[bisect.bisect_left(self.paths, path)]
+
+    def page(self, prefix="", cursor=None, limit=None):
+        '''
+        return up to @limit paths starting with @prefix that sort after
+        @cursor
+        '''
+        with self.lock:
+            start = bisect.bisect_left(self.paths, prefix)
+            if cursor is not None:
+                start = max(start, bisect.bisect_right(self.paths, cursor))
+            # "\xff" sorts after any character in a path
+            end = bisect.bisect_left(self.paths, prefix + "\xff", start)
+            if limit is not None:
+                end = min(end, start + limit)
+            return self.paths[start:end]
+
+
 class _CacheMonitor(threading.Thread):
-    def __init__(self, access_queue, dfs_root, print_out=False):
-        self.access_queue = access_queue
+    # wake up at least this often (seconds) to check for termination
+    WAIT_TIMEOUT = 1.0
+    # seconds to wait for the monitor to save the cache state on exit
+    TERMINATE_TIMEOUT = 10
+    # batches processed before checking for termination
+    MAX_BATCHES = 64
+    # seconds between saving the cached byte ranges that have changed
+    SNAPSHOT_PERIOD = 30
+    # rewrite the state log once it has this many records per live inode
+    COMPACT_RATIO = 4
+
+    def __init__(self, access_conn, dfs_root, print_out=False,
+            state_path=None, mount_root=None, prefetch=False,
+            control_conn=None, block_cache_dir=None):
+        self.access_conn = access_conn
         self.dfs_root = dfs_root
         self.print_out = print_out
         self.stop = threading.Event()
         self.cache_info_dict = dict() # inode:cache_status
+        # relative paths of the files in cache_info_dict
+        self.cached_paths = SortedPathSet()
+        self.cached_relpaths = dict()   # inode:relpath
+        self.cached_inodes = dict()     # relpath:set(inode)
+        # inode:IntervalSet of byte ranges that have been read or written
+        self.residency = dict()
+        self.residency_lock = threading.Lock()
+        self.open_paths = dict()    # inode:[path, open count]
+        self.written_paths = set()
+        self.path_inodes = PathInodeCache()
+        self.listeners = list()
+        # built on its own thread, so that startup does not walk the DFS
+        self.file_index = FileIndex(dfs_root)
+        self.file_index.start()
+        self.dirty_inodes = set()
+        self.snapshot_time = time.time()
+        self.state_records = 0
+        self.cache_state = None
+        # the loopback keeps the cached bytes in the block cache at
+        # @block_cache_dir
+        self.block_cache_dir = block_cache_dir
+        if state_path is not None:
+            self.cache_state = CacheStateLog(state_path)
+            self._restore_state()
+        self.app_scores = CacheScoreTable(self)
+        # files are replayed through the loopback at @mount_root, so that
+        # the reads are seen as cached
+        self.mount_root = mount_root
+        self.app_accesses = None
+        self.app_prefetcher = None
+        if prefetch is True and mount_root is not None:
+            self.app_accesses = AppAccessLog()
+            self.app_prefetcher = BlockPrefetcher(DiscoveryConst.PREFETCH_WORKERS)
+        # requests to the loopback
+        self.control_conn = control_conn
+        self.control_lock = threading.Lock()
+        self.pinned = dict()    # file pattern:[inode]
+        self.warmup = None
+        if mount_root is not None:
+            self.warmup = WarmupManager(self, mount_root,
+                    bandwidth=DiscoveryConst.WARMUP_BANDWIDTH,
+                    workers=DiscoveryConst.WARMUP_WORKERS,
+                    http_proxy=DiscoveryConst.WARMUP_HTTP_PROXY,
+                    http_timeout=DiscoveryConst.WARMUP_HTTP_TIMEOUT)
         threading.Thread.__init__(self, target=self.process)
 
+    def add_listener(self, callback):
+        '''
+        @callback(inode) is called when the cached byte ranges of an inode
+        change
+        '''
+        self.listeners.append(callback)
+
     def process(self):
-        while (self.stop.wait(0.01) is False):
+        while not self.stop.is_set():
+            if time.time() - self.snapshot_time > self.SNAPSHOT_PERIOD:
+                self._save_state()
             try:
-                access = self.access_queue.get_nowait()
-                if access.cmd == AccessInfo.CMD_READ or \
-                        access.cmd == AccessInfo.CMD_WRITE:
-                    self.cache_info_dict[access.inode] = access
-                if self.print_out is True:
-                    print access
-            except Empty:
+                # block until records arrive, then drain what is available
+                if not self.access_conn.poll(self.WAIT_TIMEOUT):
+                    continue
+                for batch_count in xrange(self.MAX_BATCHES):
+                    data = self.access_conn.recv_bytes()
+                    for record in unpack_records(data):
+                        self._process_record(*record)
+                    if not self.access_conn.poll():
+                        break
+            except (EOFError, IOError) as e:
+                LOG.info("[CACHE] access pipe is closed")
+                break
+        self.file_index.terminate()
+        self._save_state()
+        if self.cache_state is not None:
+            self.cache_state.close()
+        if self.app_prefetcher is not None:
+            self.app_prefetcher.terminate()
+        if self.warmup is not None:
+            self.warmup.terminate()
+
+    def _process_record(self, cmd, inode, offset, length, path):
+        if cmd == AccessInfo.CMD_READ or cmd == AccessInfo.CMD_WRITE:
+            # read and write records carry only the inode
+            path = self.open_paths.get(inode, (None,))[0]
+            with self.residency_lock:
+                residency = self.residency.get(inode, None)
+                if residency is None:
+                    residency = self.residency[inode] = IntervalSet()
+                    self.cache_info_dict[inode] = AccessInfo(cmd, path,
+                            offset, length, inode=inode)
+                    self._set_cached_path(inode, path)
+                added = residency.add(offset, offset + length)
+            if added > 0:
+                self.dirty_inodes.add(inode)
+                for callback in self.listeners:
+                    callback(inode)
+        elif cmd == AccessInfo.CMD_OPEN or cmd == AccessInfo.CMD_CREATE:
+            if inode != 0:
+                open_path = self.open_paths.setdefault(inode, [path, 0])
+                open_path[0] = path
+                open_path[1] += 1
+                access = self.cache_info_dict.get(inode, None)
+                if access is not None:
+                    access.full_path = path
+                    self._set_cached_path(inode, path)
+            if cmd == AccessInfo.CMD_OPEN and self.app_accesses is not None:
+                self.app_accesses.on_open(path)
+        elif cmd == AccessInfo.CMD_TRUNCATE or cmd == AccessInfo.CMD_EVICT:
+            with self.residency_lock:
+                residency = self.residency.get(inode, None)
+                removed = 0
+                if residency is not None and len(residency) > 0:
+                    if cmd == AccessInfo.CMD_TRUNCATE:
+                        removed = residency.remove(length, residency.ends[-1])
+                    else:
+                        removed = residency.remove(offset, offset + length)
+            if residency is not None and len(residency) == 0:
+                # nothing of the file is cached any more
+                self._forget(inode)
+            if removed > 0:
+                self.dirty_inodes.add(inode)
+                for callback in self.listeners:
+                    callback(inode)
+        elif cmd == AccessInfo.CMD_UNLINK:
+            self._drop_path(path)
+        elif cmd == AccessInfo.CMD_RENAME:
+            old_path, new_path = path.split("\0", 1)
+            self._move_path(old_path, new_path)
+        elif cmd == AccessInfo.CMD_CLOSE:
+            open_path = self.open_paths.get(inode, None)
+            if open_path is not None:
+                open_path[1] -= 1
+                if open_path[1] <= 0:
+                    del self.open_paths[inode]
+        self._update_index(cmd, path, offset, length)
+        if self.print_out is True:
+            print "%s(%ld)\t%s" % (path, inode, cmd)
+
+    def _update_index(self, cmd, path, offset, length):
+        if path is None:
+            return
+        if cmd == AccessInfo.CMD_WRITE:
+            self.written_paths.add(path)
+            self.file_index.update_size(path, offset + length)
+        elif cmd == AccessInfo.CMD_CLOSE:
+            # exact size after writes
+            if path in self.written_paths:
+                self.written_paths.discard(path)
+                self.file_index.sync(path)
+        elif cmd == AccessInfo.CMD_RENAME:
+            old_path, new_path = path.split("\0", 1)
+            self.path_inodes.invalidate(old_path)
+            self.path_inodes.invalidate(new_path)
+            self.file_index.sync(old_path)
+            self.file_index.sync(new_path)
+        elif cmd == AccessInfo.CMD_CREATE or \
+                cmd == AccessInfo.CMD_UNLINK:
+            self.path_inodes.invalidate(path)
+            self.file_index.sync(path)
+        elif cmd == AccessInfo.CMD_TRUNCATE:
+            self.file_index.sync(path)
+
+    def _restore_state(self):
+        '''
+        load the cached byte ranges saved by the previous run. Files changed
+        since then, e.g. by others through the DFS, are dropped. With a
+        block cache that was closed cleanly, the ranges are the chunks left
+        in it. Otherwise, e.g. after a crash, they are the ranges replayed
+        from the state log.
+        '''
+        try:
+            entries = self.cache_state.load()
+        except (IOError, OSError) as e:
+            LOG.warning("[CACHE] failed to load cache state: %s" % str(e))
+            return
+        block_chunks = None
+        if self.block_cache_dir is not None:
+            block_chunks = BlockCache.read_chunks(self.block_cache_dir,
+                    DiscoveryConst.BLOCK_CACHE_CAPACITY,
+                    DiscoveryConst.BLOCK_CACHE_CHUNK_SIZE)
+            if block_chunks is None:
+                LOG.info("[CACHE] block cache was not closed cleanly; " \
+                        "restore the cache state log")
+        live_entries = list()
+        for (inode, (path, mtime, size, ranges)) in entries.iteritems():
+            try:
+                st = os.stat(path)
+            except OSError:
                 continue
-
-    def cached_files(self):
-        file_list = list()
-        for (inode, access) in self.cache_info_dict.iteritems():
-            relpath = os.path.relpath(access.full_path, self.dfs_root)
-            file_list.append(relpath)
-
-        file_list.sort()
-        return file_list
+            if st.st_ino != inode or st.st_mtime != mtime or \
+                    st.st_size != size:
+                continue
+            if block_chunks is not None:
+                ranges = [(start, end) for (chunk_mtime, start, end)
+                        in block_chunks.get(inode, ()) if chunk_mtime == mtime]
+                if len(ranges) == 0:
+                    continue
+            self.residency[inode] = IntervalSet(ranges)
+            self.cache_info_dict[inode] = AccessInfo(AccessInfo.CMD_READ,
+                    path, inode=inode)
+            self._set_cached_path(inode, path)
+            live_entries.append((inode, path, mtime, size,
+                list(self.residency[inode])))
+        LOG.info("[CACHE] restored cache state of %d/%d files" % \
+                (len(live_entries), len(entries)))
+        self._compact_state(live_entries)
+
+    def _state_entry(self, inode):
+        access = self.cache_info_dict.get(inode, None)
+        with self.residency_lock:
+            residency = self.residency.get(inode, None)
+            ranges = list(residency) if residency is not None else list()
+        path = access.full_path if access is not None else None
+        if path is not None and len(ranges) > 0:
+            try:
+                st = os.stat(path)
+                if st.st_ino == inode:
+                    return (inode, path, st.st_mtime, st.st_size, ranges)
+            except OSError:
+                pass
+        # removes the inode from the state
+        return (inode, "", 0, 0, list())
+
+    def _save_state(self):
+        '''
+        append the cached byte ranges of the inodes changed since the last
+        snapshot
+        '''
+        self.snapshot_time = time.time()
+        if self.cache_state is None or len(self.dirty_inodes) == 0:
+            return
+        dirty_inodes, self.dirty_inodes = self.dirty_inodes, set()
+        entry_list = [self._state_entry(inode) for inode in dirty_inodes]
+        try:
+            self.cache_state.append(entry_list)
+        except (IOError, OSError) as e:
+            LOG.warning("[CACHE] failed to save cache state: %s" % str(e))
+            return
+        self.state_records += len(entry_list)
+        if self.state_records > self.COMPACT_RATIO * max(len(self.residency),
+                self.MAX_BATCHES):
+            live_entries = [self._state_entry(inode) for inode
+                    in self.residency.keys()]
+            self._compact_state([entry for entry in live_entries
+                if len(entry[4]) > 0])
+
+    def _compact_state(self, live_entries):
+        try:
+            self.cache_state.compact(live_entries)
+        except (IOError, OSError) as e:
+            LOG.warning("[CACHE] failed to compact cache state: %s" % str(e))
+            return
+        self.state_records = len(live_entries)
+
+    def _set_cached_path(self, inode, path):
+        relpath = None
+        if path is not None:
+            relpath = os.path.relpath(path, self.dfs_root)
+        old_relpath = self.cached_relpaths.pop(inode, None)
+        if old_relpath == relpath:
+            if relpath is not None:
+                self.cached_relpaths[inode] = relpath
+            return
+        if old_relpath is not None:
+            self.cached_paths.remove(old_relpath)
+            inodes = self.cached_inodes[old_relpath]
+            inodes.discard(inode)
+            if len(inodes) == 0:
+                del self.cached_inodes[old_relpath]
+        if relpath is not None:
+            self.cached_relpaths[inode] = relpath
+            self.cached_paths.add(relpath)
+            self.cached_inodes.setdefault(relpath, set()).add(inode)
+
+    def _forget(self, inode):
+        '''
+        drop @inode from the cached files
+        '''
+        with self.residency_lock:
+            self.residency.pop(inode, None)
+        self.cache_info_dict.pop(inode, None)
+        self._set_cached_path(inode, None)
+        self.dirty_inodes.add(inode)
+
+    def _drop_path(self, path):
+        '''
+        forget the inodes cached at @path after it is unlinked or replaced
+        '''
+        relpath = os.path.relpath(path, self.dfs_root)
+        for inode in list(self.cached_inodes.get(relpath, ())):
+            try:
+                if os.lstat(path).st_ino == inode:
+                    continue
+            except OSError:
+                pass
+            self._forget(inode)
+            for callback in self.listeners:
+                callback(inode)
+
+    def _move_path(self, old_path, new_path):
+        '''
+        move the cached files at @old_path, a file or a directory, to
+        @new_path
+        '''
+        self._drop_path(new_path)
+        old_relpath = os.path.relpath(old_path, self.dfs_root)
+        new_relpath = os.path.relpath(new_path, self.dfs_root)
+        relpath_list = self.cached_paths.page(old_relpath + "/")
+        if old_relpath in self.cached_inodes:
+            relpath_list.append(old_relpath)
+        for relpath in relpath_list:
+            moved_path = os.path.join(self.dfs_root,
+                    new_relpath + relpath[len(old_relpath):])
+            for inode in list(self.cached_inodes.get(relpath, ())):
+                access = self.cache_info_dict.get(inode, None)
+                if access is not None:
+                    access.full_path = moved_path
+                self._set_cached_path(inode, moved_path)
+                self.dirty_inodes.add(inode)
+        for open_path in self.open_paths.itervalues():
+            if open_path[0] == old_path or \
+                    open_path[0].startswith(old_path + "/"):
+                open_path[0] = new_path + open_path[0][len(old_path):]
+
+    def cached_files(self, prefix="", cursor=None, limit=None):
+        '''
+        return sorted list of up to @limit cached files starting with @prefix,
+        after @cursor, the last file of the previous page
+        '''
+        return self.cached_paths.page(prefix, cursor, limit)
+
+    def check_inode(self, inode):
+        return inode in self.cache_info_dict
+
+    def resident_bytes(self, inode, size):
+        '''
+        number of bytes of the first @size bytes of @inode that are cached
+        '''
+        with self.residency_lock:
+            residency = self.residency.get(inode, None)
+            if residency is None:
+                return 0
+            return residency.covered_in(0, size)
+
+    def match_files(self, pattern):
+        '''
+        return list of (relpath, size, inode) of files in DFS matching
+        the glob2 @pattern
+        '''
+        return self.file_index.match(pattern)
+
+    def _control(self, cmd, inode_list):
+        if self.control_conn is None or len(inode_list) == 0:
+            return
+        with self.control_lock:
+            try:
+                self.control_conn.send((cmd, inode_list))
+            except (IOError, EOFError, ValueError):
+                LOG.warning("[CACHE] loopback is gone")
+
+    def pin(self, filepattern_list):
+        '''
+        keep the files matching @filepattern_list in the local block cache.
+        Files are matched when pinned. Return dict of pattern:number of
+        files.
+        '''
+        ret = dict()
+        with self.control_lock:
+            pinned = dict()
+            for pattern in CacheScoreTable.normalize(filepattern_list):
+                pinned[pattern] = [inode for (relpath, size, inode)
+                        in self.match_files(pattern)]
+                ret[pattern] = len(pinned[pattern])
+        self.unpin(pinned.keys())
+        with self.control_lock:
+            self.pinned.update(pinned)
+        for inode_list in pinned.itervalues():
+            self._control(LoopBack.CONTROL_PIN, inode_list)
+        return ret
+
+    def unpin(self, filepattern_list):
+        with self.control_lock:
+            unpinned = [self.pinned.pop(pattern) for pattern
+                    in CacheScoreTable.normalize(filepattern_list)
+                    if pattern in self.pinned]
+        for inode_list in unpinned:
+            self._control(LoopBack.CONTROL_UNPIN, inode_list)
+
+    def pinned_files(self):
+        '''
+        return dict of pinned pattern:number of files
+        '''
+        with self.control_lock:
+            return dict((pattern, len(inode_list)) for (pattern, inode_list)
+                    in self.pinned.iteritems())
+
+    def prefetch_app(self, app_id):
+        '''
+        warm the files that @app_id opened after its previous query, and
+        record the files it opens this time. Return the number of files
+        requested.
+        '''
+        if self.app_accesses is None:
+            return 0
+        path_list = self.app_accesses.get(app_id)
+        self.app_accesses.start(app_id)
+        count = 0
+        for path in path_list:
+            relpath = self.file_index.relpath(path)
+            if relpath is None or self.check_file(path, True) >= 1.0:
+                continue
+            if self.app_prefetcher.submit(os.path.join(self.mount_root, relpath)):
+                count += 1
+        return count
 
     def check_file(self, filename, is_abspath=False):
+        '''
+        return the fraction (0.0 - 1.0) of the file that is cached
+        '''
         if is_abspath is True:
             abspath = filename
         else:
             abspath = os.path.join(self.dfs_root, filename)
 
-        if os.path.exists(abspath) is False:
-            return False
-        else:
-            inode = os.stat(abspath).st_ino
-            access_info = self.cache_info_dict.get(inode, None)
-            if access_info is not None:
-                return True
-            else:
-                return False
+        inode = self.path_inodes.get(abspath)
+        size = None
+        if inode is None:
+            try:
+                st = os.stat(abspath)
+            except OSError:
+                return 0.0
+            inode, size = st.st_ino, st.st_size
+            self.path_inodes.put(abspath, inode)
+        if inode not in self.residency:
+            return 0.0
+        if size is None:
+            size = self.file_index.size_of(abspath)
+        if size is None:
+            try:
+                size = os.stat(abspath).st_size
+            except OSError:
+                return 0.0
+        if size == 0:
+            return 1.0
+        return float(self.resident_bytes(inode, size))/size
 
     def terminate(self):
         LOG.info("get signal")
@@ -151,11 +683,22 @@ class CmdInterface(threading.Thread):
 
 
 class FuseLauncher(multiprocessing.Process):
-    def __init__(self, mountpoint, root, access_queue):
+    # seconds to wait for the loopback to exit after unmounting it
+    TERMINATE_TIMEOUT = 10
+
+    def __init__(self, mountpoint, root, access_conn, mount_options=None,
+            prefetch=None, control_conn=None):
         self.stop = threading.Event()
         self.mountpoint = mountpoint
         self.root = root
-        self.access_queue = access_queue
+        self.access_conn = access_conn
+        if mount_options is None:
+            mount_options = DiscoveryConst.FUSE_MOUNT_OPTIONS
+        self.mount_options = dict(mount_options)
+        if prefetch is None:
+            prefetch = DiscoveryConst.PREFETCH_ENABLED
+        self.prefetch = prefetch
+        self.control_conn = control_conn
         if os.path.isdir(self.root) is False or\
                 os.access(self.root, os.R_OK | os.W_OK) is False:
             msg = "Failed to setup cache monitoring at %s\n" % self.root
@@ -176,10 +719,74 @@ class FuseLauncher(multiprocessing.Process):
         multiprocessing.Process.__init__(self)
 
     def run(self):
-        FUSE(LoopBack(self.root, self.access_queue), self.mountpoint, foreground=True)
+        # multithreaded; the data path uses pread/pwrite
+        # cache metadata in the loopback as long as the kernel does
+        cache_timeout = self.mount_options.get("attr_timeout",
+                LoopBack.CACHE_TIMEOUT)
+        block_cache = None
+        if DiscoveryConst.BLOCK_CACHE_DIR is not None:
+            try:
+                block_cache = BlockCache(DiscoveryConst.BLOCK_CACHE_DIR,
+                        DiscoveryConst.BLOCK_CACHE_CAPACITY,
+                        DiscoveryConst.BLOCK_CACHE_CHUNK_SIZE)
+            except EnvironmentError as e:
+                # serve reads from DFS_ROOT only
+                LOG.warning("[CACHE] failed to open block cache at %s: %s" % \
+                        (DiscoveryConst.BLOCK_CACHE_DIR, str(e)))
+        loopback = LoopBack(self.root, self.access_conn, cache_timeout,
+                block_cache=block_cache)
+        if self.prefetch is True:
+            # prefetch through the loopback, which reports the blocks read
+            block_size = self.mount_options.get("max_read",
+                    BlockPrefetcher.BLOCK_SIZE)
+            if block_cache is not None:
+                block_size = block_cache.chunk_size
+            prefetcher = BlockPrefetcher(DiscoveryConst.PREFETCH_WORKERS,
+                    block_size, reader=loopback.read_data)
+            loopback.read_ahead = SequentialReadAhead(prefetcher,
+                    DiscoveryConst.PREFETCH_WINDOW_BLOCKS)
+        if self.control_conn is not None:
+            control_thread = threading.Thread(target=self._control,
+                    args=(loopback,))
+            control_thread.daemon = True
+            control_thread.start()
+        # libfuse exits its loop on SIGTERM only when the signal has the
+        # default handler, which may have been changed in the parent
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        try:
+            FUSE(loopback, self.mountpoint,
+                    foreground=True, nothreads=False, **self.mount_options)
+        finally:
+            if block_cache is not None:
+                block_cache.close()
+
+    def _control(self, loopback):
+        while True:
+            try:
+                (cmd, inode_list) = self.control_conn.recv()
+            except (EOFError, IOError):
+                return
+            loopback.control(cmd, inode_list)
 
     def terminate(self):
+        '''
+        unmount the loopback, so that FUSE returns and the block cache is
+        closed cleanly. SIGTERM is sent if it does not exit in time.
+        '''
         self.stop.set()
+        if not self.is_alive():
+            return
+        try:
+            with open(os.devnull, "w") as devnull:
+                subprocess.call(["fusermount", "-u", "-z", self.mountpoint],
+                        stdout=devnull, stderr=devnull)
+        except OSError as e:
+            LOG.warning("[CACHE] failed to unmount %s: %s" % \
+                    (self.mountpoint, str(e)))
+        self.join(self.TERMINATE_TIMEOUT)
+        if self.is_alive():
+            multiprocessing.Process.terminate(self)
+            self.join(self.TERMINATE_TIMEOUT)
 
 
 def process_command_line(argv):
@@ -203,9 +810,9 @@ def process_command_line(argv):
 def main():
     mountpoint, root, settings = process_command_line(sys.argv[1:])
 
-    access_queue = Queue()
-    fuse = FuseLauncher(mountpoint, root, access_queue)
-    cache_monitor = _CacheMonitor(access_queue, settings.print_console)
+    access_reader, access_writer = multiprocessing.Pipe(duplex=False)
+    fuse = FuseLauncher(mountpoint, root, access_writer)
+    cache_monitor = _CacheMonitor(access_reader, root, settings.print_console)
     cmdline_interface = None
     if not settings.print_console:
         cmdline_interface = CmdInterface(cache_monitor)
@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+#
+# Cloudlet Infrastructure for Mobile Computing
+#
+#   Copyright (C) 2011-2013 Carnegie Mellon University
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+
+import os
+import re
+import stat
+import bisect
+import threading
+from collections import OrderedDict
+
+from ..log import logging
+
+
+LOG = logging.getLogger(__name__)
+
+
+def compile_pattern(pattern):
+    '''
+    compile a glob2 style pattern relative to the root into
+    (literal directory prefix, regular expression).
+    "**" matches any number of directories, "*" and "?" do not match "/",
+    and a wildcard at the start of a name does not match a leading ".".
+    '''
+    components = [component for component in pattern.split("/")
+            if component not in ("", ".")]
+    prefix_list = list()
+    for component in components:
+        if re.search(r"[*?[]", component):
+            break
+        prefix_list.append(component)
+    if len(prefix_list) == len(components):
+        # no wildcard
+        return "/".join(prefix_list), None
+
+    regex = ""
+    for (index, component) in enumerate(components):
+        is_last = (index == len(components)-1)
+        if component == "**":
+            regex += r"(?:(?!\.)[^/]*(?:/|$))*" if is_last \
+                    else r"(?:(?!\.)[^/]*/)*"
+            continue
+        if component[0] in "*?[":
+            regex += r"(?!\.)"
+        regex += _translate(component)
+        if not is_last:
+            regex += "/"
+    prefix = "/".join(prefix_list)
+    if len(prefix) > 0:
+        prefix += "/"
+    return prefix, re.compile(regex + r"\Z")
+
+
+def _translate(component):
+    # fnmatch.translate without matching "/"
+    regex = ""
+    index, length = 0, len(component)
+    while index < length:
+        char = component[index]
+        index += 1
+        if char == "*":
+            regex += "[^/]*"
+        elif char == "?":
+            regex += "[^/]"
+        elif char == "[":
+            end = index
+            if end < length and component[end] == "!":
+                end += 1
+            if end < length and component[end] == "]":
+                end += 1
+            while end < length and component[end] != "]":
+                end += 1
+            if end >= length:
+                regex += "\\["
+            else:
+                chars = component[index:end].replace("\\", "\\\\")
+                index = end + 1
+                if chars[0] == "!":
+                    chars = "^/" + chars[1:]
+                elif chars[0] == "^":
+                    chars = "\\" + chars
+                regex += "[%s]" % chars
+        else:
+            regex += re.escape(char)
+    return regex
+
+
+class FileIndex(object):
+    '''
+    In-memory index of regular files under @root, relative path to
+    (size, inode), so that file patterns are matched without walking the
+    file system.
+
+    The index is built with os.walk in a thread, kept current with the
+    changes that the FUSE loopback reports, and rebuilt every
+    REBUILD_PERIOD seconds to pick up changes made to the DFS by others.
+    It is empty until the first build is done. A rebuilt index
+    is swapped in at once, and the changes reported during the walk are
+    applied again on top of it. Paths are also kept sorted, so a pattern
+    that starts with literal directories only scans the paths under them.
+    The generation changes whenever a file is added, removed, or replaced.
+    '''
+    REBUILD_PERIOD = 600
+    PATTERN_CACHE_SIZE = 256
+
+    def __init__(self, root, rebuild_period=REBUILD_PERIOD):
+        self.root = os.path.abspath(root)
+        self.rebuild_period = rebuild_period
+        self.lock = threading.RLock()
+        self.files = dict()         # relpath:(size, inode)
+        self.sorted_paths = list()
+        self.generation = 0
+        self.pattern_cache = OrderedDict()
+        self.synced_paths = None    # paths synced while building
+        self.stop = threading.Event()
+        self.built = threading.Event()
+        self.rebuild_thread = None
+
+    def __len__(self):
+        return len(self.files)
+
+    def relpath(self, abspath):
+        relpath = os.path.relpath(abspath, self.root)
+        if relpath == "." or relpath.startswith(".." + os.sep):
+            return None
+        return relpath
+
+    def build(self):
+        with self.lock:
+            self.synced_paths = set()
+        files = dict()
+        for (dirpath, dirnames, filenames) in os.walk(self.root):
+            for filename in filenames:
+                abspath = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(abspath)
+                except OSError:
+                    continue
+                if stat.S_ISREG(st.st_mode):
+                    files[os.path.relpath(abspath, self.root)] = \
+                            (st.st_size, st.st_ino)
+        sorted_paths = sorted(files.iterkeys())
+        with self.lock:
+            synced_paths, self.synced_paths = self.synced_paths, None
+            if files != self.files:
+                self.files = files
+                self.sorted_paths = sorted_paths
+                self.generation += 1
+        # the walk may have missed them
+        for abspath in synced_paths:
+            self.sync(abspath)
+        LOG.info("[CACHE] indexed %d files at %s" % (len(files), self.root))
+
+    def start(self):
+        '''
+        build the index in a thread, and rebuild it every rebuild_period
+        seconds
+        '''
+        self.rebuild_thread = threading.Thread(target=self._rebuild)
+        self.rebuild_thread.daemon = True
+        self.rebuild_thread.start()
+
+    def _rebuild(self):
+        while not self.stop.is_set():
+            try:
+                self.build()
+            except (IOError, OSError) as e:
+                LOG.warning("[CACHE] failed to index %s: %s" % \
+                        (self.root, str(e)))
+            self.built.set()
+            self.stop.wait(self.rebuild_period)
+
+    def terminate(self):
+        self.stop.set()
+
+    def _set(self, relpath, size, inode):
+        entry = self.files.get(relpath, None)
+        if entry == (size, inode):
+            return
+        if entry is None:
+            bisect.insort(self.sorted_paths, relpath)
+        self.files[relpath] = (size, inode)
+        self.generation += 1
+
+    def _remove_tree(self, relpath):
+        start, end = self._range(relpath + "/")
+        removed = self.files.pop(relpath, None) is not None
+        if removed:
+            exact = bisect.bisect_left(self.sorted_paths, relpath)
+            del self.sorted_paths[exact]
+            start, end = start-1, end-1
+        if removed or start < end:
+            self.generation += 1
+        for path in self.sorted_paths[start:end]:
+            del self.files[path]
+        del self.sorted_paths[start:end]
+
+    def _range(self, prefix):
+        start = bisect.bisect_left(self.sorted_paths, prefix)
+        # "\xff" sorts after any character in a path
+        end = bisect.bisect_left(self.sorted_paths, prefix + "\xff", start)
+        return start, end
+
+    def sync(self, abspath):
+        '''
+        re-read the file or directory at @abspath after a change
+        '''
+        relpath = self.relpath(abspath)
+        if relpath is None:
+            return
+        with self.lock:
+            if self.synced_paths is not None:
+                self.synced_paths.add(abspath)
+        try:
+            st = os.stat(abspath)
+        except OSError:
+            with self.lock:
+                self._remove_tree(relpath)
+            return
+        if stat.S_ISREG(st.st_mode):
+            with self.lock:
+                self._set(relpath, st.st_size, st.st_ino)
+        elif stat.S_ISDIR(st.st_mode):
+            # e.g. a renamed directory
+            with self.lock:
+                self._remove_tree(relpath)
+            for (dirpath, dirnames, filenames) in os.walk(abspath):
+                for filename in filenames:
+                    self.sync(os.path.join(dirpath, filename))
+
+    def size_of(self, abspath):
+        entry = self.files.get(self.relpath(abspath), None)
+        if entry is None:
+            return None
+        return entry[0]
+
+    def update_size(self, abspath, size):
+        '''
+        grow the size of an indexed file after a write
+        '''
+        relpath = self.relpath(abspath)
+        with self.lock:
+            entry = self.files.get(relpath, None)
+            if entry is not None and entry[0] < size:
+                self.files[relpath] = (size, entry[1])
+                self.generation += 1
+
+    def _compiled(self, pattern):
+        compiled = self.pattern_cache.get(pattern, None)
+        if compiled is None:
+            compiled = compile_pattern(pattern)
+            if len(self.pattern_cache) >= self.PATTERN_CACHE_SIZE:
+                self.pattern_cache.popitem(last=False)
+            self.pattern_cache[pattern] = compiled
+        return compiled
+
+    def match(self, pattern):
+        '''
+        return list of (relpath, size, inode) of files matching @pattern,
+        a glob2 pattern relative to the root
+        '''
+        if os.path.isabs(pattern):
+            pattern = self.relpath(pattern)
+            if pattern is None:
+                return list()
+        with self.lock:
+            prefix, regex = self._compiled(pattern)
+            if regex is None:
+                entry = self.files.get(prefix, None)
+                if entry is None:
+                    return list()
+                return [(prefix, entry[0], entry[1])]
+            start, end = self._range(prefix)
+            files = self.files
+            return [(path, files[path][0], files[path][1])
+                    for path in self.sorted_paths[start:end]
+                    if regex.match(path)]
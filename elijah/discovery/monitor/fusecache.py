@@ -21,10 +21,46 @@
 import os
 import sys
 import errno
+import time
+import struct
+import threading
+from collections import OrderedDict
 
 from fuse import FUSE, FuseOSError, Operations
 from optparse import OptionParser
-from Queue import Full
+
+
+# positional I/O leaves the file offset alone, so handles can be shared
+# by the FUSE threads
+if hasattr(os, "pread"):
+    pread = os.pread
+    pwrite = os.pwrite
+else:
+    import ctypes
+    import ctypes.util
+
+    _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    _libc.pread64.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t,
+            ctypes.c_int64]
+    _libc.pread64.restype = ctypes.c_ssize_t
+    _libc.pwrite64.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_size_t,
+            ctypes.c_int64]
+    _libc.pwrite64.restype = ctypes.c_ssize_t
+
+    def pread(fd, length, offset):
+        buf = ctypes.create_string_buffer(length)
+        ret = _libc.pread64(fd, buf, length, offset)
+        if ret < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return buf.raw[:ret]
+
+    def pwrite(fd, data, offset):
+        ret = _libc.pwrite64(fd, data, len(data), offset)
+        if ret < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return ret
 
 
 class AccessInfo(object):
@@ -32,10 +68,30 @@ class AccessInfo(object):
     CMD_WRITE = "write"
     CMD_OPEN = "open"
     CMD_CLOSE = "close"
-
-    def __init__(self, cmd, full_path, offset=None, length=None):
-        self.inode = os.stat(full_path).st_ino
+    # changes of the file tree
+    CMD_CREATE = "create"
+    CMD_UNLINK = "unlink"
+    CMD_RENAME = "rename"
+    CMD_TRUNCATE = "truncate"
+    # a byte range is no longer in the local block cache
+    CMD_EVICT = "evict"
+
+    # command code in an access record
+    CMD_LIST = (CMD_READ, CMD_WRITE, CMD_OPEN, CMD_CLOSE, CMD_CREATE,
+            CMD_UNLINK, CMD_RENAME, CMD_TRUNCATE, CMD_EVICT)
+    CMD_CODES = dict((cmd, code) for (code, cmd) in enumerate(CMD_LIST))
+
+    def __init__(self, cmd, full_path, offset=None, length=None, new_path=None,
+            inode=None):
+        if inode is not None:
+            self.inode = inode
+        elif cmd == AccessInfo.CMD_UNLINK or cmd == AccessInfo.CMD_RENAME:
+            # the path is gone
+            self.inode = None
+        else:
+            self.inode = os.stat(full_path).st_ino
         self.full_path = full_path
+        self.new_path = new_path
         self.cmd = cmd
         self.offset = offset
         self.length = length
@@ -44,17 +100,279 @@ class AccessInfo(object):
         return "%s(%ld)\t%s" % (self.full_path, self.inode, self.cmd)
 
 
+# cmd code, inode, offset, length, length of the path that follows
+RECORD_HEADER = struct.Struct("<BQqqH")
+
+
+def unpack_records(data):
+    '''
+    yield (cmd, inode, offset, length, path) of each record in a batch.
+    A rename record has "old path\\0new path".
+    '''
+    cmd_list = AccessInfo.CMD_LIST
+    unpack_from = RECORD_HEADER.unpack_from
+    header_size = RECORD_HEADER.size
+    position, data_size = 0, len(data)
+    while position < data_size:
+        (cmd, inode, offset, length, path_len) = unpack_from(data, position)
+        position += header_size
+        path = data[position:position+path_len]
+        position += path_len
+        yield cmd_list[cmd], inode, offset, length, path
+
+
+class AccessRecorder(object):
+    '''
+    Pack access events into binary records and send them to the cache
+    monitor in batches through a pipe connection.
+
+    A background thread sends the pending records every FLUSH_PERIOD
+    seconds, or as soon as BATCH_SIZE bytes are pending. Records beyond
+    MAX_PENDING bytes are dropped when the monitor does not keep up.
+    '''
+    FLUSH_PERIOD = 0.05
+    BATCH_SIZE = 64*1024
+    MAX_PENDING = 8*1024*1024
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = threading.Lock()
+        self.pending = list()
+        self.pending_size = 0
+        self.dropped = 0
+        self.wakeup = threading.Event()
+        self.sender = threading.Thread(target=self._run)
+        self.sender.daemon = True
+        self.sender.start()
+
+    def record(self, cmd, inode, offset=0, length=0, path=""):
+        if isinstance(path, unicode):
+            path = path.encode("utf-8")
+        record = RECORD_HEADER.pack(AccessInfo.CMD_CODES[cmd], inode or 0,
+                offset or 0, length or 0, len(path)) + path
+        with self.lock:
+            if self.pending_size + len(record) > self.MAX_PENDING:
+                self.dropped += 1
+                return
+            self.pending.append(record)
+            self.pending_size += len(record)
+            if self.pending_size >= self.BATCH_SIZE:
+                self.wakeup.set()
+
+    def _run(self):
+        while True:
+            self.wakeup.wait(self.FLUSH_PERIOD)
+            self.wakeup.clear()
+            with self.lock:
+                pending = self.pending
+                self.pending = list()
+                self.pending_size = 0
+            if len(pending) == 0:
+                continue
+            try:
+                self.conn.send_bytes("".join(pending))
+            except (IOError, EOFError, ValueError):
+                # cache monitor is gone
+                return
+
+
+class MetadataCache(object):
+    '''
+    Bounded LRU cache whose entries expire after @timeout seconds
+    '''
+    def __init__(self, max_size, timeout):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()    # key:(value, expire time)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is None:
+                return None
+            if entry[1] < time.time():
+                del self.entries[key]
+                return None
+            return entry[0]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, time.time() + self.timeout)
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
 class LoopBack(Operations):
-    def __init__(self, root, access_queue=None):
+    '''
+    Loopback file system of @root that reports file accesses to the cache
+    monitor through @access_conn.
+
+    getattr and readdir results are cached for @cache_timeout seconds,
+    which should match the attr/entry timeouts of the mount. Operations
+    through this mount invalidate the entries they change; changes made
+    to @root directly are seen after the timeout.
+
+    Reads are passed to @read_ahead, a SequentialReadAhead, if it is set.
+
+    With @block_cache, file data is read in whole chunks that are kept in
+    the local BlockCache, and only the chunks filled from @root and the
+    chunks evicted are reported. A write or truncate drops the cached
+    chunks it changed. The mtime chunks are cached with is taken when the
+    file is opened and after each change through the mount, so reads do
+    not stat the file.
+    '''
+    CACHE_TIMEOUT = 1.0
+    ATTR_CACHE_SIZE = 65536
+    DIRENT_CACHE_SIZE = 4096
+    MAX_FILE_SIZE = 1 << 62
+    # requests of the cache monitor
+    CONTROL_PIN = "pin"
+    CONTROL_UNPIN = "unpin"
+
+    def __init__(self, root, access_conn=None, cache_timeout=CACHE_TIMEOUT,
+            block_cache=None):
         self.root = root
-        self.access_queue = access_queue
-
-    def _update(self, access_info):
-        if self.access_queue is not None:
-            try:
-                self.access_queue.put_nowait(access_info)
-            except Full:
-                pass
+        # fh:(inode, full path) of open files
+        self.handles = dict()
+        # inode:[open count, mtime] of open files
+        self.open_inodes = dict()
+        self.open_lock = threading.Lock()
+        self.recorder = None
+        if access_conn is not None:
+            self.recorder = AccessRecorder(access_conn)
+        self.attr_cache = MetadataCache(self.ATTR_CACHE_SIZE, cache_timeout)
+        self.dirent_cache = MetadataCache(self.DIRENT_CACHE_SIZE, cache_timeout)
+        self.read_ahead = None
+        self.block_cache = block_cache
+
+    def _changed(self, path, in_parent=False):
+        '''
+        invalidate cached metadata of @path, and of its parent directory
+        if an entry was added or removed
+        '''
+        self.attr_cache.invalidate(path)
+        if in_parent:
+            parent = os.path.dirname(path)
+            self.attr_cache.invalidate(parent)
+            self.dirent_cache.invalidate(parent)
+
+    def _update(self, cmd, full_path=None, inode=0, offset=0, length=0):
+        if self.recorder is not None:
+            self.recorder.record(cmd, inode, offset, length, full_path or "")
+
+    def _evicted(self, chunk_list):
+        chunk_size = self.block_cache.chunk_size
+        for (inode, chunk, length) in chunk_list:
+            self._update(AccessInfo.CMD_EVICT, inode=inode,
+                    offset=chunk*chunk_size, length=length)
+
+    def read_data(self, fd, inode, offset, length):
+        '''
+        read from @fd of @inode, through the block cache if there is one
+        '''
+        if self.block_cache is None:
+            self._update(AccessInfo.CMD_READ, inode=inode,
+                    offset=offset, length=length)
+            return pread(fd, length, offset)
+        if length <= 0:
+            return ""
+        block_cache = self.block_cache
+        chunk_size = block_cache.chunk_size
+        mtime = self._mtime(fd, inode)
+        evicted = block_cache.validate(inode, mtime)
+        data_list = list()
+        end = offset + length
+        for chunk in xrange(offset/chunk_size, (end-1)/chunk_size + 1):
+            chunk_offset = chunk*chunk_size
+            start = max(offset, chunk_offset) - chunk_offset
+            size = min(end, chunk_offset + chunk_size) - chunk_offset - start
+            data = block_cache.get(inode, mtime, chunk, start, size)
+            if data is None:
+                chunk_data = pread(fd, chunk_size, chunk_offset)
+                if len(chunk_data) > 0:
+                    evicted.extend(block_cache.put(inode, mtime, chunk,
+                        chunk_data))
+                    self._update(AccessInfo.CMD_READ, inode=inode,
+                            offset=chunk_offset, length=len(chunk_data))
+                data = chunk_data[start:start+size]
+            data_list.append(data)
+            if len(data) < size:
+                # end of file
+                break
+        if len(evicted) > 0:
+            self._evicted(evicted)
+        return "".join(data_list)
+
+    def control(self, cmd, inode_list):
+        '''
+        handle a request of the cache monitor
+        '''
+        if self.block_cache is None:
+            return
+        if cmd == self.CONTROL_PIN:
+            for inode in inode_list:
+                self.block_cache.pin(inode)
+        elif cmd == self.CONTROL_UNPIN:
+            for inode in inode_list:
+                self.block_cache.unpin(inode)
+
+    def _opened(self, fd, inode, full_path, mtime):
+        with self.open_lock:
+            self.handles[fd] = (inode, full_path)
+            entry = self.open_inodes.setdefault(inode, [0, mtime])
+            entry[0] += 1
+            entry[1] = mtime
+
+    def _closed(self, fd):
+        with self.open_lock:
+            handle = self.handles.pop(fd, None)
+            if handle is not None:
+                entry = self.open_inodes[handle[0]]
+                entry[0] -= 1
+                if entry[0] == 0:
+                    del self.open_inodes[handle[0]]
+        return handle
+
+    def _mtime(self, fd, inode):
+        entry = self.open_inodes.get(inode, None)
+        if entry is None:
+            return os.fstat(fd).st_mtime
+        return entry[1]
+
+    def _modified(self, inode, mtime, offset, length=None):
+        '''
+        drop the cached chunks changed by a write of @length bytes at
+        @offset, or by a truncate to @offset if @length is None
+        '''
+        chunk_size = self.block_cache.chunk_size
+        first = offset/chunk_size
+        if length is None:
+            last = None
+            evict_length = self.MAX_FILE_SIZE - first*chunk_size
+        else:
+            last = (offset + length - 1)/chunk_size
+            evict_length = (last + 1 - first)*chunk_size
+        dropped = self.block_cache.modified(inode, mtime, first, last)
+        with self.open_lock:
+            entry = self.open_inodes.get(inode, None)
+            if entry is not None:
+                entry[1] = mtime
+        # the written range is not cached either
+        if evict_length > 0:
+            self._update(AccessInfo.CMD_EVICT, inode=inode,
+                    offset=first*chunk_size, length=evict_length)
+        self._evicted([item for item in dropped if item[1] < first or
+            (last is not None and item[1] > last)])
 
     def _full_path(self, partial):
         if partial.startswith("/"):
@@ -69,26 +387,42 @@ class LoopBack(Operations):
 
     def chmod(self, path, mode):
         full_path = self._full_path(path)
+        self._changed(path)
         return os.chmod(full_path, mode)
 
     def chown(self, path, uid, gid):
         full_path = self._full_path(path)
+        self._changed(path)
         return os.chown(full_path, uid, gid)
 
     def getattr(self, path, fh=None):
-        full_path = self._full_path(path)
-        st = os.lstat(full_path)
-        return dict((key, getattr(st, key)) for key in ('st_atime', 'st_ctime',
-                     'st_gid', 'st_mode', 'st_mtime', 'st_nlink', 'st_size', 'st_uid'))
+        attr = self.attr_cache.get(path)
+        if attr is None:
+            full_path = self._full_path(path)
+            try:
+                st = os.lstat(full_path)
+                attr = dict((key, getattr(st, key)) for key in ('st_atime',
+                    'st_ctime', 'st_gid', 'st_mode', 'st_mtime', 'st_nlink',
+                    'st_size', 'st_uid'))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                # remember missing files too
+                attr = e.errno
+            self.attr_cache.put(path, attr)
+        if attr == errno.ENOENT:
+            raise FuseOSError(errno.ENOENT)
+        return attr
 
     def readdir(self, path, fh):
-        full_path = self._full_path(path)
-
-        dirents = ['.', '..']
-        if os.path.isdir(full_path):
-            dirents.extend(os.listdir(full_path))
-        for r in dirents:
-            yield r
+        dirents = self.dirent_cache.get(path)
+        if dirents is None:
+            full_path = self._full_path(path)
+            dirents = ['.', '..']
+            if os.path.isdir(full_path):
+                dirents.extend(os.listdir(full_path))
+            self.dirent_cache.put(path, dirents)
+        return dirents
 
     def readlink(self, path):
         pathname = os.readlink(self._full_path(path))
@@ -99,14 +433,22 @@ class LoopBack(Operations):
             return pathname
 
     def mknod(self, path, mode, dev):
-        return os.mknod(self._full_path(path), mode, dev)
+        full_path = self._full_path(path)
+        ret = os.mknod(full_path, mode, dev)
+        self._changed(path, in_parent=True)
+        self._update(AccessInfo.CMD_CREATE, full_path, os.stat(full_path).st_ino)
+        return ret
 
     def rmdir(self, path):
         full_path = self._full_path(path)
-        return os.rmdir(full_path)
+        ret = os.rmdir(full_path)
+        self._changed(path, in_parent=True)
+        return ret
 
     def mkdir(self, path, mode):
-        return os.mkdir(self._full_path(path), mode)
+        ret = os.mkdir(self._full_path(path), mode)
+        self._changed(path, in_parent=True)
+        return ret
 
     def statfs(self, path):
         full_path = self._full_path(path)
@@ -116,51 +458,102 @@ class LoopBack(Operations):
             'f_frsize', 'f_namemax'))
 
     def unlink(self, path):
-        return os.unlink(self._full_path(path))
+        full_path = self._full_path(path)
+        ret = os.unlink(full_path)
+        self._changed(path, in_parent=True)
+        self._update(AccessInfo.CMD_UNLINK, full_path)
+        return ret
 
     def symlink(self, target, name):
-        return os.symlink(self._full_path(target), self._full_path(name))
+        ret = os.symlink(self._full_path(target), self._full_path(name))
+        self._changed(name, in_parent=True)
+        self._update(AccessInfo.CMD_CREATE, self._full_path(name))
+        return ret
 
     def rename(self, old, new):
-        return os.rename(self._full_path(old), self._full_path(new))
+        ret = os.rename(self._full_path(old), self._full_path(new))
+        # paths under a renamed directory change too
+        self.attr_cache.clear()
+        self.dirent_cache.clear()
+        self._update(AccessInfo.CMD_RENAME,
+                self._full_path(old) + "\0" + self._full_path(new))
+        return ret
 
     def link(self, target, name):
-        return os.link(self._full_path(target), self._full_path(name))
+        ret = os.link(self._full_path(target), self._full_path(name))
+        self._changed(target)
+        self._changed(name, in_parent=True)
+        self._update(AccessInfo.CMD_CREATE, self._full_path(name))
+        return ret
 
     def utimens(self, path, times=None):
+        self._changed(path)
         return os.utime(self._full_path(path), times)
 
     def open(self, path, flags):
         full_path = self._full_path(path)
-        self._update(AccessInfo(AccessInfo.CMD_OPEN, full_path))
-        return os.open(full_path, flags)
+        fd = os.open(full_path, flags)
+        st = os.fstat(fd)
+        inode = st.st_ino
+        self._opened(fd, inode, full_path, st.st_mtime)
+        self._update(AccessInfo.CMD_OPEN, full_path, inode)
+        return fd
 
     def create(self, path, mode, fi=None):
         full_path = self._full_path(path)
-        return os.open(full_path, os.O_WRONLY | os.O_CREAT, mode)
+        fd = os.open(full_path, os.O_WRONLY | os.O_CREAT, mode)
+        self._changed(path, in_parent=True)
+        st = os.fstat(fd)
+        inode = st.st_ino
+        self._opened(fd, inode, full_path, st.st_mtime)
+        self._update(AccessInfo.CMD_CREATE, full_path, inode)
+        return fd
+
+    def _inode(self, fh):
+        handle = self.handles.get(fh, None)
+        if handle is None:
+            return os.fstat(fh).st_ino
+        return handle[0]
 
     def read(self, path, length, offset, fh):
-        os.lseek(fh, offset, os.SEEK_SET)
-        self._update(AccessInfo(AccessInfo.CMD_READ, self._full_path(path),
-            offset=offset, length=length))
-        return os.read(fh, length)
+        inode = self._inode(fh)
+        if self.read_ahead is not None:
+            handle = self.handles.get(fh, None)
+            if handle is not None:
+                self.read_ahead.on_read(fh, inode, handle[1], offset, length)
+        return self.read_data(fh, inode, offset, length)
 
     def write(self, path, buf, offset, fh):
-        os.lseek(fh, offset, os.SEEK_SET)
-        self._update(AccessInfo(AccessInfo.CMD_WRITE, self._full_path(path),
-            offset=offset, length=len(buf)))
-        return os.write(fh, buf)
+        self._changed(path)
+        inode = self._inode(fh)
+        self._update(AccessInfo.CMD_WRITE, inode=inode,
+                offset=offset, length=len(buf))
+        ret = pwrite(fh, buf, offset)
+        if self.block_cache is not None:
+            self._modified(inode, os.fstat(fh).st_mtime, offset, len(buf))
+        return ret
 
     def truncate(self, path, length, fh=None):
         full_path = self._full_path(path)
         with open(full_path, 'r+') as f:
             f.truncate(length)
+        self._changed(path)
+        st = os.stat(full_path)
+        inode = st.st_ino
+        self._update(AccessInfo.CMD_TRUNCATE, full_path, inode, length=length)
+        if self.block_cache is not None:
+            self._modified(inode, st.st_mtime, length)
 
     def flush(self, path, fh):
         return os.fsync(fh)
 
     def release(self, path, fh):
-        self._update(AccessInfo(AccessInfo.CMD_CLOSE, self._full_path(path)))
+        handle = self._closed(fh)
+        if self.read_ahead is not None:
+            self.read_ahead.release(fh)
+        if handle is None:
+            handle = (os.fstat(fh).st_ino, self._full_path(path))
+        self._update(AccessInfo.CMD_CLOSE, handle[1], handle[0])
         return os.close(fh)
 
     def fsync(self, path, fdatasync, fh):
@@ -187,7 +580,7 @@ def process_command_line(argv):
 
 def main():
     mountpoint, root, settings = process_command_line(sys.argv[1:])
-    FUSE(LoopBack(root), mountpoint, foreground=True)
+    FUSE(LoopBack(root), mountpoint, foreground=True, nothreads=False)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+#
+# Cloudlet Infrastructure for Mobile Computing
+#
+#   Copyright (C) 2011-2013 Carnegie Mellon University
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+
+import bisect
+
+
+class IntervalSet(object):
+    '''
+    Set of byte ranges kept as sorted, disjoint, half-open [start, end)
+    intervals. Overlapping and adjacent ranges are merged, so sequential
+    reads of a file keep a single interval.
+    '''
+    def __init__(self, intervals=None):
+        self.starts = list()
+        self.ends = list()
+        self.covered = 0
+        for (start, end) in (intervals or ()):
+            self.add(start, end)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __iter__(self):
+        return iter(zip(self.starts, self.ends))
+
+    def add(self, start, end):
+        '''
+        add [start, end) and return the number of newly covered bytes
+        '''
+        if end <= start:
+            return 0
+        # intervals that overlap or touch [start, end)
+        first = bisect.bisect_left(self.ends, start)
+        last = bisect.bisect_right(self.starts, end)
+        removed = 0
+        if first < last:
+            for index in xrange(first, last):
+                removed += self.ends[index] - self.starts[index]
+            start = min(start, self.starts[first])
+            end = max(end, self.ends[last-1])
+        self.starts[first:last] = [start]
+        self.ends[first:last] = [end]
+        added = (end - start) - removed
+        self.covered += added
+        return added
+
+    def remove(self, start, end):
+        '''
+        remove [start, end) and return the number of uncovered bytes
+        '''
+        if end <= start:
+            return 0
+        # intervals that overlap [start, end)
+        first = bisect.bisect_right(self.ends, start)
+        last = bisect.bisect_left(self.starts, end)
+        if first >= last:
+            return 0
+        removed = 0
+        for index in xrange(first, last):
+            removed += self.ends[index] - self.starts[index]
+        new_starts, new_ends = list(), list()
+        if self.starts[first] < start:
+            new_starts.append(self.starts[first])
+            new_ends.append(start)
+        if self.ends[last-1] > end:
+            new_starts.append(end)
+            new_ends.append(self.ends[last-1])
+        for index in xrange(len(new_starts)):
+            removed -= new_ends[index] - new_starts[index]
+        self.starts[first:last] = new_starts
+        self.ends[first:last] = new_ends
+        self.covered -= removed
+        return removed
+
+    def covered_in(self, start, end):
+        '''
+        number of covered bytes in [start, end)
+        '''
+        if len(self.starts) == 0 or end <= start:
+            return 0
+        if start <= self.starts[0] and self.ends[-1] <= end:
+            return self.covered
+        first = bisect.bisect_right(self.ends, start)
+        last = bisect.bisect_left(self.starts, end)
+        total = 0
+        for index in xrange(first, last):
+            total += min(self.ends[index], end) - max(self.starts[index], start)
+        return total
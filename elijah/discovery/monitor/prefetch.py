@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+#
+# Cloudlet Infrastructure for Mobile Computing
+#
+#   Copyright (C) 2011-2013 Carnegie Mellon University
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+
+import os
+import time
+import Queue
+import threading
+from collections import OrderedDict
+
+from fusecache import pread
+from ..log import logging
+
+
+LOG = logging.getLogger(__name__)
+
+
+class BlockPrefetcher(object):
+    '''
+    Pool of threads that read byte ranges of files to bring them into the
+    cache of the file system underneath. The data is thrown away.
+
+    A request that is already queued is not queued again, and requests
+    are dropped while MAX_QUEUE requests are waiting. Blocks are read with
+    @reader(fd, inode, offset, length) if it is given.
+    '''
+    WORKERS = 4
+    BLOCK_SIZE = 128*1024
+    MAX_QUEUE = 1024
+
+    def __init__(self, workers=WORKERS, block_size=BLOCK_SIZE, reader=None):
+        self.block_size = block_size
+        self.reader = reader
+        self.queue = Queue.Queue(self.MAX_QUEUE)
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.threads = list()
+        for index in xrange(workers):
+            thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, path, offset=0, length=None, inode=0):
+        '''
+        read @length bytes of @path from @offset, or up to the end of the
+        file if @length is None. Return False if the request is dropped.
+        '''
+        key = (path, offset, length)
+        with self.lock:
+            if key in self.pending:
+                return True
+            self.pending.add(key)
+        try:
+            self.queue.put_nowait((key, inode))
+        except Queue.Full:
+            with self.lock:
+                self.pending.discard(key)
+            return False
+        return True
+
+    def _run(self):
+        while True:
+            (key, inode) = self.queue.get()
+            if key is None:
+                return
+            try:
+                self._read(inode, *key)
+            except (IOError, OSError) as e:
+                LOG.debug("[CACHE] failed to prefetch %s: %s" % (key[0], str(e)))
+            finally:
+                with self.lock:
+                    self.pending.discard(key)
+
+    def _read(self, inode, path, offset, length):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            end = None if length is None else offset + length
+            while end is None or offset < end:
+                size = self.block_size
+                if end is not None:
+                    size = min(size, end - offset)
+                if self.reader is not None:
+                    data = self.reader(fd, inode, offset, size)
+                else:
+                    data = pread(fd, size, offset)
+                if len(data) == 0:
+                    break
+                offset += len(data)
+        finally:
+            os.close(fd)
+
+    def terminate(self):
+        for thread in self.threads:
+            try:
+                self.queue.put_nowait((None, 0))
+            except Queue.Full:
+                break
+
+
+class SequentialReadAhead(object):
+    '''
+    Detect sequential reads per file handle and keep @window_blocks blocks
+    ahead of the reader prefetched.
+
+    A handle is sequential once SEQUENTIAL_READS reads in a row start where
+    the previous one ended. The next window is requested when the reader
+    gets within half a window of the prefetched range.
+    '''
+    SEQUENTIAL_READS = 2
+    WINDOW_BLOCKS = 8
+
+    def __init__(self, prefetcher, window_blocks=WINDOW_BLOCKS):
+        self.prefetcher = prefetcher
+        self.window = window_blocks * prefetcher.block_size
+        self.lock = threading.Lock()
+        self.streams = dict()   # fh:[next offset, sequential reads, prefetched until]
+
+    def on_read(self, fh, inode, full_path, offset, length):
+        end = offset + length
+        request = None
+        with self.lock:
+            stream = self.streams.get(fh, None)
+            if stream is None or stream[0] != offset:
+                # a read from the start of a file counts as sequential
+                stream = self.streams[fh] = [end, 1 if offset == 0 else 0, end]
+            else:
+                stream[0] = end
+                stream[1] += 1
+            if stream[1] >= self.SEQUENTIAL_READS and \
+                    stream[2] - end < self.window/2:
+                start = max(stream[2], end)
+                stream[2] = end + self.window
+                request = (start, stream[2] - start)
+        if request is not None:
+            self.prefetcher.submit(full_path, request[0], request[1], inode)
+
+    def release(self, fh):
+        with self.lock:
+            self.streams.pop(fh, None)
+
+    def terminate(self):
+        self.prefetcher.terminate()
+
+
+class AppAccessLog(object):
+    '''
+    Files opened by each application, in the order of first open.
+
+    Accesses are not tagged with the application, so the files opened
+    within RECORD_PERIOD seconds after a query of an application are
+    taken as its accesses. Files opened while several recordings are open
+    are added to each of them.
+    '''
+    RECORD_PERIOD = 60
+    MAX_FILES = 256
+    MAX_APPS = 128
+
+    def __init__(self, record_period=RECORD_PERIOD):
+        self.record_period = record_period
+        self.lock = threading.Lock()
+        self.sequences = OrderedDict()  # app_id:[path]
+        self.recordings = dict()        # app_id:(deadline, [path], set(path))
+
+    def start(self, app_id):
+        '''
+        record the files opened from now on as accesses of @app_id
+        '''
+        with self.lock:
+            self._finish(time.time())
+            if app_id not in self.recordings:
+                self.recordings[app_id] = \
+                        (time.time() + self.record_period, list(), set())
+
+    def _finish(self, now):
+        for (app_id, (deadline, paths, path_set)) in self.recordings.items():
+            if deadline > now:
+                continue
+            del self.recordings[app_id]
+            if len(paths) == 0:
+                continue
+            self.sequences.pop(app_id, None)
+            self.sequences[app_id] = paths
+            if len(self.sequences) > self.MAX_APPS:
+                self.sequences.popitem(last=False)
+
+    def on_open(self, path):
+        if len(self.recordings) == 0:
+            return
+        with self.lock:
+            self._finish(time.time())
+            for (deadline, paths, path_set) in self.recordings.itervalues():
+                if path in path_set or len(paths) >= self.MAX_FILES:
+                    continue
+                path_set.add(path)
+                paths.append(path)
+
+    def get(self, app_id):
+        '''
+        return the files recorded for @app_id, in the order of first open
+        '''
+        with self.lock:
+            self._finish(time.time())
+            return list(self.sequences.get(app_id, ()))
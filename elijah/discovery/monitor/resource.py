@@ -15,16 +15,47 @@
 # for more details.
 #
 
+import collections
 import libvirt
 import ResourceConst as Const
+import threading
 import time
 
 
+_resource_monitor_instance = None
+_instance_lock = threading.Lock()
+
+
+def get_instance():
+    '''
+    process-wide ResourceMonitor, so that the libvirt connection and the
+    static resource info are shared by all requests
+    '''
+    global _resource_monitor_instance
+
+    if _resource_monitor_instance is None:
+        with _instance_lock:
+            if _resource_monitor_instance is None:
+                _resource_monitor_instance = ResourceMonitor()
+    return _resource_monitor_instance
+
+
+def terminate():
+    global _resource_monitor_instance
+
+    with _instance_lock:
+        if _resource_monitor_instance is not None:
+            _resource_monitor_instance.terminate()
+            _resource_monitor_instance = None
+
+
 class ResourceMonitorError(Exception):
     pass
 
 
 class ResourceMonitor(object):
+    LIBVIRT_URI = "qemu:///session"
+
     def __init__(self, openstack_stats=None, log=None):
         if log:
             self.log = log
@@ -32,17 +63,55 @@ class ResourceMonitor(object):
             self.log = open("/dev/null", "w+b")
         self.openstack_stats = None
         self.cpu_monitor = None
-        self.libvirt_conn = None
-        
+        self.conn = None
+        self.conn_lock = threading.Lock()
+        self.static_resource = None
+
         if openstack_stats:
             # OpenStack
             self.openstack_stats = openstack_stats
         else:
             # Stand-alone
-            self.conn = libvirt.open("qemu:///session")
+            with self.conn_lock:
+                self._connect()
             self.cpu_monitor = CPUMonitor()
 
+    def _connect(self):
+        if self.conn is None:
+            try:
+                self.conn = libvirt.open(ResourceMonitor.LIBVIRT_URI)
+            except libvirt.libvirtError as e:
+                self.log.write("failed to connect to %s: %s\n" % \
+                        (ResourceMonitor.LIBVIRT_URI, str(e)))
+                self.conn = None
+        return self.conn
+
+    def _call_libvirt(self, method_name, *args):
+        '''
+        call @method_name of the libvirt connection. Reconnect once if the
+        connection is broken. Return None if libvirt is not available.
+        '''
+        with self.conn_lock:
+            for retry in range(2):
+                conn = self._connect()
+                if conn is None:
+                    return None
+                try:
+                    return getattr(conn, method_name)(*args)
+                except libvirt.libvirtError as e:
+                    self.log.write("libvirt %s failed: %s\n" % \
+                            (method_name, str(e)))
+                    try:
+                        conn.close()
+                    except libvirt.libvirtError:
+                        pass
+                    self.conn = None
+        return None
+
     def get_static_resource(self):
+        if self.static_resource is not None:
+            return dict(self.static_resource)
+
         mem_total = 0
         number_total_cores = 0
         clock_speed = 0
@@ -52,9 +121,9 @@ class ResourceMonitor(object):
             mem_total = self.openstack_stats.get("memory_mb")
             clock_speed = -1
         else:
-            if not self.conn:
+            machine_info = self._call_libvirt("getInfo")
+            if not machine_info:
                 return dict()
-            machine_info = self.conn.getInfo()
             mem_total = machine_info[1]
             clock_speed = machine_info[3]
             number_socket = machine_info[5]
@@ -67,7 +136,9 @@ class ResourceMonitor(object):
                 Const.CLOCK_SPEED: float(clock_speed),
                 Const.TOTAL_MEM_MB: long(mem_total),
                 }
-        return info_dict
+        # the machine does not change while running
+        self.static_resource = info_dict
+        return dict(info_dict)
 
     def get_dynamic_resource(self):
         if self.openstack_stats:
@@ -77,10 +148,11 @@ class ResourceMonitor(object):
             free_memory = self.openstack_stats.get("free_ram_mb")
         else:
             cpu_usage = float(self.cpu_monitor.get_usage())
-            if self.conn:
-                memory_info = self.conn.getMemoryStats(-1, 0)
-                free_memory = memory_info['cached'] + memory_info['free']
-                free_memory = long(free_memory/1024)
+            memory_info = self._call_libvirt("getMemoryStats", -1, 0)
+            if memory_info is None:
+                memory_info = get_meminfo()
+            free_memory = memory_info['cached'] + memory_info['free']
+            free_memory = long(free_memory/1024)
         
         info_dict = {
                 Const.TOTAL_CPU_PERCENT: cpu_usage,
@@ -89,30 +161,141 @@ class ResourceMonitor(object):
         return info_dict
 
     def terminate(self):
-        pass
+        if self.cpu_monitor:
+            self.cpu_monitor.terminate()
+        with self.conn_lock:
+            if self.conn is not None:
+                try:
+                    self.conn.close()
+                except libvirt.libvirtError:
+                    pass
+                self.conn = None
 
 
-class CPUMonitor:
-    def __init__(self, interval=0.1, percentage=True):
+def get_meminfo():
+    '''
+    free and cached memory (KiB) from /proc/meminfo, in the keys of
+    libvirt getMemoryStats()
+    '''
+    memory_info = {'free': 0, 'cached': 0}
+    with open("/proc/meminfo", "r") as meminfo:
+        for line in meminfo:
+            name, value = line.split(":", 1)
+            if name == "MemFree":
+                memory_info['free'] = long(value.split()[0])
+            elif name == "Cached":
+                memory_info['cached'] = long(value.split()[0])
+    return memory_info
+
+
+class CPUMonitor(object):
+    '''
+    Sample /proc/stat in a background thread so that get_usage() returns
+    the latest utilization without waiting for a sampling interval.
+
+    Keeps the last HISTORY_SIZE samples of aggregate and per-CPU usage in
+    a ring buffer, and their exponentially weighted moving average.
+    '''
+    SAMPLE_INTERVAL = 1.0
+    HISTORY_SIZE = 60
+    EWMA_ALPHA = 0.3
+
+    def __init__(self, interval=SAMPLE_INTERVAL, history_size=HISTORY_SIZE,
+            ewma_alpha=EWMA_ALPHA):
         self.interval = interval
+        self.ewma_alpha = ewma_alpha
+        self.lock = threading.Lock()
+        self.history = collections.deque(maxlen=history_size)
+        self.usage = None           # (aggregate, [per cpu])
+        self.ewma = None            # (aggregate, [per cpu])
+        self.last_times = self.get_times()
+        self.stop_event = threading.Event()
+        self.sampler = threading.Thread(target=self._run)
+        self.sampler.daemon = True
+        self.sampler.start()
+
+    def get_times(self):
+        '''
+        return [(user, nice, system, idle)] of the aggregate and each cpu
+        '''
+        time_list = list()
+        with open("/proc/stat", "r") as stat:
+            for line in stat:
+                if not line.startswith("cpu"):
+                    break
+                time_list.append([int(value) for value in line.split()[1:5]])
+        return time_list
 
     def get_time(self):
-        stat = file("/proc/stat", "r")
-        time_list = stat.readline().split(" ")[2:6]
-        stat.close()
-        for index in range(len(time_list)):
-            time_list[index] = int(time_list[index])
-        return time_list 
-    
+        return self.get_times()[0]
+
+    @staticmethod
+    def _usage(before, after):
+        delta = [after[index] - before[index] for index in range(len(before))]
+        total = sum(delta)
+        if total <= 0:
+            return 0.0
+        return 100 - (delta[len(delta)-1]*100.00/total)
+
+    def _sample(self):
+        times = self.get_times()
+        usage_list = [CPUMonitor._usage(before, after) for (before, after)
+                in zip(self.last_times, times)]
+        self.last_times = times
+        usage = (usage_list[0], usage_list[1:])
+        with self.lock:
+            if self.ewma is None or len(self.ewma[1]) != len(usage[1]):
+                self.ewma = usage
+            else:
+                alpha = self.ewma_alpha
+                self.ewma = (alpha*usage[0] + (1-alpha)*self.ewma[0],
+                        [alpha*cur + (1-alpha)*prev for (cur, prev)
+                            in zip(usage[1], self.ewma[1])])
+            self.usage = usage
+            self.history.append((time.time(), usage[0], usage[1]))
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self._sample()
+            except (IOError, ValueError, IndexError):
+                pass
+
     def get_usage(self):
-        before = self.get_time()
-        time.sleep(self.interval)
-        after = self.get_time()
-        delta = list()
-        for index in range(len(before)):
-            delta.append(after[index] - before[index])
-        result= 100 - (delta[len(delta)-1]*100.00/sum(delta))
-        return result
+        '''
+        latest aggregate usage (%). Before the first sample, the average
+        since boot.
+        '''
+        usage = self.usage
+        if usage is None:
+            return CPUMonitor._usage([0]*4, self.last_times[0])
+        return usage[0]
+
+    def get_per_cpu_usage(self):
+        usage = self.usage
+        if usage is None:
+            return [CPUMonitor._usage([0]*4, times)
+                    for times in self.last_times[1:]]
+        return list(usage[1])
+
+    def get_average_usage(self):
+        '''
+        EWMA of aggregate usage (%)
+        '''
+        ewma = self.ewma
+        if ewma is None:
+            return self.get_usage()
+        return ewma[0]
+
+    def get_history(self):
+        '''
+        list of (timestamp, aggregate usage, [per cpu usage]), oldest first
+        '''
+        with self.lock:
+            return list(self.history)
+
+    def terminate(self):
+        self.stop_event.set()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,615 @@
+#!/usr/bin/env python
+#
+# Cloudlet Infrastructure for Mobile Computing
+#
+#   Copyright (C) 2011-2013 Carnegie Mellon University
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# Tests of the cache monitor
+#
+#   $ python -m unittest elijah.discovery.monitor.tests
+#
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+import multiprocessing
+
+import file_cache
+from block_cache import BlockCache
+from cache_state import CacheStateLog
+from file_cache import SortedPathSet
+from file_cache import _CacheMonitor
+from file_index import FileIndex
+from fusecache import AccessInfo
+from fusecache import LoopBack
+from fusecache import RECORD_HEADER
+from fusecache import unpack_records
+from interval_set import IntervalSet
+from warmup import WarmupError
+from warmup import WarmupJob
+from warmup import WarmupManager
+from web_cache import _WebCacheMonitor
+
+from ..config import DiscoveryConst
+
+try:
+    import glob2
+except ImportError:
+    glob2 = None
+
+
+class IntervalSetTest(unittest.TestCase):
+    def test_add_merges_overlapping_and_adjacent(self):
+        intervals = IntervalSet()
+        self.assertEqual(intervals.add(0, 10), 10)
+        self.assertEqual(intervals.add(20, 30), 10)
+        self.assertEqual(intervals.add(10, 20), 10)
+        self.assertEqual(list(intervals), [(0, 30)])
+        self.assertEqual(intervals.add(5, 35), 5)
+        self.assertEqual(intervals.add(5, 5), 0)
+        self.assertEqual(list(intervals), [(0, 35)])
+        self.assertEqual(intervals.covered, 35)
+
+    def test_remove_splits(self):
+        intervals = IntervalSet([(0, 10), (20, 30)])
+        self.assertEqual(intervals.remove(5, 25), 10)
+        self.assertEqual(list(intervals), [(0, 5), (25, 30)])
+        self.assertEqual(intervals.remove(10, 20), 0)
+        self.assertEqual(intervals.covered, 10)
+
+    def test_covered_in(self):
+        intervals = IntervalSet([(0, 10), (20, 30)])
+        self.assertEqual(intervals.covered_in(0, 100), 20)
+        self.assertEqual(intervals.covered_in(5, 25), 10)
+        self.assertEqual(intervals.covered_in(10, 20), 0)
+
+
+class FileIndexTest(unittest.TestCase):
+    PATHS = ["a.txt", "b.bin", ".hidden", "d/x.txt", "d/.y.txt",
+            "d/e/z.txt", "d/e/f/w.bin", "data1/v.txt", "data2/v.txt"]
+    # a trailing "**" of glob2 matches hidden files below the top directory
+    # but not in it; the index skips hidden files at any depth
+    PATTERNS = ["*.txt", "d/*.txt", "d/**/*.txt", "**/*.txt", "d/**",
+            "d/e/z.txt", "data?/*", "data[!1]/*", "*", "d/*/*"]
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        for path in self.PATHS:
+            abspath = os.path.join(self.root, path)
+            if not os.path.exists(os.path.dirname(abspath)):
+                os.makedirs(os.path.dirname(abspath))
+            open(abspath, "w").write(path)
+        self.index = FileIndex(self.root)
+        self.index.build()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _match(self, pattern):
+        return sorted([relpath for (relpath, size, inode)
+            in self.index.match(pattern)])
+
+    @unittest.skipIf(glob2 is None, "glob2 is not installed")
+    def test_patterns_match_glob2(self):
+        for pattern in self.PATTERNS:
+            expected = sorted([os.path.relpath(path, self.root) for path
+                in glob2.glob(os.path.join(self.root, pattern))
+                if os.path.isfile(path)])
+            self.assertEqual(self._match(pattern), expected, pattern)
+
+    def test_patterns(self):
+        self.assertEqual(self._match("*.txt"), ["a.txt"])
+        self.assertEqual(self._match("d/**/*.txt"), ["d/e/z.txt", "d/x.txt"])
+        self.assertEqual(self._match("data[!1]/*"), ["data2/v.txt"])
+        self.assertEqual(self._match("**"), ["a.txt", "b.bin", "d/e/f/w.bin",
+            "d/e/z.txt", "d/x.txt", "data1/v.txt", "data2/v.txt"])
+        self.assertEqual(self._match(os.path.join(self.root, "b.bin")),
+                ["b.bin"])
+
+    def test_sync(self):
+        generation = self.index.generation
+        os.rename(os.path.join(self.root, "d"), os.path.join(self.root, "g"))
+        self.index.sync(os.path.join(self.root, "d"))
+        self.index.sync(os.path.join(self.root, "g"))
+        self.assertEqual(self._match("d/**"), [])
+        self.assertEqual(self._match("g/**"),
+                ["g/e/f/w.bin", "g/e/z.txt", "g/x.txt"])
+        self.assertTrue(self.index.generation > generation)
+
+    def test_rebuild_keeps_generation(self):
+        generation = self.index.generation
+        self.index.build()
+        self.assertEqual(self.index.generation, generation)
+        open(os.path.join(self.root, "new.txt"), "w").close()
+        self.index.build()
+        self.assertEqual(self.index.generation, generation + 1)
+
+    def test_update_size(self):
+        generation = self.index.generation
+        self.index.update_size(os.path.join(self.root, "a.txt"), 1)
+        self.assertEqual(self.index.generation, generation)
+        self.index.update_size(os.path.join(self.root, "a.txt"), 100)
+        self.assertEqual(self.index.size_of(os.path.join(self.root, "a.txt")),
+                100)
+        self.assertEqual(self.index.generation, generation + 1)
+
+    def test_start_builds_in_thread(self):
+        index = FileIndex(self.root)
+        self.assertEqual(len(index), 0)
+        index.start()
+        try:
+            self.assertTrue(index.built.wait(5))
+            self.assertEqual(len(index), len(self.index))
+        finally:
+            index.terminate()
+
+
+class CacheStateLogTest(unittest.TestCase):
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.path = os.path.join(self.dirname, "cache-state.log")
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def test_latest_record_wins(self):
+        state = CacheStateLog(self.path)
+        state.append([(1, "/a", 1.5, 100, [(0, 10)]),
+            (2, "/b", 2.5, 200, [(0, 20)])])
+        state.append([(1, "/a", 1.5, 100, [(0, 50)]), (2, "", 0, 0, [])])
+        state.close()
+        self.assertEqual(CacheStateLog(self.path).load(),
+                {1: ("/a", 1.5, 100, [(0, 50)])})
+
+    def test_torn_tail(self):
+        state = CacheStateLog(self.path)
+        state.append([(1, "/a", 1.5, 100, [(0, 10)])])
+        state.close()
+        record = CacheStateLog.pack_entry(2, "/b", 2.5, 200, [(0, 20)])
+        with open(self.path, "ab") as log_file:
+            log_file.write(record[:len(record)-3])
+        self.assertEqual(CacheStateLog(self.path).load(),
+                {1: ("/a", 1.5, 100, [(0, 10)])})
+
+    def test_compact(self):
+        state = CacheStateLog(self.path)
+        for index in xrange(10):
+            state.append([(1, "/a", 1.5, 100, [(0, index+1)])])
+        state.compact([(1, "/a", 1.5, 100, [(0, 10)])])
+        state.append([(2, "/b", 2.5, 200, [(0, 20)])])
+        state.close()
+        self.assertEqual(os.path.getsize(self.path), state.log_size)
+        self.assertEqual(CacheStateLog(self.path).load(),
+                {1: ("/a", 1.5, 100, [(0, 10)]),
+                    2: ("/b", 2.5, 200, [(0, 20)])})
+        self.assertFalse(os.path.exists(self.path + ".tmp"))
+
+
+class AccessRecordTest(unittest.TestCase):
+    def _pack(self, cmd, inode, offset, length, path):
+        return RECORD_HEADER.pack(AccessInfo.CMD_CODES[cmd], inode, offset,
+                length, len(path)) + path
+
+    def test_unpack_records(self):
+        records = [(AccessInfo.CMD_OPEN, 7, 0, 0, "/dfs/a"),
+                (AccessInfo.CMD_READ, 7, 4096, 131072, ""),
+                (AccessInfo.CMD_RENAME, 0, 0, 0, "/dfs/a\0/dfs/b"),
+                (AccessInfo.CMD_EVICT, 7, 1 << 20, 1 << 20, "")]
+        data = "".join([self._pack(*record) for record in records])
+        self.assertEqual(list(unpack_records(data)), records)
+
+
+class WebCacheMonitorTest(unittest.TestCase):
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.path = os.path.join(self.dirname, "store.log")
+        self.monitor = _WebCacheMonitor(self.path)
+
+    def tearDown(self):
+        if self.monitor.log_file is not None:
+            self.monitor.log_file.close()
+        shutil.rmtree(self.dirname)
+
+    def _line(self, action, url, size, method="GET", swap_file="0000001A"):
+        return "1400000000.000 %s 00 %s 0123456789ABCDEF 200 " \
+                "1400000000 -1 -1 text/html %d/%d %s %s\n" % \
+                (action, swap_file, size, size, method, url)
+
+    def _write(self, lines, mode="a", path=None):
+        with open(path or self.path, mode) as log_file:
+            log_file.write("".join(lines))
+
+    def test_parse(self):
+        self._write([self._line("SWAPOUT", "http://a/", 100),
+            self._line("SWAPOUT", "http://b/", 200),
+            self._line("SWAPOUT", "http://p/", 300, method="POST"),
+            self._line("SWAPIN", "http://a/", 100),
+            self._line("RELEASE", "http://b/", 200),
+            "incomplete"])
+        self.monitor.poll()
+        self.assertEqual(self.monitor.lookup("http://a/"), (100, "hit"))
+        self.assertEqual(sorted(self.monitor.urls), ["http://a/"])
+        self.assertEqual(self.monitor.check_urls(["http://a/", "http://c/"]),
+                (100, 200, ["http://a/"], ["http://c/"]))
+
+    def test_release_of_another_swap_file(self):
+        self._write([self._line("SWAPOUT", "http://a/", 100),
+            # e.g. a response that was never stored
+            self._line("RELEASE", "http://a/", 100, swap_file="FFFFFFFF")])
+        self.monitor.poll()
+        self.assertEqual(self.monitor.lookup("http://a/"), (100, "stored"))
+        self._write([self._line("RELEASE", "http://a/", 100)])
+        self.monitor.poll()
+        self.assertEqual(self.monitor.lookup("http://a/"), None)
+
+    def test_rotation(self):
+        self._write([self._line("SWAPOUT", "http://a/", 100)])
+        self.monitor.poll()
+        # lines written to the old log before squid reopens it are read
+        os.rename(self.path, self.path + ".0")
+        self._write([self._line("SWAPOUT", "http://b/", 100)],
+                path=self.path + ".0")
+        self._write([self._line("SWAPOUT", "http://c/", 100)], mode="w")
+        self.monitor.poll()
+        self.assertEqual(sorted(self.monitor.urls),
+                ["http://a/", "http://b/", "http://c/"])
+
+    def test_truncate_and_grow(self):
+        self._write([self._line("SWAPOUT", "http://a/", 100)])
+        self.monitor.poll()
+        # truncated in place, and grown past the old offset before the poll
+        self._write([self._line("SWAPOUT", "http://b/", 100),
+            self._line("RELEASE", "http://a/", 100)], mode="w")
+        self.monitor.poll()
+        self.assertEqual(sorted(self.monitor.urls), ["http://b/"])
+
+
+class BlockCacheTest(unittest.TestCase):
+    CHUNK_SIZE = 4096
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.cache = self._open()
+
+    def tearDown(self):
+        if self.cache is not None:
+            self.cache.close()
+        shutil.rmtree(self.dirname)
+
+    def _open(self, slot_count=4):
+        return BlockCache(self.dirname, slot_count*self.CHUNK_SIZE,
+                chunk_size=self.CHUNK_SIZE)
+
+    def _data(self, inode, chunk):
+        return ("%d:%d:" % (inode, chunk)).ljust(self.CHUNK_SIZE, "x")
+
+    def test_get_put(self):
+        self.assertEqual(self.cache.get(1, 1.0, 0), None)
+        self.cache.put(1, 1.0, 0, self._data(1, 0))
+        self.assertEqual(self.cache.get(1, 1.0, 0), self._data(1, 0))
+        self.assertEqual(self.cache.get(1, 1.0, 0, 2, 3), self._data(1, 0)[2:5])
+        # another mtime
+        self.assertEqual(self.cache.get(1, 2.0, 0), None)
+
+    def test_lru_eviction(self):
+        for chunk in xrange(4):
+            self.assertEqual(self.cache.put(1, 1.0, chunk,
+                self._data(1, chunk)), [])
+        self.cache.get(1, 1.0, 0)
+        self.assertEqual(self.cache.put(2, 1.0, 0, self._data(2, 0)),
+                [(1, 1, self.CHUNK_SIZE)])
+        self.assertEqual(self.cache.get(1, 1.0, 1), None)
+        self.assertEqual(self.cache.get(1, 1.0, 0), self._data(1, 0))
+
+    def test_pinned_chunks_are_kept(self):
+        for chunk in xrange(4):
+            self.cache.put(1, 1.0, chunk, self._data(1, chunk))
+        self.cache.pin(1)
+        self.assertEqual(self.cache.put(2, 1.0, 0, self._data(2, 0)), [])
+        self.assertEqual(self.cache.get(2, 1.0, 0), None)
+        self.cache.unpin(1)
+        self.assertEqual(len(self.cache.put(2, 1.0, 0, self._data(2, 0))), 1)
+
+    def test_validate(self):
+        self.cache.put(1, 1.0, 0, self._data(1, 0))
+        self.cache.put(1, 1.0, 1, self._data(1, 1))
+        self.assertEqual(self.cache.validate(1, 1.0), [])
+        self.assertEqual(sorted(self.cache.validate(1, 2.0)),
+                [(1, 0, self.CHUNK_SIZE), (1, 1, self.CHUNK_SIZE)])
+        self.assertEqual(self.cache.get(1, 1.0, 0), None)
+
+    def test_modified(self):
+        for chunk in xrange(3):
+            self.cache.put(1, 1.0, chunk, self._data(1, chunk))
+        self.cache.put(1, 1.0, 3, self._data(1, 3)[:100])
+        # the partial chunk at the end of file is dropped too
+        self.assertEqual(sorted(self.cache.modified(1, 2.0, 1, 1)),
+                [(1, 1, self.CHUNK_SIZE), (1, 3, 100)])
+        self.assertEqual(self.cache.get(1, 2.0, 0), self._data(1, 0))
+        self.assertEqual(self.cache.get(1, 2.0, 1), None)
+        self.assertEqual(self.cache.validate(1, 2.0), [])
+        self.assertEqual(self.cache.modified(1, 3.0, 2),
+                [(1, 2, self.CHUNK_SIZE)])
+        self.assertEqual(self.cache.get(1, 3.0, 0), self._data(1, 0))
+
+    def test_reopen(self):
+        self.cache.put(1, 1.0, 0, self._data(1, 0))
+        self.cache.close()
+        self.cache = self._open()
+        self.assertEqual(self.cache.get(1, 1.0, 0), self._data(1, 0))
+
+    def test_read_chunks(self):
+        self.cache.put(1, 1.0, 2, self._data(1, 2)[:100])
+        self.assertEqual(BlockCache.read_chunks(self.dirname,
+            4*self.CHUNK_SIZE, self.CHUNK_SIZE), None)
+        self.cache.close()
+        self.cache = None
+        self.assertEqual(BlockCache.read_chunks(self.dirname,
+            4*self.CHUNK_SIZE, self.CHUNK_SIZE),
+            {1: [(1.0, 2*self.CHUNK_SIZE, 2*self.CHUNK_SIZE + 100)]})
+
+    def test_unclean_reopen_is_emptied(self):
+        self.cache.put(1, 1.0, 0, self._data(1, 0))
+        # not closed, as after a crash
+        self.cache.index.flush()
+        cache = self._open()
+        try:
+            self.assertEqual(cache.get(1, 1.0, 0), None)
+        finally:
+            cache.close()
+
+
+class SortedPathSetTest(unittest.TestCase):
+    def setUp(self):
+        self.paths = SortedPathSet()
+        for path in ["b/2", "a/1", "b/1", "c", "b/3", "bb"]:
+            self.paths.add(path)
+
+    def test_cursor(self):
+        self.assertEqual(self.paths.page(limit=2), ["a/1", "b/1"])
+        self.assertEqual(self.paths.page(cursor="b/1", limit=2),
+                ["b/2", "b/3"])
+        self.assertEqual(self.paths.page(cursor="b/3"), ["bb", "c"])
+        self.assertEqual(self.paths.page(cursor="c"), [])
+
+    def test_prefix(self):
+        self.assertEqual(self.paths.page("b/"), ["b/1", "b/2", "b/3"])
+        self.assertEqual(self.paths.page("b/", cursor="b/1", limit=1),
+                ["b/2"])
+
+    def test_counted_remove(self):
+        self.paths.add("c")
+        self.paths.remove("c")
+        self.assertIn("c", self.paths.page())
+        self.paths.remove("c")
+        self.assertNotIn("c", self.paths.page())
+        self.assertEqual(len(self.paths), 5)
+
+
+class CacheMonitorTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.root, "d"))
+        for path in ["a", "b", "d/x"]:
+            open(os.path.join(self.root, path), "w").write("x"*8192)
+        (self.access_conn, sender) = multiprocessing.Pipe(duplex=False)
+        self.monitor = _CacheMonitor(self.access_conn, self.root)
+        self.monitor.file_index.built.wait(5)
+        self.inodes = dict()
+        for path in ["a", "b", "d/x"]:
+            self.inodes[path] = self._read(path)
+
+    def tearDown(self):
+        self.monitor.file_index.terminate()
+        self.access_conn.close()
+        shutil.rmtree(self.root)
+
+    def _record(self, cmd, inode=0, offset=0, length=0, path=""):
+        self.monitor._process_record(cmd, inode, offset, length, path)
+
+    def _read(self, path):
+        abspath = os.path.join(self.root, path)
+        inode = os.stat(abspath).st_ino
+        self._record(AccessInfo.CMD_OPEN, inode, path=abspath)
+        self._record(AccessInfo.CMD_READ, inode, 0, 4096)
+        self._record(AccessInfo.CMD_CLOSE, inode, path=abspath)
+        return inode
+
+    def test_evicted_file_is_not_listed(self):
+        self._record(AccessInfo.CMD_EVICT, self.inodes["a"], 0, 1024)
+        self.assertIn("a", self.monitor.cached_files())
+        self._record(AccessInfo.CMD_EVICT, self.inodes["a"], 0, 4096)
+        self.assertEqual(self.monitor.cached_files(), ["b", "d/x"])
+        self.assertFalse(self.monitor.check_inode(self.inodes["a"]))
+
+    def test_app_scores_list_most_cached_files(self):
+        self._record(AccessInfo.CMD_READ, self.inodes["b"], 4096, 4096)
+        self._record(AccessInfo.CMD_EVICT, self.inodes["d/x"], 0, 1024)
+        self.assertEqual(self.monitor.app_scores.get(["**"], 2),
+                (4096 + 8192 + 3072, 3*8192, ["a", "b"], 3))
+        self.assertEqual(self.monitor.app_scores.get(["**"])[2:],
+                (["a", "b", "d/x"], 3))
+
+    def test_unlinked_file_is_not_listed(self):
+        abspath = os.path.join(self.root, "b")
+        os.unlink(abspath)
+        self._record(AccessInfo.CMD_UNLINK, path=abspath)
+        self.assertEqual(self.monitor.cached_files(), ["a", "d/x"])
+
+    def test_rename(self):
+        old_path = os.path.join(self.root, "d")
+        new_path = os.path.join(self.root, "e")
+        os.rename(old_path, new_path)
+        self._record(AccessInfo.CMD_RENAME, path=old_path + "\0" + new_path)
+        self.assertEqual(self.monitor.cached_files(), ["a", "b", "e/x"])
+        # replaces a cached file
+        old_path = os.path.join(self.root, "e/x")
+        new_path = os.path.join(self.root, "a")
+        os.rename(old_path, new_path)
+        self._record(AccessInfo.CMD_RENAME, path=old_path + "\0" + new_path)
+        self.assertEqual(self.monitor.cached_files(), ["a", "b"])
+        self.assertFalse(self.monitor.check_inode(self.inodes["a"]))
+        self.assertTrue(self.monitor.check_inode(self.inodes["d/x"]))
+
+
+class WarmupTest(unittest.TestCase):
+    class _Monitor(object):
+        def match_files(self, pattern):
+            return list()
+
+    def test_progress_of_files_and_urls(self):
+        job = WarmupJob("1", [("a", 100)], ["http://u/"])
+        job.add_bytes("a", 50, 100)
+        self.assertEqual(job.to_dict()["progress"], 0.25)
+        job.finish_item("a")
+        # the size of a URL is known once its response starts
+        job.add_total(200)
+        job.add_bytes("http://u/", 100, 200)
+        status = job.to_dict()
+        self.assertEqual(status["progress"], 0.75)
+        self.assertEqual(status["total_bytes"], 300)
+        job.finish_item("http://u/", error=IOError())
+        self.assertEqual(job.to_dict()["progress"], 1.0)
+
+    def test_max_jobs(self):
+        manager = WarmupManager(self._Monitor(), "/", workers=0)
+        manager.MAX_JOBS = 2
+        jobs = [manager.submit([], ["http://u/"]) for count in xrange(2)]
+        self.assertRaises(WarmupError, manager.submit, [], ["http://u/"])
+        jobs[0].finish_item("http://u/")
+        manager.submit([], ["http://u/"])
+        self.assertEqual(manager.get(jobs[0].job_id), None)
+
+
+class _LoopBackProcess(object):
+    '''
+    stands for the FuseLauncher, which closes the block cache when it is
+    unmounted
+    '''
+    def __init__(self, block_cache, access_conn):
+        self.block_cache = block_cache
+        self.access_conn = access_conn
+
+    def terminate(self):
+        self.block_cache.close()
+        self.access_conn.close()
+
+
+class CacheRestartTest(unittest.TestCase):
+    CHUNK_SIZE = 4096
+    CAPACITY = 16*CHUNK_SIZE
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.root = os.path.join(self.dirname, "dfs")
+        os.mkdir(self.root)
+        self.path = os.path.join(self.root, "a")
+        open(self.path, "w").write("x"*(3*self.CHUNK_SIZE))
+        self.inode = os.stat(self.path).st_ino
+        self.cache_dir = os.path.join(self.dirname, "block-cache")
+        self.state_path = os.path.join(self.dirname, "cache-state.log")
+        self.geometry = (DiscoveryConst.BLOCK_CACHE_CAPACITY,
+                DiscoveryConst.BLOCK_CACHE_CHUNK_SIZE)
+        DiscoveryConst.BLOCK_CACHE_CAPACITY = self.CAPACITY
+        DiscoveryConst.BLOCK_CACHE_CHUNK_SIZE = self.CHUNK_SIZE
+
+    def tearDown(self):
+        (DiscoveryConst.BLOCK_CACHE_CAPACITY,
+                DiscoveryConst.BLOCK_CACHE_CHUNK_SIZE) = self.geometry
+        file_cache.terminate()
+        shutil.rmtree(self.dirname)
+
+    def _monitor(self):
+        (access_reader, access_writer) = multiprocessing.Pipe(duplex=False)
+        monitor = file_cache._CacheMonitor(access_reader, self.root,
+                state_path=self.state_path, block_cache_dir=self.cache_dir)
+        return monitor, access_writer
+
+    def _start(self):
+        monitor, access_writer = self._monitor()
+        block_cache = BlockCache(self.cache_dir, self.CAPACITY,
+                self.CHUNK_SIZE)
+        loopback = LoopBack(self.root, access_writer, block_cache=block_cache)
+        file_cache._cache_monitor_instance = monitor
+        file_cache._fuse_instance = _LoopBackProcess(block_cache,
+                access_writer)
+        monitor.start()
+        return monitor, loopback
+
+    def _read(self, loopback, length):
+        fh = loopback.open("/a", os.O_RDONLY)
+        loopback.read("/a", length, 0, fh)
+        loopback.release("/a", fh)
+
+    def _wait_resident(self, monitor, size):
+        for count in xrange(100):
+            if monitor.resident_bytes(self.inode, 3*self.CHUNK_SIZE) == size:
+                return
+            time.sleep(0.05)
+        self.fail("records are not processed")
+
+    def test_residency_survives_restart(self):
+        monitor, loopback = self._start()
+        self._read(loopback, 2*self.CHUNK_SIZE)
+        self._wait_resident(monitor, 2*self.CHUNK_SIZE)
+        file_cache.terminate()
+        self.assertFalse(monitor.is_alive())
+
+        monitor, access_writer = self._monitor()
+        try:
+            self.assertEqual(monitor.resident_bytes(self.inode,
+                3*self.CHUNK_SIZE), 2*self.CHUNK_SIZE)
+            self.assertEqual(monitor.cached_files(), ["a"])
+        finally:
+            monitor.file_index.terminate()
+            monitor.cache_state.close()
+
+    def test_write_keeps_other_chunks(self):
+        monitor, loopback = self._start()
+        self._read(loopback, 3*self.CHUNK_SIZE)
+        self._wait_resident(monitor, 3*self.CHUNK_SIZE)
+        fh = loopback.open("/a", os.O_RDWR)
+        loopback.write("/a", "y", self.CHUNK_SIZE + 1, fh)
+        self._wait_resident(monitor, 2*self.CHUNK_SIZE)
+        data = loopback.read("/a", 3*self.CHUNK_SIZE, 0, fh)
+        loopback.release("/a", fh)
+        self.assertEqual(data[self.CHUNK_SIZE:self.CHUNK_SIZE + 3], "xyx")
+        block_cache = loopback.block_cache
+        self.assertEqual(sorted(block_cache.inode_chunks[self.inode]),
+                [0, 1, 2])
+        self.assertEqual(loopback.open_inodes, {})
+
+    def test_state_log_after_crash(self):
+        monitor, loopback = self._start()
+        self._read(loopback, 2*self.CHUNK_SIZE)
+        self._wait_resident(monitor, 2*self.CHUNK_SIZE)
+        # the block cache is left open, as after a crash
+        monitor.terminate()
+        monitor.join()
+        file_cache._cache_monitor_instance = None
+        file_cache._fuse_instance = None
+
+        monitor, access_writer = self._monitor()
+        try:
+            self.assertEqual(monitor.resident_bytes(self.inode,
+                3*self.CHUNK_SIZE), 2*self.CHUNK_SIZE)
+        finally:
+            monitor.file_index.terminate()
+            monitor.cache_state.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
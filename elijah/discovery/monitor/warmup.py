@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+#
+# Cloudlet Infrastructure for Mobile Computing
+#
+#   Copyright (C) 2011-2013 Carnegie Mellon University
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+
+import os
+import time
+import Queue
+import urllib2
+import httplib
+import threading
+import itertools
+from collections import OrderedDict
+
+import ResourceConst as Const
+from ..log import logging
+
+
+LOG = logging.getLogger(__name__)
+
+
+class WarmupError(Exception):
+    pass
+
+
+class TokenBucket(object):
+    '''
+    Limit the rate to @rate bytes per second, allowing bursts of @burst
+    bytes. No limit if @rate is None.
+    '''
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self, amount):
+        '''
+        block until @amount bytes may be transferred
+        '''
+        if self.rate is None:
+            return
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst,
+                    self.tokens + (now - self.updated)*self.rate)
+            self.updated = now
+            # go into debt, and let the next caller wait for it
+            self.tokens -= amount
+            wait_time = -self.tokens/self.rate if self.tokens < 0 else 0
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+
+class WarmupJob(object):
+    '''
+    Progress of warming up @file_list and @url_list.
+
+    The total bytes include the size of a URL once its response starts.
+    Progress is the fraction of the items done, with the items in progress
+    counted by their bytes done, so that it does not depend on the URL
+    sizes that are not known yet.
+    '''
+    STATE_QUEUED = "queued"
+    STATE_RUNNING = "running"
+    STATE_DONE = "done"
+
+    def __init__(self, job_id, file_list, url_list, bandwidth=None):
+        self.job_id = job_id
+        self.file_list = file_list      # [(relpath, size)]
+        self.url_list = url_list
+        self.bucket = TokenBucket(bandwidth)
+        self.lock = threading.Lock()
+        self.state = WarmupJob.STATE_QUEUED
+        self.remaining = len(file_list) + len(url_list)
+        self.total_bytes = sum([size for (relpath, size) in file_list])
+        self.done_bytes = 0
+        self.done_items = 0
+        self.item_progress = dict()     # item:fraction done
+        self.failed_items = list()
+        self.created_time = time.time()
+        self.started_time = None
+        self.finished_time = None
+        if self.remaining == 0:
+            self.state = WarmupJob.STATE_DONE
+            self.finished_time = self.created_time
+
+    def start_item(self):
+        with self.lock:
+            if self.state == WarmupJob.STATE_QUEUED:
+                self.state = WarmupJob.STATE_RUNNING
+                self.started_time = time.time()
+
+    def add_total(self, size):
+        with self.lock:
+            self.total_bytes += size
+
+    def add_bytes(self, item, size, item_size=None):
+        with self.lock:
+            self.done_bytes += size
+            if item_size:
+                self.item_progress[item] = min(1.0,
+                        self.item_progress.get(item, 0) + float(size)/item_size)
+
+    def finish_item(self, item, error=None):
+        with self.lock:
+            if error is None:
+                self.done_items += 1
+            else:
+                self.failed_items.append(item)
+            self.item_progress.pop(item, None)
+            self.remaining -= 1
+            if self.remaining == 0:
+                self.state = WarmupJob.STATE_DONE
+                self.finished_time = time.time()
+
+    def to_dict(self):
+        with self.lock:
+            total_items = len(self.file_list) + len(self.url_list)
+            progress = 1.0
+            if total_items > 0:
+                progress = (total_items - self.remaining +
+                        sum(self.item_progress.itervalues(), 0.0))/total_items
+            return {
+                    Const.WARMUP_JOB_ID: self.job_id,
+                    Const.WARMUP_STATE: self.state,
+                    Const.WARMUP_PROGRESS: progress,
+                    Const.WARMUP_TOTAL_ITEMS: total_items,
+                    Const.WARMUP_DONE_ITEMS: self.done_items,
+                    Const.WARMUP_FAILED_ITEMS: list(self.failed_items),
+                    Const.WARMUP_TOTAL_BYTES: self.total_bytes,
+                    Const.WARMUP_DONE_BYTES: self.done_bytes,
+                    Const.WARMUP_CREATED_TIME: self.created_time,
+                    Const.WARMUP_FINISHED_TIME: self.finished_time,
+                    }
+
+
+class WarmupManager(object):
+    '''
+    Read files and URLs ahead of an expected client on a pool of @workers
+    threads, so that they are cached when the client arrives.
+
+    Files are read through the loopback at @mount_root, where the cache
+    monitor sees the reads. URLs are fetched through @http_proxy, the
+    HTTP cache of the cloudlet, and a URL that does not respond for
+    @http_timeout seconds fails. The total rate is limited to @bandwidth
+    bytes per second, and a job can be limited further. Up to MAX_JOBS
+    jobs are kept for their status; the oldest finished job is forgotten
+    for a new one, and a new job is refused if none has finished.
+    '''
+    WORKERS = 2
+    HTTP_TIMEOUT = 30
+    BLOCK_SIZE = 1024*1024
+    MAX_JOBS = 64
+
+    def __init__(self, cache_monitor, mount_root, bandwidth=None,
+            workers=WORKERS, http_proxy=None, http_timeout=HTTP_TIMEOUT):
+        self.cache_monitor = cache_monitor
+        self.mount_root = mount_root
+        self.bucket = TokenBucket(bandwidth)
+        self.http_proxy = http_proxy
+        self.http_timeout = http_timeout
+        self.lock = threading.Lock()
+        self.jobs = OrderedDict()   # job_id:WarmupJob
+        self.job_ids = itertools.count(1)
+        self.queue = Queue.Queue()
+        self.threads = list()
+        for index in xrange(workers):
+            thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, filepattern_list, url_list, bandwidth=None):
+        '''
+        queue the files matching @filepattern_list and the @url_list, and
+        return the new WarmupJob. Raise WarmupError if MAX_JOBS jobs are
+        not finished yet.
+        '''
+        with self.lock:
+            self._make_room()
+        file_dict = dict()
+        for pattern in filepattern_list:
+            for (relpath, size, inode) in \
+                    self.cache_monitor.match_files(pattern):
+                file_dict[relpath] = size
+        job = WarmupJob(str(self.job_ids.next()), sorted(file_dict.items()),
+                list(url_list), bandwidth)
+        with self.lock:
+            # another job may have been submitted meanwhile
+            self._make_room()
+            self.jobs[job.job_id] = job
+        for (relpath, size) in job.file_list:
+            self.queue.put((job, self._warm_file, relpath))
+        for url in job.url_list:
+            self.queue.put((job, self._warm_url, url))
+        LOG.info("[CACHE] warmup job %s: %d files (%d bytes), %d URLs" % \
+                (job.job_id, len(job.file_list), job.total_bytes,
+                    len(job.url_list)))
+        return job
+
+    def _make_room(self):
+        # forget the oldest finished jobs
+        for (job_id, job) in self.jobs.items():
+            if len(self.jobs) < self.MAX_JOBS:
+                return
+            if job.state == WarmupJob.STATE_DONE:
+                del self.jobs[job_id]
+        if len(self.jobs) >= self.MAX_JOBS:
+            raise WarmupError("%d warmup jobs are in progress" % \
+                    len(self.jobs))
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id, None)
+
+    def job_list(self):
+        with self.lock:
+            return self.jobs.values()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            (job, warm, target) = item
+            job.start_item()
+            error = None
+            try:
+                warm(job, target)
+            except (IOError, OSError, ValueError, httplib.HTTPException) as e:
+                LOG.warning("[CACHE] failed to warm up %s: %s" % (target, str(e)))
+                error = e
+            except Exception as e:
+                # keep the worker alive for the next item
+                LOG.error("[CACHE] failed to warm up %s: %s" % (target, str(e)))
+                error = e
+            finally:
+                # the job is done only when all of its items are finished
+                job.finish_item(target, error=error)
+
+    def _consume(self, job, size):
+        job.bucket.consume(size)
+        self.bucket.consume(size)
+
+    def _warm_file(self, job, relpath):
+        with open(os.path.join(self.mount_root, relpath), "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            while True:
+                self._consume(job, self.BLOCK_SIZE)
+                data = f.read(self.BLOCK_SIZE)
+                if len(data) == 0:
+                    break
+                job.add_bytes(relpath, len(data), size)
+
+    def _warm_url(self, job, url):
+        handlers = list()
+        if self.http_proxy is not None:
+            handlers.append(urllib2.ProxyHandler({"http": self.http_proxy}))
+        response = urllib2.build_opener(*handlers).open(url,
+                timeout=self.http_timeout)
+        try:
+            size = None
+            length = response.info().getheader("Content-Length")
+            if length is not None and length.isdigit():
+                size = int(length)
+                job.add_total(size)
+            while True:
+                self._consume(job, self.BLOCK_SIZE)
+                data = response.read(self.BLOCK_SIZE)
+                if len(data) == 0:
+                    break
+                if size is None:
+                    # counted as it arrives
+                    job.add_total(len(data))
+                job.add_bytes(url, len(data), size)
+        finally:
+            response.close()
+
+    def terminate(self):
+        for thread in self.threads:
+            self.queue.put(None)
@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+#
+# Cloudlet Infrastructure for Mobile Computing
+#
+#   Copyright (C) 2011-2013 Carnegie Mellon University
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+
+import os
+import threading
+
+from ..config import DiscoveryConst as DiscoveryConst
+from ..log import logging
+
+
+LOG = logging.getLogger(__name__)
+
+
+_web_cache_monitor_instance = None
+
+
+def get_instance():
+    global _web_cache_monitor_instance
+
+    if _web_cache_monitor_instance is None:
+        LOG.info("[CACHE] start HTTP cache monitoring of %s" % \
+                DiscoveryConst.SQUID_LOG_FILE)
+        _web_cache_monitor_instance = _WebCacheMonitor(
+                DiscoveryConst.SQUID_LOG_FILE)
+        _web_cache_monitor_instance.start()
+    return _web_cache_monitor_instance
+
+
+def terminate():
+    global _web_cache_monitor_instance
+
+    if _web_cache_monitor_instance is not None:
+        _web_cache_monitor_instance.terminate()
+        _web_cache_monitor_instance = None
+
+
+class WebCacheMonitorError(Exception):
+    pass
+
+
+class _WebCacheMonitor(threading.Thread):
+    '''
+    Index of the objects in the squid disk cache, URL to (size, state,
+    swap file), kept from the squid store.log. A URL is removed when its
+    own swap file is released, and not when another copy of it is, e.g.
+    an object that was never stored or a replaced one.
+
+    The log is read from the start and then followed every POLL_PERIOD
+    seconds from the last offset. When the log is rotated, i.e. the path
+    has a new inode, the rest of the old file is read before following the
+    new one. A log truncated in place is read again from the start; it is
+    noticed by its size, or by its first HEAD_SIZE bytes when it has
+    grown past the last offset again since the last poll.
+    '''
+    POLL_PERIOD = 1.0
+    READ_SIZE = 1024*1024
+    HEAD_SIZE = 512
+    # estimated size of an object whose length is not known
+    DEFAULT_OBJECT_SIZE = 64*1024
+
+    # store.log actions
+    ACTION_SWAPOUT = "SWAPOUT"
+    ACTION_SWAPIN = "SWAPIN"
+    ACTION_RELEASE = "RELEASE"
+    ACTION_SO_FAIL = "SO_FAIL"
+
+    # state of a URL
+    STATE_STORED = "stored"     # written to the disk cache
+    STATE_HIT = "hit"           # read back from the disk cache
+
+    def __init__(self, log_path, poll_period=POLL_PERIOD):
+        log_dir = os.path.dirname(os.path.abspath(log_path))
+        if os.path.isdir(log_dir) is False:
+            msg = "Failed to setup HTTP cache monitoring at %s\n" % log_path
+            msg += "Please install squid or change SQUID_LOG_FILE at "
+            msg += "elijah/discovery/config.py"
+            raise WebCacheMonitorError(msg)
+        self.log_path = log_path
+        self.poll_period = poll_period
+        self.stop = threading.Event()
+        self.urls = dict()          # URL:(size, state, swap file)
+        self.total_size = 0         # of the objects in self.urls
+        self.log_file = None
+        self.log_inode = None
+        self.log_head = ""          # first bytes of the log
+        self.offset = 0
+        self.partial_line = ""
+        threading.Thread.__init__(self, target=self.process)
+        self.daemon = True
+
+    def process(self):
+        while not self.stop.is_set():
+            try:
+                self.poll()
+            except (IOError, OSError) as e:
+                LOG.warning("[CACHE] failed to read %s: %s" % \
+                        (self.log_path, str(e)))
+            self.stop.wait(self.poll_period)
+        if self.log_file is not None:
+            self.log_file.close()
+
+    def poll(self):
+        '''
+        read the lines added to the log since the last poll
+        '''
+        if self.log_file is not None and self._read_head() != self.log_head:
+            LOG.info("[CACHE] %s is truncated" % self.log_path)
+            self._rewind()
+        if self.log_file is not None:
+            self._read()
+        try:
+            st = os.stat(self.log_path)
+        except OSError:
+            # rotated, and the new log is not created yet
+            return
+        if self.log_file is not None and st.st_ino == self.log_inode and \
+                st.st_size >= self.offset:
+            return
+
+        if self.log_file is not None and st.st_ino == self.log_inode:
+            LOG.info("[CACHE] %s is truncated" % self.log_path)
+        else:
+            if self.log_file is not None:
+                LOG.info("[CACHE] %s is rotated" % self.log_path)
+                self.log_file.close()
+            self.log_file = open(self.log_path, "rb")
+            self.log_inode = os.fstat(self.log_file.fileno()).st_ino
+        self._rewind()
+        self._read()
+
+    def _read_head(self):
+        position = self.log_file.tell()
+        self.log_file.seek(0)
+        head = self.log_file.read(len(self.log_head))
+        self.log_file.seek(position)
+        return head
+
+    def _rewind(self):
+        self.log_file.seek(0)
+        self.offset = 0
+        self.partial_line = ""
+        self.log_head = ""
+
+    def _read(self):
+        while True:
+            data = self.log_file.read(self.READ_SIZE)
+            if len(data) == 0:
+                break
+            if len(self.log_head) < self.HEAD_SIZE:
+                self.log_head += data[:self.HEAD_SIZE-len(self.log_head)]
+            self.offset += len(data)
+            lines = (self.partial_line + data).split("\n")
+            # the last line may not be complete yet
+            self.partial_line = lines.pop()
+            for line in lines:
+                self._process_line(line)
+
+    def _process_line(self, line):
+        # time action dir file hash status date lastmod expires type
+        # expected-length/real-length method URL
+        fields = line.split()
+        if len(fields) < 5:
+            return
+        action, url = fields[1], fields[-1]
+        # cache_dir and file number of the swap file
+        swap_file = (fields[2], fields[3])
+        if action == self.ACTION_SWAPOUT or action == self.ACTION_SWAPIN:
+            if fields[-2] != "GET":
+                return
+            size = 0
+            length = fields[-3].split("/")[-1]
+            if length.isdigit():
+                size = int(length)
+            state = self.STATE_STORED
+            if action == self.ACTION_SWAPIN:
+                state = self.STATE_HIT
+            old_entry = self.urls.get(url, None)
+            if old_entry is not None:
+                self.total_size -= old_entry[0]
+            self.urls[url] = (size, state, swap_file)
+            self.total_size += size
+        elif action == self.ACTION_RELEASE or action == self.ACTION_SO_FAIL:
+            old_entry = self.urls.get(url, None)
+            if old_entry is not None and old_entry[2] == swap_file:
+                del self.urls[url]
+                self.total_size -= old_entry[0]
+
+    def lookup(self, url):
+        '''
+        return (size, state) of a cached @url, or None
+        '''
+        entry = self.urls.get(url, None)
+        if entry is None:
+            return None
+        return entry[:2]
+
+    def check_urls(self, url_list):
+        '''
+        return (cached bytes, total bytes, list of cached URLs, list of
+        URLs whose size is estimated) of @url_list. The size of a URL that
+        is not cached, or whose length was not logged, is estimated by the
+        mean size of cached objects.
+        '''
+        urls = self.urls
+        object_count = len(urls)
+        mean_size = self.DEFAULT_OBJECT_SIZE
+        if object_count > 0 and self.total_size > 0:
+            mean_size = self.total_size/object_count
+        cached_urls = list()
+        estimated_urls = list()
+        cached_bytes = total_bytes = 0
+        for url in url_list:
+            entry = urls.get(url, None)
+            size = mean_size
+            if entry is not None and entry[0] > 0:
+                size = entry[0]
+            else:
+                estimated_urls.append(url)
+            if entry is not None:
+                cached_urls.append(url)
+                cached_bytes += size
+            total_bytes += size
+        return cached_bytes, total_bytes, cached_urls, estimated_urls
+
+    def terminate(self):
+        self.stop.set()
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+#
+# Load test of the registration server with a synthetic cloudlet fleet
+#
+#   $ python bench_registry.py --cloudlets 20000 --requests 5000
+#   $ python bench_registry.py --rate 200 --duration 60 --search-ratio 0.5
+#
+# The database (sqlite, see registerAPI/settings_bench.py) is seeded with
+# random cloudlets, IP geolocation is served from a generated fixture
+# instead of the MaxMind DB, and search, heartbeat and status update (PUT)
+# requests are sent through the Django test client or to a running server
+# given by --url. The fixture only replaces the geolocation of this process,
+# so searches sent to a running server carry explicit latitude/longitude.
+#
+
+import os
+import sys
+import time
+import json
+import random
+import socket
+import struct
+import httplib
+import argparse
+from urlparse import urlparse
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "registerAPI.settings_bench")
+
+import django
+from django.core.management import call_command
+from django.db import connection
+from django.test.client import Client
+from django.test.utils import CaptureQueriesContext
+from django.utils.timezone import now
+
+
+SEARCH_URL = "/api/v1/Cloudlet/search/"
+HEARTBEAT_URL = "/api/v1/Cloudlet/%d/heartbeat/"
+CLOUDLET_URL = "/api/v1/Cloudlet/%d/"
+FEATURES = "vm-synthesis-app"
+
+
+class FixtureIPLocation(object):
+    '''
+    IPLocation replacement that answers from a generated IP:location table
+    '''
+    def __init__(self, location_dict):
+        self.location_dict = location_dict
+
+    def ip2location(self, ip_address):
+        from cloudlet.network.ip_location import Location
+        latitude, longitude = self.location_dict.get(ip_address, (0.0, 0.0))
+        return Location({'ip_address': ip_address,
+            'latitude': latitude, 'longitude': longitude})
+
+
+def random_location(rand):
+    return (rand.uniform(-60.0, 70.0), rand.uniform(-180.0, 180.0))
+
+
+def random_ip(rand):
+    return socket.inet_ntoa(struct.pack("!I", rand.randint(0x01000000, 0xdfffffff)))
+
+
+def random_meta(rand):
+    return {
+        "total_cpu_num": rand.choice([2, 4, 8, 16, 32]),
+        "total_mem_mb": rand.choice([4096, 8192, 16384, 65536]),
+        "cpu_clock_speed_mhz": float(rand.choice([2400, 2600, 3200])),
+        "total_cpu_usage_percent": rand.uniform(0, 100),
+        "total_free_memory_mb": rand.randint(512, 4096),
+        }
+
+
+def setup_database():
+    if hasattr(django, 'setup'):
+        django.setup()
+        call_command('migrate', interactive=False, verbosity=0)
+    else:
+        call_command('syncdb', interactive=False, verbosity=0)
+
+
+def seed_cloudlets(count, rand):
+    from cloudlet.models import Cloudlet, parse_meta
+    Cloudlet.objects.all().delete()
+    batch = list()
+    cur_time = now()
+    for index in xrange(count):
+        latitude, longitude = random_location(rand)
+        meta = repr(random_meta(rand))
+        batch.append(Cloudlet(ip_address=random_ip(rand),
+            features=FEATURES, rest_api_port=8022,
+            rest_api_url="/api/v1/resource/",
+            status=Cloudlet.CLOUDLET_STATUS_RUNNING,
+            pub_date=cur_time, mod_time=cur_time,
+            latitude="%.6f" % latitude, longitude="%.6f" % longitude,
+            geo_latitude=latitude, geo_longitude=longitude,
+            meta=meta, meta_json=json.dumps(parse_meta(meta))))
+        if len(batch) == 500:
+            Cloudlet.objects.bulk_create(batch)
+            batch = list()
+    if len(batch) > 0:
+        Cloudlet.objects.bulk_create(batch)
+    return list(Cloudlet.objects.values_list('id', flat=True))
+
+
+class TestClientDriver(object):
+    def __init__(self):
+        self.client = Client()
+
+    def request(self, method, path, params=None, body=None):
+        with CaptureQueriesContext(connection) as queries:
+            if method == "GET":
+                response = self.client.get(path, params)
+            elif method == "PUT":
+                response = self.client.put(path, body,
+                        content_type="application/json")
+            else:
+                response = self.client.post(path, body,
+                        content_type="application/json")
+        return response.status_code, len(queries)
+
+
+class HTTPDriver(object):
+    def __init__(self, url):
+        end_point = urlparse(url)
+        self.conn = httplib.HTTPConnection(end_point.hostname,
+                end_point.port or 80, timeout=10)
+
+    def request(self, method, path, params=None, body=None):
+        if params:
+            path = "%s?%s" % (path, "&".join(["%s=%s" % item
+                for item in params.iteritems()]))
+        headers = {"Content-type": "application/json"}
+        self.conn.request(method, path, body, headers)
+        response = self.conn.getresponse()
+        response.read()
+        return response.status, None
+
+
+def percentile(sorted_list, ratio):
+    if len(sorted_list) == 0:
+        return 0.0
+    index = min(len(sorted_list)-1, int(round(ratio*(len(sorted_list)-1))))
+    return sorted_list[index]
+
+
+def report(stats, elapsed):
+    total = sum([len(stat['latency']) for stat in stats.values()])
+    print "%-10s %8s %10s %10s %10s %10s %8s" % ("request", "count",
+            "p50(ms)", "p99(ms)", "mean(ms)", "queries", "errors")
+    for (name, stat) in sorted(stats.items()):
+        latency = sorted(stat['latency'])
+        if len(latency) == 0:
+            continue
+        queries = "-"
+        if len(stat['queries']) > 0:
+            queries = "%.2f" % (float(sum(stat['queries']))/len(stat['queries']))
+        print "%-10s %8d %10.2f %10.2f %10.2f %10s %8d" % (name, len(latency),
+                percentile(latency, 0.50)*1000, percentile(latency, 0.99)*1000,
+                sum(latency)/len(latency)*1000, queries, stat['errors'])
+    print "total %d requests in %.2f s: %.1f req/s" % (total, elapsed,
+            total/elapsed if elapsed > 0 else 0.0)
+
+
+def process_command_line(argv):
+    parser = argparse.ArgumentParser(description="Registry load test")
+    parser.add_argument('--cloudlets', type=int, default=10000,
+            help="number of synthetic cloudlets")
+    parser.add_argument('--clients', type=int, default=1000,
+            help="number of client IP addresses in the geolocation fixture")
+    parser.add_argument('--requests', type=int, default=2000,
+            help="number of requests to send")
+    parser.add_argument('--duration', type=float, default=None,
+            help="send requests for this many seconds instead of --requests")
+    parser.add_argument('--rate', type=float, default=0,
+            help="target requests per second (0 for as fast as possible)")
+    parser.add_argument('--search-ratio', type=float, default=0.5,
+            help="fraction of search requests")
+    parser.add_argument('--update-ratio', type=float, default=0.1,
+            help="fraction of status updates sent as a full PUT, the rest "
+            "are heartbeats")
+    parser.add_argument('--count', type=int, default=5,
+            help="number of cloudlets per search")
+    parser.add_argument('--url', default=None,
+            help="send requests to a running server (e.g. http://127.0.0.1:8020) "
+            "instead of the Django test client")
+    parser.add_argument('--no-seed', action='store_true',
+            help="reuse cloudlets in the existing database")
+    parser.add_argument('--seed', type=int, default=0, help="random seed")
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    settings = process_command_line(argv[1:])
+    rand = random.Random(settings.seed)
+
+    setup_database()
+    from cloudlet import api
+    from cloudlet.models import Cloudlet
+    if settings.no_seed:
+        cloudlet_ids = list(Cloudlet.objects.values_list('id', flat=True))
+    else:
+        start_time = time.time()
+        cloudlet_ids = seed_cloudlets(settings.cloudlets, rand)
+        print "seeded %d cloudlets in %.2f s" % (len(cloudlet_ids),
+                time.time()-start_time)
+    if len(cloudlet_ids) == 0:
+        sys.stderr.write("No cloudlet in the database\n")
+        return 1
+
+    client_locations = dict()
+    for index in xrange(settings.clients):
+        client_locations[random_ip(rand)] = random_location(rand)
+    client_ips = client_locations.keys()
+
+    if settings.url:
+        driver = HTTPDriver(settings.url)
+    else:
+        api.cost = FixtureIPLocation(client_locations)
+        driver = TestClientDriver()
+
+    stats = dict()
+    for name in ("search", "heartbeat", "update"):
+        stats[name] = {'latency': list(), 'queries': list(), 'errors': 0}
+    start_time = time.time()
+    sent = 0
+    while True:
+        if settings.duration is not None:
+            if time.time() - start_time >= settings.duration:
+                break
+        elif sent >= settings.requests:
+            break
+        if settings.rate > 0:
+            wait_time = start_time + sent/settings.rate - time.time()
+            if wait_time > 0:
+                time.sleep(wait_time)
+
+        if rand.random() < settings.search_ratio:
+            name = "search"
+            client_ip = rand.choice(client_ips)
+            params = {'n': settings.count}
+            if settings.url:
+                # the server does not know the fixture
+                latitude, longitude = client_locations[client_ip]
+                params['latitude'] = "%.6f" % latitude
+                params['longitude'] = "%.6f" % longitude
+            else:
+                params['client_ip'] = client_ip
+            request_start = time.time()
+            status, queries = driver.request("GET", SEARCH_URL, params=params)
+        elif rand.random() < settings.update_ratio:
+            # the status update PUT of elijah/discovery/ds_register.py
+            name = "update"
+            body = json.dumps({'status': "RUN", 'features': FEATURES,
+                'meta': random_meta(rand)})
+            request_start = time.time()
+            status, queries = driver.request("PUT",
+                    CLOUDLET_URL % rand.choice(cloudlet_ids), body=body)
+        else:
+            name = "heartbeat"
+            body = json.dumps({'meta': random_meta(rand)})
+            request_start = time.time()
+            status, queries = driver.request("POST",
+                    HEARTBEAT_URL % rand.choice(cloudlet_ids), body=body)
+        stats[name]['latency'].append(time.time() - request_start)
+        if queries is not None:
+            stats[name]['queries'].append(queries)
+        if status >= 400:
+            stats[name]['errors'] += 1
+        sent += 1
+
+    elapsed = time.time() - start_time
+    api.write_buffer.flush()
+    report(stats, elapsed)
+    return 0
+
+
+if __name__ == "__main__":
+    status = main(sys.argv)
+    sys.exit(status)
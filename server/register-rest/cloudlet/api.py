@@ -1,44 +1,133 @@
 from django.utils.timezone import utc
 from django.utils.timezone import now
-import heapq
+import calendar
+import json
 import socket 
-from operator import itemgetter
+import time
 from tastypie.authorization import Authorization
 from .models import Cloudlet
+from .models import parse_meta
 from tastypie.resources import ModelResource, ALL, ALL_WITH_RELATIONS
 from django.conf.urls import *
 from tastypie.utils import trailing_slash
+from tastypie import http
+from django.conf import settings
 
-from django.core.serializers import json
-from django.utils import simplejson
+from django.core.serializers.json import DjangoJSONEncoder
 from tastypie.serializers import Serializer
+try:
+    import msgpack
+except ImportError as e:
+    msgpack = None
 from network import ip_location
+from geo_index import GeoGridIndex
+from write_behind import WriteBehindBuffer
+from search_cache import SearchCache
+from snapshot import RegistrySnapshot
+from pubsub import get_pubsub
+from django.http import HttpResponse
 from django.db.models.signals import post_save
+from django.db.models.signals import post_delete
 
 cost = ip_location.IPLocation()
+cloudlet_index = GeoGridIndex(rebuild_period=settings.CLOUDLET_INDEX_REBUILD_PERIOD)
+write_buffer = WriteBehindBuffer(Cloudlet, settings.CLOUDLET_WRITE_BEHIND_PERIOD,
+        version_field='mod_time')
+search_cache = SearchCache(cloudlet_index, settings.CLOUDLET_SEARCH_CACHE_TIMEOUT)
+snapshot = RegistrySnapshot(cloudlet_index, search_cache,
+        get_pubsub(settings.CLOUDLET_PUBSUB))
 
 
-class PrettyJSONSerializer(Serializer):
+def _epoch(mod_time):
+    return calendar.timegm(mod_time.utctimetuple()) + \
+            mod_time.microsecond/1000000.0
+
+
+def _coordinate_or_default(value, default):
+    if value is None:
+        return default
+    return value
+
+
+def _index_cloudlet(cloudlet):
+    if cloudlet.status != Cloudlet.CLOUDLET_STATUS_RUNNING:
+        snapshot.remove(cloudlet.pk)
+        return
+    latitude = _coordinate_or_default(cloudlet.geo_latitude,
+            CloudletResource.DEFAULT_LATITUDE)
+    longitude = _coordinate_or_default(cloudlet.geo_longitude,
+            CloudletResource.DEFAULT_LONGITUDE)
+    snapshot.upsert(cloudlet.pk, latitude, longitude, cloudlet.search_out(),
+            _epoch(cloudlet.mod_time))
+
+
+def _read_running_cloudlets():
+    # write pending updates first so that the table is the latest
+    write_buffer.flush()
+    # read plain rows to avoid building a model object per cloudlet
+    running = Cloudlet.objects.filter(
+            status=Cloudlet.CLOUDLET_STATUS_RUNNING).values(
+                    'id', 'geo_latitude', 'geo_longitude',
+                    *Cloudlet.SEARCH_FIELDS)
+    return [(values['id'],
+        _coordinate_or_default(values['geo_latitude'],
+            CloudletResource.DEFAULT_LATITUDE),
+        _coordinate_or_default(values['geo_longitude'],
+            CloudletResource.DEFAULT_LONGITUDE),
+        Cloudlet.to_search_record(values), _epoch(values['mod_time']))
+        for values in running]
+
+
+def _load_cloudlet_index():
+    snapshot.rebuild(_read_running_cloudlets)
+
+
+class RegistrySerializer(Serializer):
+    '''
+    Compact JSON by default, indented JSON with ?pretty=1, and msgpack with
+    ?format=msgpack or "Accept: application/x-msgpack"
+    '''
     json_indent = 2
+    formats = ['json', 'xml', 'yaml', 'html', 'plist']
+    if msgpack is not None:
+        formats.insert(1, 'msgpack')
+    content_types = dict(Serializer.content_types)
+    content_types['msgpack'] = 'application/x-msgpack'
+
     def to_json(self, data, options=None):
         options = options or {}
         data = self.to_simple(data, options)
-        return simplejson.dumps(data, cls=json.DjangoJSONEncoder,
-                sort_keys=True, ensure_ascii=False, indent=self.json_indent)
+        if options.get('pretty', False):
+            return json.dumps(data, cls=DjangoJSONEncoder, sort_keys=True,
+                    ensure_ascii=False, indent=self.json_indent)
+        # without indent and sort_keys, the C encoder is used
+        return json.dumps(data, cls=DjangoJSONEncoder, ensure_ascii=False,
+                separators=(',', ':'))
+
+    def to_msgpack(self, data, options=None):
+        options = options or {}
+        return msgpack.packb(self.to_simple(data, options))
+
+    def from_msgpack(self, content):
+        return msgpack.unpackb(content)
 
 
 class CloudletResource(ModelResource):
     DEFAULT_LATITUDE = 00.000000
     DEFAULT_LONGITUDE = 00.000000
+    # a PUT that keeps these fields of a running cloudlet is a status update
+    LOCATION_FIELDS = ('status', 'ip_address', 'latitude', 'longitude',
+            'rest_api_port', 'rest_api_url', 'features')
 
     class Meta:
-        serializer = PrettyJSONSerializer()
+        serializer = RegistrySerializer()
         authorization = Authorization()
         always_return_data = True
         queryset = Cloudlet.objects.all()
         resource_name = 'Cloudlet'
         list_allowed_methods = ['get', 'post', 'put', 'delete']
-        excludes = ['pub_date', 'mod_time', 'id']
+        excludes = ['pub_date', 'mod_time', 'id', 'geo_latitude',
+                'geo_longitude', 'meta_json']
         filtering = {"mod_time":ALL, "status":ALL, "ip_address":ALL,
                 "latitude":ALL, "longitude":ALL, "rest_api_port":ALL}
 
@@ -52,23 +141,69 @@ class CloudletResource(ModelResource):
         '''
         called for POST, UPDATE
         '''
-        cloudlet_ip = bundle.request.META.get("REMOTE_ADDR")
-        if cloudlet_ip == "127.0.0.1":
-            import socket
-            cloudlet_ip = socket.gethostbyname(socket.gethostname())
-
-        # find location of cloudlet
-        location = cost.ip2location(cloudlet_ip)
-        # in python 2.6, you cannot directly convert float to Decimal
-        if bundle.obj.longitude is None or len(bundle.obj.longitude) == 0:
-            bundle.obj.longitude = str(location.longitude).strip()
-        if bundle.obj.latitude is None or len(bundle.obj.latitude) == 0:
-            bundle.obj.latitude = str(location.latitude).strip()
+        # this is called before fields are hydrated, so bundle.obj still
+        # has the stored values for UPDATE
+        if bundle.obj.pk is not None:
+            bundle.stored_values = dict((field_name, getattr(bundle.obj, field_name))
+                    for field_name in CloudletResource.LOCATION_FIELDS)
+
+        if bundle.obj.longitude is None or len(bundle.obj.longitude) == 0 or \
+                bundle.obj.latitude is None or len(bundle.obj.latitude) == 0:
+            cloudlet_ip = bundle.request.META.get("REMOTE_ADDR")
+            if cloudlet_ip == "127.0.0.1":
+                import socket
+                cloudlet_ip = socket.gethostbyname(socket.gethostname())
+
+            # find location of cloudlet
+            location = cost.ip2location(cloudlet_ip)
+            # in python 2.6, you cannot directly convert float to Decimal
+            if bundle.obj.longitude is None or len(bundle.obj.longitude) == 0:
+                bundle.obj.longitude = str(location.longitude).strip()
+            if bundle.obj.latitude is None or len(bundle.obj.latitude) == 0:
+                bundle.obj.latitude = str(location.latitude).strip()
 
         # record Cloudlet's ip address
         bundle.obj.mod_time = now()
         return bundle
 
+    def save(self, bundle, skip_errors=False):
+        '''
+        updates that only refresh mod_time and meta of a running cloudlet
+        are written behind in bulk
+        '''
+        if self._is_status_update(bundle):
+            self.is_valid(bundle)
+            if not bundle.errors:
+                self.authorized_update_detail(
+                        self.get_object_list(bundle.request), bundle)
+                cloudlet = bundle.obj
+                meta_dict = parse_meta(cloudlet.meta)
+                cloudlet.meta_json = json.dumps(meta_dict, default=str)
+                record_update = {'mod_time': cloudlet.mod_time}
+                record_update.update(meta_dict)
+                if snapshot.touch(cloudlet.pk, _epoch(cloudlet.mod_time),
+                        record_update):
+                    write_buffer.add(cloudlet.pk, {
+                        'mod_time': cloudlet.mod_time,
+                        'meta': cloudlet.meta,
+                        'meta_json': cloudlet.meta_json,
+                        })
+                    return bundle
+        if bundle.obj.pk is not None:
+            write_buffer.discard(bundle.obj.pk)
+        return super(CloudletResource, self).save(bundle, skip_errors=skip_errors)
+
+    def _is_status_update(self, bundle):
+        stored_values = getattr(bundle, 'stored_values', None)
+        if stored_values is None:
+            return False
+        if stored_values['status'] != Cloudlet.CLOUDLET_STATUS_RUNNING:
+            return False
+        for (field_name, value) in stored_values.iteritems():
+            if getattr(bundle.obj, field_name) != value:
+                return False
+        return True
+
     def dehydrate(self, bundle):
         '''
         called for POST, UPDATE, GET
@@ -80,7 +215,46 @@ class CloudletResource(ModelResource):
     def prepend_urls(self):
         return [url(r"^(?P<resource_name>%s)/search%s$" %
                 (self._meta.resource_name, trailing_slash()),
-                self.wrap_view('get_search'), name="api_get_search"), ]
+                self.wrap_view('get_search'), name="api_get_search"),
+                url(r"^(?P<resource_name>%s)/(?P<pk>\d+)/heartbeat%s$" %
+                (self._meta.resource_name, trailing_slash()),
+                self.wrap_view('post_heartbeat'), name="api_post_heartbeat"), ]
+
+    def post_heartbeat(self, request, **kwargs):
+        '''
+        refresh mod_time and meta of a running cloudlet without a full PUT
+        '''
+        self.method_check(request, allowed=['post', 'put'])
+        self.is_authenticated(request)
+        self.throttle_check(request)
+
+        data = dict()
+        if request.body:
+            data = self.deserialize(request, request.body,
+                    format=request.META.get('CONTENT_TYPE', 'application/json'))
+        mod_time = now()
+        update_fields = {'mod_time': mod_time}
+        record_update = {'mod_time': mod_time}
+        meta = data.get('meta', None)
+        if meta is not None:
+            meta_dict = parse_meta(meta)
+            update_fields['meta'] = str(meta)
+            update_fields['meta_json'] = json.dumps(meta_dict, default=str)
+            record_update.update(meta_dict)
+
+        pk = int(kwargs['pk'])
+        self.log_throttled_access(request)
+        if snapshot.touch(pk, _epoch(mod_time), record_update):
+            write_buffer.add(pk, update_fields)
+            return http.HttpNoContent()
+
+        # not in the index of this worker yet
+        updated = Cloudlet.objects.filter(pk=pk,
+                status=Cloudlet.CLOUDLET_STATUS_RUNNING).update(**update_fields)
+        if updated == 0:
+            # unknown or terminated cloudlet needs to register again
+            return http.HttpNotFound()
+        return http.HttpNoContent()
 
     def get_search(self, request, **kwargs):
         self.method_check(request, allowed=['get'])
@@ -101,26 +275,48 @@ class CloudletResource(ModelResource):
                     CloudletResource.DEFAULT_LATITUDE)
             longitude = getattr(client_location, 'longitude', \
                     CloudletResource.DEFAULT_LONGITUDE)
-        cloudlet_list = list()
-        for cloudlet in Cloudlet.objects.all():
-            if cloudlet.status != Cloudlet.CLOUDLET_STATUS_RUNNING:
-                continue
-            if len(cloudlet.latitude) is 0:
-                cloudlet.latitude = str(CloudletResource.DEFAULT_LATITUDE)
-            if len(cloudlet.longitude) is 0:
-                cloudlet.longitude = str(CloudletResource.DEFAULT_LONGITUDE)
-            geo_distance = ip_location.geo_distance(latitude, longitude, \
-                    float(cloudlet.latitude), float(cloudlet.longitude))
-            cloudlet.cost = geo_distance
-            cloudlet_list.append(cloudlet)
-
-        top_cloudlets = heapq.nsmallest(SEARCH_COUNT, cloudlet_list, key=itemgetter('cost'))
-        top_cloudlet_list = [item.search_out() for item in top_cloudlets]
+        # serialized response of a nearby query
+        variant = self.determine_format(request)
+        if self._is_pretty(request):
+            variant += ";pretty"
+        cached_response, cache_keys = None, None
+        if 'callback' not in request.GET:
+            cached_response, cache_keys = search_cache.get(latitude, longitude,
+                    SEARCH_COUNT, variant)
+        if cached_response is not None:
+            self.log_throttled_access(request)
+            content_type, content = cached_response
+            return HttpResponse(content=content, content_type=content_type)
+
+        if snapshot.is_expired():
+            _load_cloudlet_index()
+        min_heartbeat = None
+        if settings.CLOUDLET_HEARTBEAT_TTL:
+            min_heartbeat = time.time() - settings.CLOUDLET_HEARTBEAT_TTL
+        top_cloudlets = snapshot.search(latitude, longitude,
+                SEARCH_COUNT, min_heartbeat)
+        top_cloudlet_list = [record for (distance, record) in top_cloudlets]
         object_list = {
             'cloudlet' : top_cloudlet_list
         }
         self.log_throttled_access(request)
-        return self.create_response(request, object_list)
+        response = self.create_response(request, object_list)
+
+        max_distance = None
+        if len(top_cloudlets) == SEARCH_COUNT and SEARCH_COUNT > 0:
+            max_distance = top_cloudlets[-1][0]
+        search_cache.set(cache_keys, latitude, max_distance,
+                (response['Content-Type'], response.content))
+        return response
+
+    def serialize(self, request, data, format, options=None):
+        options = options or {}
+        options['pretty'] = self._is_pretty(request)
+        return super(CloudletResource, self).serialize(request, data, format,
+                options)
+
+    def _is_pretty(self, request):
+        return request.GET.get('pretty', '0').lower() in ('1', 'true', 'yes')
 
     def _is_ip(self, ip_address):
         try:
@@ -131,13 +327,19 @@ class CloudletResource(ModelResource):
 
 
 def post_save_signal(sender, **kwargs):
-    pass
-    '''
     cloudlet = kwargs.get('instance', None)
-    if (not cloudlet) or (not redis):
+    if cloudlet is None:
         return
-    redis.set(cloudlet.ip_address, (cloudlet.latitude, cloudlet.longitude))
-    '''
+    _index_cloudlet(cloudlet)
+
+
+def post_delete_signal(sender, **kwargs):
+    cloudlet = kwargs.get('instance', None)
+    if cloudlet is None:
+        return
+    write_buffer.discard(cloudlet.pk)
+    snapshot.remove(cloudlet.pk)
 
 post_save.connect(post_save_signal, sender=Cloudlet)
+post_delete.connect(post_delete_signal, sender=Cloudlet)
 
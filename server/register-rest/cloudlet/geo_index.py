@@ -0,0 +1,254 @@
+import math
+import threading
+import time
+
+import numpy
+
+from network import ip_location
+
+
+EARTH_RADIUS = 6371 # km
+
+
+def ring_distance_bound(latitude, ring, cell_degree):
+    '''
+    lower bound (km) of the distance between a point and any cell that is
+    at least @ring cells away from the cell containing the point.
+    '''
+    if ring <= 1:
+        return 0.0
+    delta = math.radians(min((ring-1)*cell_degree, 180.0))
+    # cells that differ in latitude index
+    lat_bound = EARTH_RADIUS * delta
+    # cells that differ in longitude index: distance to a meridian
+    # that is delta away is asin(cos(lat)*sin(delta))
+    sin_delta = math.sin(min(delta, math.pi/2))
+    lon_bound = EARTH_RADIUS * math.asin(
+            min(1.0, math.cos(math.radians(latitude))*sin_delta))
+    return min(lat_bound, lon_bound)
+
+
+class GeoGridIndex(object):
+    '''
+    Spatial index of running cloudlets on an equirectangular lat/lon grid.
+
+    Each cloudlet is hashed to a grid cell. A nearest-neighbor query scans
+    rings of cells around the query point and stops as soon as the n-th
+    best distance found so far is smaller than the lower bound of the next
+    ring, so only the neighborhood of the query is evaluated.
+
+    Coordinates are kept column-oriented in contiguous float64 arrays
+    together with the search record of each cloudlet, so a search never
+    touches the database. The last heartbeat time of each cloudlet is kept
+    in another column so that searches can skip silent cloudlets.
+    '''
+    CELL_DEGREE = 1.0
+    # re-read the table periodically to pick up writes in other workers
+    REBUILD_PERIOD = 60
+    INITIAL_CAPACITY = 1024
+
+    def __init__(self, cell_degree=CELL_DEGREE, rebuild_period=REBUILD_PERIOD):
+        self.cell_degree = float(cell_degree)
+        self.rebuild_period = rebuild_period
+        self.lat_cells = int(math.ceil(180.0/self.cell_degree))
+        self.lon_cells = int(math.ceil(360.0/self.cell_degree))
+        self.lock = threading.RLock()
+        self.loaded_time = None
+        self.clear()
+
+    def __len__(self):
+        return len(self.cloudlet_ids)
+
+    def cell_of(self, latitude, longitude):
+        lat_index = int((latitude + 90.0)/self.cell_degree)
+        lat_index = max(0, min(self.lat_cells-1, lat_index))
+        lon_index = int((longitude + 180.0)/self.cell_degree) % self.lon_cells
+        return (lat_index, lon_index)
+
+    def _grow(self):
+        size = len(self.cloudlet_ids)
+        capacity = max(GeoGridIndex.INITIAL_CAPACITY, 2*len(self.latitudes))
+        for name in ('latitudes', 'longitudes', 'heartbeats'):
+            column = numpy.zeros(capacity, dtype=numpy.float64)
+            column[:size] = getattr(self, name)[:size]
+            setattr(self, name, column)
+
+    def add(self, cloudlet_id, latitude, longitude, record=None,
+            heartbeat=None):
+        if heartbeat is None:
+            heartbeat = time.time()
+        with self.lock:
+            self.remove(cloudlet_id)
+            row = len(self.cloudlet_ids)
+            if row == len(self.latitudes):
+                self._grow()
+            cell = self.cell_of(latitude, longitude)
+            self.latitudes[row] = latitude
+            self.longitudes[row] = longitude
+            self.heartbeats[row] = heartbeat
+            self.cloudlet_ids.append(cloudlet_id)
+            self.records.append(record)
+            self.cell_list.append(cell)
+            self.rows[cloudlet_id] = row
+            self.cells.setdefault(cell, set()).add(cloudlet_id)
+
+    def remove(self, cloudlet_id):
+        with self.lock:
+            row = self.rows.pop(cloudlet_id, None)
+            if row is None:
+                return
+            members = self.cells.get(self.cell_list[row])
+            members.discard(cloudlet_id)
+            if len(members) == 0:
+                del self.cells[self.cell_list[row]]
+
+            # move the last row into the hole
+            last = len(self.cloudlet_ids) - 1
+            if row != last:
+                self.latitudes[row] = self.latitudes[last]
+                self.longitudes[row] = self.longitudes[last]
+                self.heartbeats[row] = self.heartbeats[last]
+                self.cloudlet_ids[row] = self.cloudlet_ids[last]
+                self.records[row] = self.records[last]
+                self.cell_list[row] = self.cell_list[last]
+                self.rows[self.cloudlet_ids[row]] = row
+            self.cloudlet_ids.pop()
+            self.records.pop()
+            self.cell_list.pop()
+
+    def clear(self):
+        with self.lock:
+            self.cells = dict()         # cell:set(cloudlet_id)
+            self.rows = dict()          # cloudlet_id:row
+            self.cloudlet_ids = list()
+            self.records = list()
+            self.cell_list = list()
+            self.latitudes = numpy.zeros(0, dtype=numpy.float64)
+            self.longitudes = numpy.zeros(0, dtype=numpy.float64)
+            self.heartbeats = numpy.zeros(0, dtype=numpy.float64)
+
+    def touch(self, cloudlet_id, heartbeat, record_update=None):
+        '''
+        refresh heartbeat time and update the search record in place.
+        return False if the cloudlet is not in the index
+        '''
+        with self.lock:
+            row = self.rows.get(cloudlet_id, None)
+            if row is None:
+                return False
+            self.heartbeats[row] = heartbeat
+            if record_update:
+                record = dict(self.records[row] or {})
+                record.update(record_update)
+                self.records[row] = record
+            return True
+
+    def get_record(self, cloudlet_id):
+        with self.lock:
+            row = self.rows.get(cloudlet_id, None)
+            if row is None:
+                return None
+            return self.records[row]
+
+    def is_expired(self):
+        if self.loaded_time is None:
+            return True
+        return (time.time() - self.loaded_time) > self.rebuild_period
+
+    def load(self, point_list):
+        '''
+        replace the index content with @point_list of
+        (cloudlet_id, latitude, longitude, record, heartbeat)
+        '''
+        with self.lock:
+            self.clear()
+            for (cloudlet_id, latitude, longitude, record, heartbeat) in \
+                    point_list:
+                self.add(cloudlet_id, latitude, longitude, record, heartbeat)
+            self.loaded_time = time.time()
+
+    def _ring(self, center, ring):
+        lat_index, lon_index = center
+        if ring == 0:
+            yield center
+            return
+        for dlat in xrange(-ring, ring+1):
+            cur_lat = lat_index + dlat
+            if cur_lat < 0 or cur_lat >= self.lat_cells:
+                continue
+            if abs(dlat) == ring:
+                dlon_list = xrange(-ring, ring+1)
+            else:
+                dlon_list = (-ring, ring)
+            for dlon in dlon_list:
+                yield (cur_lat, (lon_index + dlon) % self.lon_cells)
+
+    def _nearest_rows(self, latitude, longitude, count, min_heartbeat=None):
+        if count <= 0 or len(self.cloudlet_ids) == 0:
+            return list(), numpy.zeros(0)
+        center = self.cell_of(latitude, longitude)
+        max_ring = max(self.lat_cells, self.lon_cells//2 + 1)
+        visited = set()
+        evaluated = 0
+        candidate_rows = list()
+        distances = numpy.zeros(0)
+        for ring in xrange(0, max_ring+1):
+            if evaluated == len(self.cloudlet_ids):
+                break
+            if len(candidate_rows) >= count:
+                worst = numpy.partition(distances, count-1)[count-1]
+                if worst <= ring_distance_bound(latitude, ring,
+                        self.cell_degree):
+                    break
+            ring_rows = list()
+            for cell in self._ring(center, ring):
+                if cell in visited:
+                    continue
+                visited.add(cell)
+                for cloudlet_id in self.cells.get(cell, ()):
+                    ring_rows.append(self.rows[cloudlet_id])
+            evaluated += len(ring_rows)
+            if min_heartbeat is not None and len(ring_rows) > 0:
+                alive = self.heartbeats[ring_rows] >= min_heartbeat
+                ring_rows = [row for (row, is_alive) in \
+                        zip(ring_rows, alive) if is_alive]
+            if len(ring_rows) == 0:
+                continue
+            ring_distances = ip_location.geo_distance_batch(latitude,
+                    longitude, self.latitudes[ring_rows],
+                    self.longitudes[ring_rows])
+            candidate_rows += ring_rows
+            distances = numpy.concatenate((distances, ring_distances))
+
+        top = ip_location.nearest_indices(distances, count)
+        return [candidate_rows[index] for index in top], distances[top]
+
+    def nearest(self, latitude, longitude, count, min_heartbeat=None):
+        '''
+        return list of (distance, cloudlet_id) for the @count closest
+        cloudlets whose last heartbeat is not older than @min_heartbeat,
+        sorted by distance
+        '''
+        with self.lock:
+            rows, distances = self._nearest_rows(latitude, longitude, count,
+                    min_heartbeat)
+            return [(float(distance), self.cloudlet_ids[row])
+                    for (row, distance) in zip(rows, distances)]
+
+    def search(self, latitude, longitude, count, min_heartbeat=None):
+        '''
+        return list of (distance, search record) of the @count closest
+        live cloudlets
+        '''
+        with self.lock:
+            rows, distances = self._nearest_rows(latitude, longitude, count,
+                    min_heartbeat)
+            return [(float(distance), self.records[row])
+                    for (row, distance) in zip(rows, distances)]
+
+    def location_of(self, cloudlet_id):
+        with self.lock:
+            row = self.rows.get(cloudlet_id, None)
+            if row is None:
+                return None
+            return (float(self.latitudes[row]), float(self.longitudes[row]))
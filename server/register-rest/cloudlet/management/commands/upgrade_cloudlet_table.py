@@ -0,0 +1,63 @@
+import json
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db import transaction
+
+from cloudlet.models import Cloudlet
+from cloudlet.models import parse_coordinate
+from cloudlet.models import parse_meta
+
+
+class Command(BaseCommand):
+    '''
+    Add the typed coordinate and meta_json columns to a cloudlet table
+    created by syncdb before they existed, and fill them in.
+
+    This is the upgrade path for Django < 1.7, which has no migrations;
+    with Django >= 1.7, use "migrate --fake-initial" instead. Columns that
+    already exist are left alone, so it is safe to run more than once.
+    '''
+    help = "Add the typed coordinate and meta_json columns to the " \
+            "cloudlet table (Django < 1.7)"
+    NEW_FIELDS = ('geo_latitude', 'geo_longitude', 'meta_json')
+    INDEX_NAME = 'cloudlet_cloudlet_status_geo'
+
+    def handle(self, *args, **options):
+        table = Cloudlet._meta.db_table
+        qn = connection.ops.quote_name
+        with transaction.atomic():
+            cursor = connection.cursor()
+            columns = [column[0] for column in
+                    connection.introspection.get_table_description(cursor,
+                        table)]
+            added = list()
+            for name in self.NEW_FIELDS:
+                field = Cloudlet._meta.get_field(name)
+                if field.column in columns:
+                    continue
+                # nullable, since MySQL has no default for a TEXT column;
+                # every row is filled in below
+                cursor.execute("ALTER TABLE %s ADD COLUMN %s %s NULL" % \
+                        (qn(table), qn(field.column),
+                            field.db_type(connection=connection)))
+                added.append(name)
+            if len(added) == 0:
+                self.stdout.write("%s is up to date" % table)
+                return
+            if 'geo_latitude' in added:
+                cursor.execute("CREATE INDEX %s ON %s (%s, %s, %s)" % \
+                        (qn(self.INDEX_NAME), qn(table), qn('status'),
+                            qn('geo_latitude'), qn('geo_longitude')))
+
+            count = 0
+            rows = Cloudlet.objects.values_list('pk', 'latitude',
+                    'longitude', 'meta').order_by('pk')
+            for (pk, latitude, longitude, meta) in list(rows):
+                Cloudlet.objects.filter(pk=pk).update(
+                        geo_latitude=parse_coordinate(latitude),
+                        geo_longitude=parse_coordinate(longitude),
+                        meta_json=json.dumps(parse_meta(meta), default=str))
+                count += 1
+        self.stdout.write("added %s to %s, and filled %d rows" % \
+                (", ".join(added), table, count))
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Cloudlet',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('pub_date', models.DateTimeField(default=django.utils.timezone.now)),
+                ('ip_address', models.CharField(max_length=16)),
+                ('features', models.CharField(max_length=250)),
+                ('rest_api_port', models.IntegerField(default=80)),
+                ('rest_api_url', models.CharField(max_length=250)),
+                ('status', models.CharField(choices=[('RUN', 'Running'), ('TER', 'Terminate')], max_length=3)),
+                ('mod_time', models.DateTimeField(default=django.utils.timezone.now)),
+                ('longitude', models.CharField(max_length=12)),
+                ('latitude', models.CharField(max_length=12)),
+                ('meta', models.CharField(default='', max_length=1024)),
+            ],
+        ),
+    ]
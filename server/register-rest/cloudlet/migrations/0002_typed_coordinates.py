@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+
+from django.db import migrations, models
+
+from cloudlet.models import parse_coordinate, parse_meta
+
+
+def fill_typed_columns(apps, schema_editor):
+    Cloudlet = apps.get_model('cloudlet', 'Cloudlet')
+    for cloudlet in Cloudlet.objects.all().iterator():
+        cloudlet.geo_latitude = parse_coordinate(cloudlet.latitude)
+        cloudlet.geo_longitude = parse_coordinate(cloudlet.longitude)
+        cloudlet.meta_json = json.dumps(parse_meta(cloudlet.meta), default=str)
+        cloudlet.save(update_fields=['geo_latitude', 'geo_longitude', 'meta_json'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cloudlet', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cloudlet',
+            name='geo_latitude',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='cloudlet',
+            name='geo_longitude',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='cloudlet',
+            name='meta_json',
+            field=models.TextField(default='{}'),
+        ),
+        migrations.AlterIndexTogether(
+            name='cloudlet',
+            index_together=set([('status', 'geo_latitude', 'geo_longitude')]),
+        ),
+        migrations.RunPython(fill_typed_columns, migrations.RunPython.noop),
+    ]
@@ -1,6 +1,7 @@
 import base64
 import datetime
 import ast
+import json
 from django.utils.timezone import utc
 from django.utils.timezone import now
 #from django.contrib.auth.models import Group
@@ -9,6 +10,29 @@ from django.db import models
 from uuid import uuid1
 
 
+def parse_coordinate(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_meta(meta):
+    '''
+    meta is stored as a python literal of the dict sent by the cloudlet
+    '''
+    if isinstance(meta, dict):
+        return meta
+    if meta is None or len(meta.strip()) == 0:
+        return dict()
+    try:
+        meta_dict = ast.literal_eval(meta)
+    except (ValueError, SyntaxError):
+        return dict()
+    if not isinstance(meta_dict, dict):
+        return dict()
+    return meta_dict
+
 
 class Cloudlet(models.Model):
     CLOUDLET_STATUS_RUNNING = 'RUN'
@@ -32,24 +56,43 @@ class Cloudlet(models.Model):
     #latitude = models.DecimalField(max_digits=10, decimal_places=4)
     meta = models.CharField(max_length=1024, default='')
 
+    # typed copies of latitude, longitude, and meta filled at save()
+    geo_latitude = models.FloatField(null=True, blank=True)
+    geo_longitude = models.FloatField(null=True, blank=True)
+    meta_json = models.TextField(default='{}')
+
+    class Meta:
+        index_together = [('status', 'geo_latitude', 'geo_longitude')]
+
     def save(self, *args, **kwargs):
+        self.geo_latitude = parse_coordinate(self.latitude)
+        self.geo_longitude = parse_coordinate(self.longitude)
+        self.meta_json = json.dumps(parse_meta(self.meta), default=str)
         return super(Cloudlet, self).save(*args, **kwargs)
 
     def __getitem__(self, item):
         return self.__dict__[item]
 
-    def search_out(self):
+    # fields required to build a search record
+    SEARCH_FIELDS = ('ip_address', 'latitude', 'longitude', 'rest_api_port',
+            'rest_api_url', 'status', 'mod_time', 'meta_json')
+
+    @staticmethod
+    def to_search_record(values):
         ret_dict = dict()
-        ret_dict['ip_address'] = self.ip_address
-        ret_dict['latitude'] = self.latitude
-        ret_dict['longitude'] = self.longitude
-        ret_dict['rest_api_port'] = self.rest_api_port
-        ret_dict['rest_api_url'] = self.rest_api_url
-        ret_dict['status'] = str(self.status)
-        ret_dict['mod_time'] = self.mod_time
-        ret_dict.update(ast.literal_eval(self.meta))
+        ret_dict['ip_address'] = values['ip_address']
+        ret_dict['latitude'] = values['latitude']
+        ret_dict['longitude'] = values['longitude']
+        ret_dict['rest_api_port'] = values['rest_api_port']
+        ret_dict['rest_api_url'] = values['rest_api_url']
+        ret_dict['status'] = str(values['status'])
+        ret_dict['mod_time'] = values['mod_time']
+        ret_dict.update(json.loads(values['meta_json']))
         return ret_dict
 
+    def search_out(self):
+        return Cloudlet.to_search_record(self.__dict__)
+
 
 class NotFound(Exception):
     pass
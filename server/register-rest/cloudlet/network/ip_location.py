@@ -22,6 +22,10 @@ import urllib
 import pprint
 import math
 import os
+import numpy
+import time
+import threading
+from collections import OrderedDict
 
 
 class IPGelocationError(Exception):
@@ -68,6 +72,35 @@ def geo_distance(lat1, lon1, lat2, lon2):
     return distance
 
 
+def geo_distance_batch(lat, lon, latitudes, longitudes):
+    '''
+    distances (km) from (@lat, @lon) to every point of @latitudes and
+    @longitudes, which are float64 arrays of the same length
+    '''
+    radius = 6371 # km
+    lat = math.radians(lat)
+    latitudes = numpy.radians(numpy.asarray(latitudes, dtype=numpy.float64))
+    longitudes = numpy.radians(numpy.asarray(longitudes, dtype=numpy.float64))
+    sin_dlat = numpy.sin((latitudes - lat)/2)
+    sin_dlon = numpy.sin((longitudes - math.radians(lon))/2)
+    a = sin_dlat*sin_dlat + math.cos(lat)*numpy.cos(latitudes)*sin_dlon*sin_dlon
+    numpy.clip(a, 0.0, 1.0, out=a)
+    return 2 * radius * numpy.arctan2(numpy.sqrt(a), numpy.sqrt(1-a))
+
+
+def nearest_indices(distances, count):
+    '''
+    indices of the @count smallest @distances in increasing order
+    '''
+    if count <= 0 or len(distances) == 0:
+        return numpy.empty(0, dtype=numpy.intp)
+    if count < len(distances):
+        candidates = numpy.argpartition(distances, count-1)[:count]
+    else:
+        candidates = numpy.arange(len(distances))
+    return candidates[numpy.argsort(distances[candidates], kind='mergesort')]
+
+
 def _is_float(str):
     try:
         float(str)
@@ -76,25 +109,91 @@ def _is_float(str):
         return False
 
 
+class LRUCache(object):
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.items = OrderedDict()
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.items:
+                return default
+            value = self.items.pop(key)
+            self.items[key] = value
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+            if len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+
 class IPLocation(object):
     CUR_PATH = os.path.dirname(os.path.abspath(__file__))
     MAXMIND_DB_PATH = os.path.join(CUR_PATH, "db", "GeoLiteCity.dat")
-
-    def __init__(self):
-        self.maxmind_db_path = IPLocation.MAXMIND_DB_PATH
+    LOOKUP_CACHE_SIZE = 65536
+    # interval to check whether the DB file is replaced
+    RELOAD_CHECK_PERIOD = 60
+
+    # GeoIP readers are shared by all instances in the process
+    _reader_lock = threading.Lock()
+    _readers = dict()   # db_path:(reader, mtime, last_check_time)
+
+    def __init__(self, maxmind_db_path=None):
+        self.maxmind_db_path = maxmind_db_path or IPLocation.MAXMIND_DB_PATH
+        self.lookup_cache = LRUCache(IPLocation.LOOKUP_CACHE_SIZE)
+        self.reader_mtime = None
+
+    def _get_reader(self):
+        db_path = self.maxmind_db_path
+        cur_time = time.time()
+        reader_info = IPLocation._readers.get(db_path, None)
+        if reader_info is not None and \
+                (cur_time - reader_info[2]) < IPLocation.RELOAD_CHECK_PERIOD:
+            return reader_info[0], reader_info[1]
+
+        with IPLocation._reader_lock:
+            import pygeoip
+            if db_path == None or os.path.exists(db_path) == False:
+                raise IPGelocationError("Cannot find maxmind DB at : %s" % db_path)
+            mtime = os.path.getmtime(db_path)
+            reader_info = IPLocation._readers.get(db_path, None)
+            if reader_info is None or reader_info[1] != mtime:
+                reader = pygeoip.GeoIP(db_path, pygeoip.MMAP_CACHE)
+            else:
+                reader = reader_info[0]
+            IPLocation._readers[db_path] = (reader, mtime, cur_time)
+        return reader, mtime
 
     def ip2location(self, ip_address):
         # get getlocation from http://maxmind.com/
-        import pygeoip
-        if self.maxmind_db_path == None or os.path.exists(self.maxmind_db_path) == False:
-            raise IPGelocationError("Cannot find maxmind DB at : %s" % self.maxmind_db_path)
-        self.gi = pygeoip.GeoIP(self.maxmind_db_path, pygeoip.MEMORY_CACHE)
-        ret_dict = self.gi.record_by_addr(ip_address)
+        reader, mtime = self._get_reader()
+        if mtime != self.reader_mtime:
+            # DB is replaced
+            self.lookup_cache.clear()
+            self.reader_mtime = mtime
+
+        location = self.lookup_cache.get(ip_address, False)
+        if location is not False:
+            return location
+        ret_dict = reader.record_by_addr(ip_address)
         if ret_dict:
             ret_dict['ip_address'] = ip_address
-            return Location(ret_dict)
+            location = Location(ret_dict)
         else:
-            return None
+            location = None
+        self.lookup_cache.put(ip_address, location)
+        return location
 
     def ip2location_hostip(self, ip_address):
         # get geolocation from http://www.hostip.info/
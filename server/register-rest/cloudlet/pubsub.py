@@ -0,0 +1,108 @@
+import json
+import logging
+import os
+import threading
+import time
+
+from importlib import import_module
+
+
+LOG = logging.getLogger(__name__)
+
+
+class LocalPubSub(object):
+    '''
+    Backend for a single worker. There is nobody else to deliver to.
+    '''
+    shared = False
+
+    def __init__(self, **kwargs):
+        pass
+
+    def publish(self, message):
+        pass
+
+    def subscribe(self, handler, on_reset):
+        pass
+
+
+class RedisPubSub(object):
+    '''
+    Deliver messages to the workers through a Redis channel, usually a
+    Redis server on the same machine.
+
+    Redis pub/sub drops messages while a subscriber is disconnected, so
+    @on_reset is called whenever the subscription is (re)established and
+    the subscriber should resynchronize.
+    '''
+    shared = True
+    URL = "redis://127.0.0.1:6379/0"
+    CHANNEL = "cloudlet-registry"
+    RETRY_PERIOD = 5
+
+    def __init__(self, url=URL, channel=CHANNEL, **kwargs):
+        import redis
+        self.client = redis.StrictRedis.from_url(url)
+        self.channel = channel
+        self.thread = None
+        self.thread_pid = None
+
+    def publish(self, message):
+        try:
+            self.client.publish(self.channel, json.dumps(message))
+        except Exception as e:
+            LOG.warning("failed to publish registry update: %s" % str(e))
+
+    def subscribe(self, handler, on_reset):
+        # a thread started before fork does not run in the child
+        if self.thread is not None and self.thread_pid == os.getpid():
+            return
+        self.thread_pid = os.getpid()
+        self.thread = threading.Thread(target=self._listen,
+                args=(handler, on_reset))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _listen(self, handler, on_reset):
+        while True:
+            try:
+                pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                on_reset()
+                for item in pubsub.listen():
+                    if item.get('type') != 'message':
+                        continue
+                    try:
+                        handler(json.loads(item['data']))
+                    except Exception as e:
+                        LOG.error("failed to apply registry update: %s" % str(e))
+            except Exception as e:
+                LOG.warning("registry subscription failed: %s" % str(e))
+            time.sleep(self.RETRY_PERIOD)
+
+
+BACKENDS = {
+    'local': LocalPubSub,
+    'redis': RedisPubSub,
+}
+
+
+def get_pubsub(config):
+    '''
+    build a backend from settings.CLOUDLET_PUBSUB, e.g.
+    {'BACKEND': 'redis', 'URL': 'redis://127.0.0.1:6379/0'}. BACKEND is
+    'local', 'redis', or a dotted path to a class.
+    '''
+    config = dict(config or {})
+    backend = config.pop('BACKEND', 'local')
+    backend_class = BACKENDS.get(backend, None)
+    if backend_class is None:
+        module_name, class_name = backend.rsplit('.', 1)
+        backend_class = getattr(import_module(module_name), class_name)
+    options = dict((key.lower(), value) for (key, value) in config.iteritems())
+    try:
+        return backend_class(**options)
+    except Exception as e:
+        LOG.error("registry pub/sub '%s' is not available, "
+                "fall back to local: %s" % (backend, str(e)))
+        return LocalPubSub()
@@ -0,0 +1,138 @@
+import logging
+
+from django.core.cache.backends.locmem import LocMemCache
+try:
+    from django.core.cache import caches
+    def _get_cache(alias):
+        return caches[alias]
+except ImportError:
+    from django.core.cache import get_cache as _get_cache
+
+from geo_index import ring_distance_bound
+
+
+LOG = logging.getLogger(__name__)
+
+
+class SearchCache(object):
+    '''
+    Short-lived cache of serialized search responses.
+
+    Entries are keyed by the query location quantized to LOCATION_QUANTUM
+    degrees, the number of results, and the response variant (format).
+    Each key also carries a version number. When a cloudlet joins, leaves,
+    or moves, the versions of the grid cells around it are bumped, and
+    cached responses of nearby queries are no longer found.
+
+    A response whose farthest result is closer than any cell outside the
+    3x3 neighborhood of the query can only be changed by cloudlets in that
+    neighborhood, so it is versioned by its own cell. Other responses are
+    versioned by a global version that every change bumps.
+
+    The cache is stored in the Django cache named @cache_alias, which
+    should be a memcached server shared by the gunicorn workers. If that
+    cache is not configured or fails, an in-process cache is used.
+    '''
+    LOCATION_QUANTUM = 0.01
+    TIMEOUT = 10
+    VERSION_TIMEOUT = 86400
+    KEY_PREFIX = "search"
+
+    def __init__(self, grid_index, timeout=TIMEOUT, cache_alias='search'):
+        self.grid_index = grid_index
+        self.timeout = timeout
+        self.cache_alias = cache_alias
+        self.shared_cache = None
+        self.local_cache = LocMemCache('cloudlet-search', {'TIMEOUT': timeout})
+
+    def _cache(self):
+        if self.shared_cache is None:
+            try:
+                self.shared_cache = _get_cache(self.cache_alias)
+            except Exception as e:
+                LOG.info("search cache '%s' is not available: %s" % \
+                        (self.cache_alias, str(e)))
+                self.shared_cache = self.local_cache
+        return self.shared_cache
+
+    def _call(self, method, *args):
+        cache = self._cache()
+        try:
+            return getattr(cache, method)(*args)
+        except ValueError:
+            # incr() of a missing key
+            raise
+        except Exception as e:
+            if cache is self.local_cache:
+                raise
+            LOG.warning("search cache failed, use local cache: %s" % str(e))
+            self.shared_cache = self.local_cache
+            return getattr(self.local_cache, method)(*args)
+
+    def _cell_version_key(self, cell):
+        return "%s:version:%d:%d" % (self.KEY_PREFIX, cell[0], cell[1])
+
+    def _global_version_key(self):
+        return "%s:version" % self.KEY_PREFIX
+
+    def _entry_keys(self, latitude, longitude, count, variant):
+        cell = self.grid_index.cell_of(latitude, longitude)
+        cell_version_key = self._cell_version_key(cell)
+        global_version_key = self._global_version_key()
+        versions = self._call('get_many', [cell_version_key, global_version_key])
+        cell_version = versions.get(cell_version_key, 0)
+        global_version = versions.get(global_version_key, 0)
+        location = "%d:%d:%d:%s" % (
+                int(round(latitude/self.LOCATION_QUANTUM)),
+                int(round(longitude/self.LOCATION_QUANTUM)), count, variant)
+        near_key = "%s:near:%d:%s" % (self.KEY_PREFIX, cell_version, location)
+        far_key = "%s:far:%d:%s" % (self.KEY_PREFIX, global_version, location)
+        return near_key, far_key
+
+    def get(self, latitude, longitude, count, variant):
+        '''
+        return (cached (content_type, body) or None, keys). The keys are
+        read before the search so that a change made during the search
+        is not hidden by the new entry.
+        '''
+        if not self.timeout:
+            return None, None
+        keys = self._entry_keys(latitude, longitude, count, variant)
+        entries = self._call('get_many', list(keys))
+        return entries.get(keys[0], None) or entries.get(keys[1], None), keys
+
+    def set(self, keys, latitude, max_distance, response):
+        '''
+        cache a serialized (content_type, body) @response under @keys from
+        get(). @max_distance is the distance to the farthest cloudlet, or
+        None if fewer cloudlets than requested were found.
+        '''
+        if not self.timeout or keys is None:
+            return
+        near_key, far_key = keys
+        neighbor_bound = ring_distance_bound(latitude, 2,
+                self.grid_index.cell_degree)
+        if max_distance is not None and max_distance < neighbor_bound:
+            self._call('set', near_key, response, self.timeout)
+        else:
+            self._call('set', far_key, response, self.timeout)
+
+    def _bump(self, key):
+        try:
+            self._call('incr', key)
+        except ValueError:
+            self._call('set', key, 1, self.VERSION_TIMEOUT)
+
+    def invalidate(self, latitude, longitude):
+        '''
+        invalidate responses that a cloudlet at the location could change
+        '''
+        lat_index, lon_index = self.grid_index.cell_of(latitude, longitude)
+        for dlat in (-1, 0, 1):
+            cur_lat = lat_index + dlat
+            if cur_lat < 0 or cur_lat >= self.grid_index.lat_cells:
+                continue
+            for dlon in (-1, 0, 1):
+                cur_lon = (lon_index + dlon) % self.grid_index.lon_cells
+                self._bump(self._cell_version_key((cur_lat, cur_lon)))
+        self._bump(self._global_version_key())
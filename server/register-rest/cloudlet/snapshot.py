@@ -0,0 +1,213 @@
+import datetime
+import itertools
+import logging
+import os
+import threading
+import uuid
+
+from django.utils.dateparse import parse_datetime
+
+from pubsub import LocalPubSub
+
+
+LOG = logging.getLogger(__name__)
+
+
+def _encode_record(record):
+    if record is None:
+        return None
+    encoded = dict(record)
+    mod_time = encoded.get('mod_time', None)
+    if isinstance(mod_time, datetime.datetime):
+        encoded['mod_time'] = mod_time.isoformat()
+    return encoded
+
+
+def _decode_record(record):
+    if record is None:
+        return None
+    mod_time = record.get('mod_time', None)
+    if isinstance(mod_time, basestring):
+        record['mod_time'] = parse_datetime(mod_time)
+    return record
+
+
+class RegistrySnapshot(object):
+    '''
+    In-memory snapshot of the running cloudlets of this worker, kept in a
+    GeoGridIndex and updated incrementally. Searches are served from the
+    snapshot only; the database is the durable store that the snapshot is
+    built from.
+
+    Every change made in this worker is applied to the snapshot and, with
+    a shared pub/sub backend, published to the other workers, which apply
+    it to their own snapshot. Messages carry a per-worker sequence number.
+    A gap in the sequence, or a new subscription, means updates may have
+    been lost, and the snapshot is rebuilt from the database.
+
+    Changes that arrive while the snapshot is rebuilt are journaled and
+    replayed on top of the rows read from the database, so none is lost to
+    a rebuild that read the table before the change was written.
+    '''
+    UPSERT = 'upsert'
+    REMOVE = 'remove'
+    TOUCH = 'touch'
+
+    def __init__(self, grid_index, search_cache=None, pubsub=None):
+        self.index = grid_index
+        self.search_cache = search_cache
+        self.pubsub = pubsub or LocalPubSub()
+        self.needs_rebuild = True
+        self.journal = None
+        self.host_id = uuid.uuid4().hex
+        self.sequence = itertools.count(1)
+        self.last_sequence = dict()     # origin:sequence
+        self.publish_lock = threading.Lock()
+        self.rebuild_lock = threading.Lock()
+        self.subscribed_pid = None
+
+    def _origin(self):
+        # workers forked from one master share host_id
+        return "%s:%d" % (self.host_id, os.getpid())
+
+    def start(self):
+        '''
+        subscribe in the current process, i.e. after gunicorn forks workers
+        '''
+        pid = os.getpid()
+        if self.subscribed_pid == pid:
+            return
+        self.subscribed_pid = pid
+        self.pubsub.subscribe(self.receive, self.reset)
+
+    def reset(self):
+        '''
+        the snapshot may have missed changes; rebuild before the next search
+        '''
+        self.needs_rebuild = True
+
+    def is_expired(self):
+        self.start()
+        if self.needs_rebuild:
+            return True
+        if self.pubsub.shared:
+            # changes of the other workers are pushed
+            return False
+        return self.index.is_expired()
+
+    def rebuild(self, loader):
+        '''
+        replace the snapshot with the (cloudlet_id, latitude, longitude,
+        record, heartbeat) list returned by @loader
+        '''
+        with self.rebuild_lock:
+            if not self.is_expired():
+                # rebuilt by another thread
+                return
+            with self.index.lock:
+                self.needs_rebuild = False
+                self.journal = list()
+            try:
+                point_list = loader()
+            except Exception:
+                with self.index.lock:
+                    self.journal = None
+                    self.needs_rebuild = True
+                raise
+            with self.index.lock:
+                journal, self.journal = self.journal, None
+                self.index.load(point_list)
+                for mutation in journal:
+                    self._apply(mutation)
+
+    def search(self, latitude, longitude, count, min_heartbeat=None):
+        return self.index.search(latitude, longitude, count, min_heartbeat)
+
+    def upsert(self, cloudlet_id, latitude, longitude, record, heartbeat):
+        self._mutate((RegistrySnapshot.UPSERT, cloudlet_id, latitude,
+            longitude, record, heartbeat))
+
+    def remove(self, cloudlet_id):
+        self._mutate((RegistrySnapshot.REMOVE, cloudlet_id))
+
+    def touch(self, cloudlet_id, heartbeat, record_update=None):
+        '''
+        return False if the cloudlet is not in the snapshot of this worker
+        '''
+        return self._mutate((RegistrySnapshot.TOUCH, cloudlet_id, heartbeat,
+            record_update))
+
+    def receive(self, message):
+        '''
+        apply a change published by another worker
+        '''
+        origin = message.get('origin', None)
+        if origin == self._origin():
+            return
+        sequence = message.get('sequence', None)
+        last_sequence = self.last_sequence.get(origin, None)
+        self.last_sequence[origin] = sequence
+        if last_sequence is not None and sequence != last_sequence + 1:
+            LOG.warning("missed registry updates from %s (%s after %s)" % \
+                    (origin, sequence, last_sequence))
+            self.reset()
+        mutation = list(message['mutation'])
+        if mutation[0] == RegistrySnapshot.UPSERT:
+            mutation[4] = _decode_record(mutation[4])
+        elif mutation[0] == RegistrySnapshot.TOUCH:
+            mutation[3] = _decode_record(mutation[3])
+        self._mutate(tuple(mutation), publish=False)
+
+    def _mutate(self, mutation, publish=True):
+        if publish and self.pubsub.shared:
+            self.start()
+            # publish in the order of the sequence numbers
+            with self.publish_lock:
+                old_location, applied = self._apply_locked(mutation)
+                self._publish(mutation)
+        else:
+            old_location, applied = self._apply_locked(mutation)
+        self._invalidate(old_location, mutation)
+        return applied
+
+    def _apply_locked(self, mutation):
+        with self.index.lock:
+            old_location = self.index.location_of(mutation[1])
+            return old_location, self._apply(mutation)
+
+    def _apply(self, mutation):
+        if self.journal is not None:
+            self.journal.append(mutation)
+        if mutation[0] == RegistrySnapshot.UPSERT:
+            self.index.add(*mutation[1:])
+            return True
+        elif mutation[0] == RegistrySnapshot.REMOVE:
+            self.index.remove(mutation[1])
+            return True
+        elif mutation[0] == RegistrySnapshot.TOUCH:
+            return self.index.touch(*mutation[1:])
+        LOG.error("unknown registry update: %s" % str(mutation[0]))
+        return False
+
+    def _publish(self, mutation):
+        mutation = list(mutation)
+        if mutation[0] == RegistrySnapshot.UPSERT:
+            mutation[4] = _encode_record(mutation[4])
+        elif mutation[0] == RegistrySnapshot.TOUCH:
+            mutation[3] = _encode_record(mutation[3])
+        self.pubsub.publish({
+            'origin': self._origin(),
+            'sequence': self.sequence.next(),
+            'mutation': mutation,
+            })
+
+    def _invalidate(self, old_location, mutation):
+        # cached search responses around the old and the new location
+        if self.search_cache is None or mutation[0] == RegistrySnapshot.TOUCH:
+            return
+        if old_location is not None:
+            self.search_cache.invalidate(*old_location)
+        if mutation[0] == RegistrySnapshot.UPSERT:
+            new_location = (mutation[2], mutation[3])
+            if new_location != old_location:
+                self.search_cache.invalidate(*new_location)
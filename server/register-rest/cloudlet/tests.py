@@ -5,7 +5,24 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
+import json
+import random
+import datetime
+
+import msgpack
+from StringIO import StringIO
+
+from django.core.management import call_command
+from django.db import connection
 from django.test import TestCase
+from django.utils.timezone import now
+
+from cloudlet import api
+from cloudlet.geo_index import GeoGridIndex
+from cloudlet.models import Cloudlet
+from cloudlet.network import ip_location
+from cloudlet.snapshot import RegistrySnapshot
+from cloudlet.write_behind import WriteBehindBuffer
 
 
 class SimpleTest(TestCase):
@@ -14,3 +31,337 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class GeoGridIndexTest(TestCase):
+    def setUp(self):
+        rand = random.Random(0)
+        self.points = [(cloudlet_id, rand.uniform(-90, 90), rand.uniform(-180, 180))
+                for cloudlet_id in xrange(1000)]
+        self.index = GeoGridIndex()
+        self.index.load([(cloudlet_id, latitude, longitude, None, None)
+            for (cloudlet_id, latitude, longitude) in self.points])
+
+    def _brute_force(self, latitude, longitude, count):
+        distances = sorted((ip_location.geo_distance(latitude, longitude,
+            point_lat, point_lon), cloudlet_id)
+            for (cloudlet_id, point_lat, point_lon) in self.points)
+        return [cloudlet_id for (distance, cloudlet_id) in distances[:count]]
+
+    def test_nearest_matches_full_scan(self):
+        for (latitude, longitude) in [(40.44, -79.94), (89.9, 10.0),
+                (-33.9, 151.2), (0.0, 179.9)]:
+            found = [cloudlet_id for (distance, cloudlet_id) in \
+                    self.index.nearest(latitude, longitude, 5)]
+            self.assertEqual(found, self._brute_force(latitude, longitude, 5))
+
+    def test_remove(self):
+        cloudlet_id = self.index.nearest(40.44, -79.94, 1)[0][1]
+        self.index.remove(cloudlet_id)
+        self.assertNotIn(cloudlet_id, [item[1] for item in \
+                self.index.nearest(40.44, -79.94, 5)])
+
+
+class GeoDistanceBatchTest(TestCase):
+    def test_batch_matches_scalar(self):
+        latitudes = [40.44, -33.9, 0.0, 89.9]
+        longitudes = [-79.94, 151.2, 179.9, 10.0]
+        distances = ip_location.geo_distance_batch(37.77, -122.42,
+                latitudes, longitudes)
+        for (index, distance) in enumerate(distances):
+            self.assertAlmostEqual(distance, ip_location.geo_distance(
+                37.77, -122.42, latitudes[index], longitudes[index]), places=6)
+        self.assertEqual(list(ip_location.nearest_indices(distances, 2)),
+                [0, 3])
+
+
+class CloudletSearchTest(TestCase):
+    SEARCH_URL = "/api/v1/Cloudlet/search/"
+
+    def setUp(self):
+        api.cloudlet_index.loaded_time = None
+        api.search_cache.local_cache.clear()
+        self.locations = {"pittsburgh": ("40.44", "-79.94"),
+                "new-york": ("40.71", "-74.00"), "seoul": ("37.56", "126.97")}
+        for (index, (name, (latitude, longitude))) in \
+                enumerate(sorted(self.locations.items())):
+            Cloudlet.objects.create(ip_address="10.0.0.%d" % index,
+                    rest_api_url="/api/v1/resource/", rest_api_port=8022,
+                    status=Cloudlet.CLOUDLET_STATUS_RUNNING,
+                    latitude=latitude, longitude=longitude,
+                    meta=repr({"name": name}))
+
+    def _search(self, **params):
+        response = self.client.get(self.SEARCH_URL, params)
+        self.assertEqual(response.status_code, 200)
+        return [item["name"] for item in json.loads(response.content)["cloudlet"]]
+
+    def test_search_sorted_by_distance(self):
+        self.assertEqual(self._search(latitude="40.0", longitude="-80.0", n=2),
+                ["pittsburgh", "new-york"])
+
+    def test_search_response_is_cached(self):
+        self.assertEqual(self._search(latitude="40.0", longitude="-80.0", n=1),
+                ["pittsburgh"])
+        api.cloudlet_index.remove(Cloudlet.objects.get(latitude="40.44").pk)
+        self.assertEqual(self._search(latitude="40.001", longitude="-80.001", n=1),
+                ["pittsburgh"])
+
+    def test_status_change_invalidates_cache(self):
+        self.assertEqual(self._search(latitude="40.0", longitude="-80.0", n=1),
+                ["pittsburgh"])
+        Cloudlet.objects.create(ip_address="10.0.0.9",
+                rest_api_url="/api/v1/resource/", rest_api_port=8022,
+                status=Cloudlet.CLOUDLET_STATUS_RUNNING,
+                latitude="40.01", longitude="-80.01", meta=repr({"name": "near"}))
+        self.assertEqual(self._search(latitude="40.0", longitude="-80.0", n=1),
+                ["near"])
+
+    def test_search_skips_terminated(self):
+        cloudlet = Cloudlet.objects.get(latitude="40.44")
+        cloudlet.status = Cloudlet.CLOUDLET_STATUS_TERMINATE
+        cloudlet.save()
+        self.assertEqual(self._search(latitude="40.0", longitude="-80.0", n=5),
+                ["new-york", "seoul"])
+
+    def test_compact_json(self):
+        response = self.client.get(self.SEARCH_URL,
+                {"latitude": "40.0", "longitude": "-80.0"})
+        self.assertNotIn("\n", response.content)
+        self.assertNotIn(", ", response.content)
+
+    def test_pretty_json(self):
+        response = self.client.get(self.SEARCH_URL,
+                {"latitude": "40.0", "longitude": "-80.0", "pretty": "1"})
+        self.assertIn("\n  ", response.content)
+
+    def test_msgpack(self):
+        response = self.client.get(self.SEARCH_URL,
+                {"latitude": "40.0", "longitude": "-80.0", "n": 2},
+                HTTP_ACCEPT="application/x-msgpack")
+        self.assertTrue(response["Content-Type"].startswith("application/x-msgpack"))
+        names = [item["name"] for item in msgpack.unpackb(response.content)["cloudlet"]]
+        self.assertEqual(names, ["pittsburgh", "new-york"])
+
+
+class CloudletHeartbeatTest(TestCase):
+    def setUp(self):
+        api.cloudlet_index.loaded_time = None
+        api.search_cache.local_cache.clear()
+        self.flush_period = api.write_buffer.flush_period
+        api.write_buffer.flush_period = 0
+        self.cloudlet = Cloudlet.objects.create(ip_address="10.0.0.1",
+                rest_api_url="/api/v1/resource/", rest_api_port=8022,
+                status=Cloudlet.CLOUDLET_STATUS_RUNNING,
+                latitude="40.44", longitude="-79.94", meta=repr({"cpu": 10}))
+        self.url = "/api/v1/Cloudlet/%d/heartbeat/" % self.cloudlet.pk
+
+    def tearDown(self):
+        api.write_buffer.flush()
+        api.write_buffer.flush_period = self.flush_period
+
+    def _search(self):
+        response = self.client.get("/api/v1/Cloudlet/search/",
+                {"latitude": "40.0", "longitude": "-80.0"})
+        return json.loads(response.content)["cloudlet"]
+
+    def test_heartbeat_updates_meta(self):
+        response = self.client.post(self.url, json.dumps({"meta": {"cpu": 55}}),
+                content_type="application/json")
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(Cloudlet.objects.get(pk=self.cloudlet.pk).meta_json,
+                json.dumps({"cpu": 55}))
+        self.assertEqual(self._search()[0]["cpu"], 55)
+
+    def test_heartbeat_of_terminated_cloudlet(self):
+        self.cloudlet.status = Cloudlet.CLOUDLET_STATUS_TERMINATE
+        self.cloudlet.save()
+        response = self.client.post(self.url, "{}",
+                content_type="application/json")
+        self.assertEqual(response.status_code, 404)
+
+    def test_stale_cloudlet_is_not_searched(self):
+        self.assertEqual(len(self._search()), 1)
+        api.cloudlet_index.touch(self.cloudlet.pk, 0)
+        api.search_cache.local_cache.clear()
+        self.assertEqual(len(self._search()), 0)
+
+
+class WriteBehindTest(TestCase):
+    def setUp(self):
+        api.cloudlet_index.loaded_time = None
+        api.search_cache.local_cache.clear()
+        self.flush_period = api.write_buffer.flush_period
+        api.write_buffer.flush_period = 3600
+        self.cloudlet = Cloudlet.objects.create(ip_address="10.0.0.1",
+                rest_api_url="/api/v1/resource/", rest_api_port=8022,
+                status=Cloudlet.CLOUDLET_STATUS_RUNNING, features="app",
+                latitude="40.44", longitude="-79.94", meta=repr({"cpu": 10}))
+        self.url = "/api/v1/Cloudlet/%d/" % self.cloudlet.pk
+
+    def tearDown(self):
+        api.write_buffer.flush()
+        api.write_buffer.flush_period = self.flush_period
+
+    def _put(self, data):
+        response = self.client.put(self.url, json.dumps(data),
+                content_type="application/json")
+        self.assertIn(response.status_code, (200, 202, 204))
+
+    def _search(self):
+        response = self.client.get("/api/v1/Cloudlet/search/",
+                {"latitude": "40.0", "longitude": "-80.0"})
+        return json.loads(response.content)["cloudlet"]
+
+    def test_status_update_is_buffered(self):
+        self._put({"status": "RUN", "features": "app", "meta": {"cpu": 70}})
+        self.assertEqual(len(api.write_buffer), 1)
+        self.assertEqual(Cloudlet.objects.get(pk=self.cloudlet.pk).meta_json,
+                json.dumps({"cpu": 10}))
+        self.assertEqual(self._search()[0]["cpu"], 70)
+
+        api.write_buffer.flush()
+        self.assertEqual(len(api.write_buffer), 0)
+        self.assertEqual(Cloudlet.objects.get(pk=self.cloudlet.pk).meta_json,
+                json.dumps({"cpu": 70}))
+
+    def test_status_change_is_written_through(self):
+        self._put({"status": "RUN", "features": "app", "meta": {"cpu": 70}})
+        self._put({"status": "TER"})
+        self.assertEqual(len(api.write_buffer), 0)
+        self.assertEqual(Cloudlet.objects.get(pk=self.cloudlet.pk).status,
+                Cloudlet.CLOUDLET_STATUS_TERMINATE)
+        self.assertEqual(self._search(), [])
+
+    def test_flush_does_not_overwrite_newer_save(self):
+        self._put({"status": "RUN", "features": "app", "meta": {"cpu": 70}})
+        # a full save in another worker after the buffered update
+        cloudlet = Cloudlet.objects.get(pk=self.cloudlet.pk)
+        cloudlet.meta = repr({"cpu": 90})
+        cloudlet.mod_time = now() + datetime.timedelta(seconds=1)
+        cloudlet.save()
+        api.write_buffer.flush()
+        self.assertEqual(Cloudlet.objects.get(pk=self.cloudlet.pk).meta_json,
+                json.dumps({"cpu": 90}))
+
+    def test_terminate_stops_thread_and_flushes(self):
+        write_buffer = WriteBehindBuffer(Cloudlet, flush_period=3600)
+        write_buffer.add(self.cloudlet.pk, {"features": "other"})
+        self.assertTrue(write_buffer.flush_thread.is_alive())
+        write_buffer.terminate()
+        self.assertFalse(write_buffer.flush_thread.is_alive())
+        self.assertEqual(Cloudlet.objects.get(pk=self.cloudlet.pk).features,
+                "other")
+        # written through once stopped
+        write_buffer.add(self.cloudlet.pk, {"features": "app"})
+        self.assertEqual(len(write_buffer), 0)
+
+
+class MemoryPubSub(object):
+    '''
+    deliver messages between snapshots in this process
+    '''
+    shared = True
+
+    def __init__(self):
+        self.handlers = list()
+
+    def publish(self, message):
+        message = json.loads(json.dumps(message))
+        for handler in self.handlers:
+            handler(message)
+
+    def subscribe(self, handler, on_reset):
+        self.handlers.append(handler)
+
+
+class RegistrySnapshotTest(TestCase):
+    def setUp(self):
+        self.pubsub = MemoryPubSub()
+        self.snapshots = [RegistrySnapshot(GeoGridIndex(), None, self.pubsub)
+                for index in range(2)]
+        # each snapshot stands for another worker
+        for (index, snapshot) in enumerate(self.snapshots):
+            snapshot.host_id = "worker-%d" % index
+            snapshot.rebuild(lambda: [])
+
+    def test_update_is_pushed(self):
+        mod_time = now()
+        self.snapshots[0].upsert(1, 40.44, -79.94,
+                {"ip_address": "10.0.0.1", "mod_time": mod_time}, 100.0)
+        results = self.snapshots[1].search(40.0, -80.0, 5)
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0][1]["mod_time"], mod_time)
+        self.assertTrue(self.snapshots[1].touch(1, 200.0, {"cpu": 5}))
+        self.assertEqual(self.snapshots[0].index.get_record(1)["cpu"], 5)
+        self.snapshots[1].remove(1)
+        self.assertEqual(len(self.snapshots[0].search(40.0, -80.0, 5)), 0)
+        self.assertFalse(self.snapshots[0].is_expired())
+
+    def test_update_during_rebuild_is_replayed(self):
+        snapshot = self.snapshots[1]
+        snapshot.reset()
+        def loader():
+            # written after the rows were read
+            self.snapshots[0].upsert(2, 10.0, 10.0, {}, 100.0)
+            return [(1, 40.44, -79.94, {}, 100.0)]
+        snapshot.rebuild(loader)
+        self.assertEqual(set(snapshot.index.cloudlet_ids), set([1, 2]))
+        self.assertFalse(snapshot.is_expired())
+
+    def test_missed_update_forces_rebuild(self):
+        self.snapshots[0].upsert(1, 40.44, -79.94, {}, 100.0)
+        self.snapshots[0].sequence.next()
+        self.snapshots[0].upsert(2, 10.0, 10.0, {}, 100.0)
+        self.assertTrue(self.snapshots[1].is_expired())
+
+
+class CloudletDeleteTest(TestCase):
+    def setUp(self):
+        api.cloudlet_index.loaded_time = None
+        api.search_cache.local_cache.clear()
+
+    def test_deleted_cloudlet_is_not_searched(self):
+        cloudlet = Cloudlet.objects.create(ip_address="10.0.0.1",
+                rest_api_url="/api/v1/resource/", rest_api_port=8022,
+                status=Cloudlet.CLOUDLET_STATUS_RUNNING,
+                latitude="40.44", longitude="-79.94")
+        search = lambda: json.loads(self.client.get("/api/v1/Cloudlet/search/",
+            {"latitude": "40.0", "longitude": "-80.0"}).content)["cloudlet"]
+        self.assertEqual(len(search()), 1)
+        cloudlet.delete()
+        self.assertEqual(len(search()), 0)
+
+
+class UpgradeCloudletTableTest(TestCase):
+    # the cloudlet table as syncdb created it before the typed columns
+    LEGACY_TABLE = '''CREATE TABLE "cloudlet_cloudlet" (
+        "id" integer NOT NULL PRIMARY KEY,
+        "pub_date" datetime NOT NULL,
+        "ip_address" varchar(16) NOT NULL,
+        "features" varchar(250) NOT NULL,
+        "rest_api_port" integer NOT NULL,
+        "rest_api_url" varchar(250) NOT NULL,
+        "status" varchar(3) NOT NULL,
+        "mod_time" datetime NOT NULL,
+        "longitude" varchar(12) NOT NULL,
+        "latitude" varchar(12) NOT NULL,
+        "meta" varchar(1024) NOT NULL)'''
+
+    def test_upgrade_legacy_table(self):
+        cursor = connection.cursor()
+        cursor.execute('DROP TABLE "cloudlet_cloudlet"')
+        cursor.execute(self.LEGACY_TABLE)
+        cursor.execute('INSERT INTO "cloudlet_cloudlet" VALUES (1, '
+                '"2014-01-01 00:00:00", "10.0.0.1", "", 8022, "/", "RUN", '
+                '"2014-01-01 00:00:00", "-79.94", "40.44", %s)',
+                [repr({"cpu": 4})])
+        out = StringIO()
+        call_command("upgrade_cloudlet_table", stdout=out)
+        cloudlet = Cloudlet.objects.get(pk=1)
+        self.assertEqual((cloudlet.geo_latitude, cloudlet.geo_longitude),
+                (40.44, -79.94))
+        self.assertEqual(json.loads(cloudlet.meta_json), {"cpu": 4})
+        # nothing left to do
+        call_command("upgrade_cloudlet_table", stdout=out)
+        self.assertIn("up to date", out.getvalue())
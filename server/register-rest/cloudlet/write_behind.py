@@ -0,0 +1,157 @@
+import atexit
+import logging
+import threading
+
+from django.db import connection
+from django.db import transaction
+
+
+LOG = logging.getLogger(__name__)
+
+
+class WriteBehindBuffer(object):
+    '''
+    Collect column updates of model rows in memory and write them to the
+    database in bulk.
+
+    Pending updates of the same row are merged, and rows that update the
+    same set of columns are written with one multi-row UPDATE statement
+    (UPDATE ... SET col = CASE pk WHEN .. THEN .. END WHERE pk IN (..)).
+    A background thread flushes every @flush_period seconds, or as soon as
+    @max_pending rows are waiting. With @flush_period of 0, updates are
+    written synchronously. At exit, the thread is stopped and the updates
+    left are flushed.
+
+    With @version_field, e.g. a modification time that every update sets,
+    a row is only updated if its stored version is older than the buffered
+    one, so a late flush does not overwrite a newer save made elsewhere,
+    e.g. by another worker.
+    '''
+    FLUSH_PERIOD = 2
+    MAX_PENDING = 1000
+    BATCH_SIZE = 200
+    TERMINATE_TIMEOUT = 10
+
+    def __init__(self, model, flush_period=FLUSH_PERIOD,
+            max_pending=MAX_PENDING, batch_size=BATCH_SIZE, version_field=None):
+        self.model = model
+        self.version_field = version_field
+        self.flush_period = flush_period
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.pending = dict()   # pk:dict(field_name:value)
+        self.wakeup = threading.Event()
+        self.stop = threading.Event()
+        self.flush_thread = None
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, pk, fields):
+        with self.lock:
+            self.pending.setdefault(pk, dict()).update(fields)
+            pending_count = len(self.pending)
+        if not self.flush_period or self.stop.is_set():
+            self.flush()
+            return
+        self._start()
+        if pending_count >= self.max_pending:
+            self.wakeup.set()
+
+    def discard(self, pk):
+        '''
+        drop pending updates of @pk, e.g. before the row is fully saved
+        '''
+        with self.lock:
+            self.pending.pop(pk, None)
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                pending = self.pending
+                self.pending = dict()
+            if len(pending) == 0:
+                return
+            try:
+                self._bulk_update(pending)
+            except Exception as e:
+                LOG.error("failed to flush %d updates: %s" % (len(pending), str(e)))
+                # keep updates that have not been superseded for the next try
+                with self.lock:
+                    for (pk, fields) in pending.iteritems():
+                        fields.update(self.pending.get(pk, dict()))
+                        self.pending[pk] = fields
+
+    def _bulk_update(self, pending):
+        # group rows that update the same set of columns
+        groups = dict()
+        for (pk, fields) in pending.iteritems():
+            groups.setdefault(tuple(sorted(fields.keys())), list()).append(pk)
+
+        opts = self.model._meta
+        quote_name = connection.ops.quote_name
+        table = quote_name(opts.db_table)
+        pk_column = quote_name(opts.pk.column)
+        with transaction.atomic():
+            cursor = connection.cursor()
+            for (field_names, pk_list) in groups.iteritems():
+                for start in xrange(0, len(pk_list), self.batch_size):
+                    batch = pk_list[start:start+self.batch_size]
+                    set_clauses = list()
+                    params = list()
+                    for field_name in field_names:
+                        field = opts.get_field(field_name)
+                        set_clauses.append("%s = CASE %s %s END" % (
+                            quote_name(field.column), pk_column,
+                            " ".join(["WHEN %s THEN %s"]*len(batch))))
+                        for pk in batch:
+                            params.append(pk)
+                            params.append(field.get_db_prep_save(
+                                pending[pk][field_name], connection))
+                    params += batch
+                    where = "%s IN (%s)" % (pk_column,
+                            ", ".join(["%s"]*len(batch)))
+                    if self.version_field in field_names:
+                        field = opts.get_field(self.version_field)
+                        where += " AND %s < CASE %s %s END" % (
+                            quote_name(field.column), pk_column,
+                            " ".join(["WHEN %s THEN %s"]*len(batch)))
+                        for pk in batch:
+                            params.append(pk)
+                            params.append(field.get_db_prep_save(
+                                pending[pk][self.version_field], connection))
+                    cursor.execute("UPDATE %s SET %s WHERE %s" % (
+                        table, ", ".join(set_clauses), where), params)
+
+    def _start(self):
+        if self.flush_thread is not None:
+            return
+        with self.lock:
+            if self.flush_thread is not None:
+                return
+            self.flush_thread = threading.Thread(target=self._run)
+            self.flush_thread.daemon = True
+            self.flush_thread.start()
+            atexit.register(self.terminate)
+
+    def _run(self):
+        while not self.stop.is_set():
+            self.wakeup.wait(self.flush_period)
+            self.wakeup.clear()
+            if self.stop.is_set():
+                break
+            self.flush()
+            # do not hold an idle connection in this thread
+            connection.close()
+
+    def terminate(self):
+        '''
+        stop the flush thread, and flush the updates left
+        '''
+        self.stop.set()
+        self.wakeup.set()
+        if self.flush_thread is not None:
+            self.flush_thread.join(self.TERMINATE_TIMEOUT)
+        self.flush()
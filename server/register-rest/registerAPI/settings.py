@@ -14,6 +14,49 @@ TASTYPIE_FULL_DEBUG = True
 API_LIMIT_PER_PAGE = 0
 APPEND_SLASH = False
 
+# cloudlets send a heartbeat at this period (seconds)
+CLOUDLET_HEARTBEAT_PERIOD = 30
+
+# heartbeat and meta updates are buffered and written to the database in
+# bulk at this period (seconds). 0 writes them synchronously.
+CLOUDLET_WRITE_BEHIND_PERIOD = 2
+
+# without a shared pub/sub, each worker re-reads the registry at this period
+# (seconds), and sees heartbeats handled by other workers only then
+CLOUDLET_INDEX_REBUILD_PERIOD = 60
+
+# cloudlets that have not sent a heartbeat for this many seconds are
+# excluded from search. A heartbeat can reach another worker up to
+# CLOUDLET_INDEX_REBUILD_PERIOD + CLOUDLET_WRITE_BEHIND_PERIOD seconds late,
+# and one missed heartbeat is tolerated.
+CLOUDLET_HEARTBEAT_TTL = 2*CLOUDLET_HEARTBEAT_PERIOD + \
+        CLOUDLET_INDEX_REBUILD_PERIOD + CLOUDLET_WRITE_BEHIND_PERIOD
+
+# search responses are cached for this many seconds. 0 disables the cache.
+CLOUDLET_SEARCH_CACHE_TIMEOUT = 10
+
+# changes of the registry are pushed to the search snapshot of the other
+# gunicorn workers through this pub/sub backend ('local', 'redis', or a
+# dotted path to a class). 'local' does not share changes, and each worker
+# re-reads the table every minute instead.
+CLOUDLET_PUBSUB = {
+    'BACKEND': 'local',
+    #'BACKEND': 'redis',
+    #'URL': 'redis://127.0.0.1:6379/0',
+}
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # Share cached search responses between gunicorn workers with a local
+    # memcached. Without it, each worker caches in its own memory.
+    #'search': {
+    #    'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+    #    'LOCATION': '127.0.0.1:11211',
+    #},
+}
+
 ADMINS = (
     # ('Your Name', 'your_email@example.com'),
 )
@@ -0,0 +1,16 @@
+# Django settings for the registry benchmark (bench_registry.py)
+import os
+from settings import *
+
+DEBUG = False
+TEMPLATE_DEBUG = DEBUG
+TASTYPIE_FULL_DEBUG = False
+ALLOWED_HOSTS = ['*']
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.environ.get('CLOUDLET_BENCH_DB',
+            os.path.join(BASE_DIR, 'bench.sqlite3')),
+    }
+}